@@ -0,0 +1,203 @@
+"""Local stand-in for the Anthropic messages API with prompt caching.
+
+    python -m benchmarks.anthropic_stub [--port 8787] [--min-cache-tokens 1024]
+
+Serves POST /v1/messages, both plain and streamed (SSE), and simulates
+prompt caching the way the API documents it. A breakpoint caches the prefix
+up to and including its block: tools, then system, then messages. A request
+reads the longest cached prefix that ends at one of its breakpoints, and
+writes the breakpoints past it that meet the minimum length. Entries live
+for five minutes after their last use. Token counts are estimates (three
+characters per token), and so are the usage numbers returned. Replies
+follow the chain's prompts closely enough for it to run: YES to the judge,
+the question back to the contextualizer, and a fixed answer otherwise.
+Point ChatAnthropic at it with ANTHROPIC_API_URL=http://127.0.0.1:PORT.
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CACHE_TTL_S = 300
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN) if text else 0
+
+
+def _blocks(body: dict) -> list[tuple[dict, bool]]:
+    # Every prompt block in cache order, with whether it is a breakpoint.
+    out = []
+    for tool in body.get("tools") or []:
+        out.append((tool, "cache_control" in tool))
+    system = body.get("system")
+    if isinstance(system, str):
+        out.append(({"type": "text", "text": system}, False))
+    elif system:
+        for block in system:
+            out.append((block, "cache_control" in block))
+    for message in body.get("messages") or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for block in content:
+            out.append(({**block, "role": message.get("role")}, "cache_control" in block))
+    return out
+
+
+def _block_text(block: dict) -> str:
+    return str(block.get("text") or block.get("content") or json.dumps(block, sort_keys=True))
+
+
+class PromptCache:
+    def __init__(self, min_tokens: int):
+        self.min_tokens = min_tokens
+        self._entries: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def usage(self, body: dict) -> dict:
+        h = hashlib.sha256(str(body.get("model")).encode())
+        total = 0
+        breakpoints = []
+        for block, is_breakpoint in _blocks(body):
+            stripped = {k: v for k, v in block.items() if k != "cache_control"}
+            h.update(json.dumps(stripped, sort_keys=True, ensure_ascii=False).encode())
+            total += estimate_tokens(_block_text(block))
+            if is_breakpoint:
+                breakpoints.append((h.hexdigest(), total))
+
+        now = time.monotonic()
+        read = written = 0
+        with self._lock:
+            self._entries = {k: t for k, t in self._entries.items() if now - t < CACHE_TTL_S}
+            for key, tokens in reversed(breakpoints):
+                if key in self._entries:
+                    read = tokens
+                    self._entries[key] = now
+                    break
+            for key, tokens in breakpoints:
+                if tokens > read and tokens >= self.min_tokens and key not in self._entries:
+                    self._entries[key] = now
+                    written = tokens
+        written = max(0, written - read)
+        return {
+            "input_tokens": total - read - written,
+            "cache_creation_input_tokens": written,
+            "cache_read_input_tokens": read,
+        }
+
+
+def reply_for(body: dict) -> str:
+    system = body.get("system") or ""
+    if not isinstance(system, str):
+        system = " ".join(str(b.get("text", "")) for b in system)
+    last = body["messages"][-1]["content"]
+    if not isinstance(last, str):
+        last = " ".join(str(b.get("text", "")) for b in last)
+    if "YES albo NO" in system:
+        return "YES"
+    if "samodzielne pytanie" in system:
+        return last.strip()
+    return "Zgodnie z procedurą podróży służbowych obowiązują zasady opisane w dokumencie."
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, *, min_cache_tokens: int = 1024):
+        super().__init__(address, _Handler)
+        self.cache = PromptCache(min_cache_tokens)
+        self.calls: list[dict] = []
+        self.calls_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/messages":
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        text = reply_for(body)
+        usage = {**self.server.cache.usage(body), "output_tokens": estimate_tokens(text)}
+        with self.server.calls_lock:
+            self.server.calls.append({"system": body.get("system"), "usage": usage})
+        message = {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": usage,
+        }
+        if body.get("stream"):
+            self._stream(message, text)
+        else:
+            self._json(message)
+
+    def _json(self, payload: dict) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, message: dict, text: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        usage = message["usage"]
+
+        def event(name: str, data: dict) -> None:
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+
+        event("message_start", {"type": "message_start", "message": {
+            **message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}}})
+        event("content_block_start", {"type": "content_block_start", "index": 0,
+                                      "content_block": {"type": "text", "text": ""}})
+        for i, word in enumerate(text.split(" ")):
+            event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": "text_delta",
+                                                    "text": word if i == 0 else " " + word}})
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta",
+                                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": usage["output_tokens"]}})
+        event("message_stop", {"type": "message_stop"})
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--min-cache-tokens", type=int, default=1024,
+                        help="shortest cacheable prefix (1024, or 2048 for Haiku models)")
+    args = parser.parse_args()
+    server = StubServer((args.host, args.port), min_cache_tokens=args.min_cache_tokens)
+    print(f"Anthropic stub listening on {server.url}")
+    server.serve_forever()
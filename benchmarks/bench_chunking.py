@@ -0,0 +1,109 @@
+"""Output check and throughput benchmark for the chunking engine.
+
+    python -m benchmarks.bench_chunking [--scale N] [--repeat N] [--workers N] [--join]
+
+Loads every supported file in sample_documents/ and repeats the documents
+`--scale` times; with --join the repeats are concatenated into one long
+document per file, as a large text file would be. Compares
+ingest.chunk_engine against the stock RecursiveCharacterTextSplitter +
+TokenTextSplitter pipeline and exits non-zero if the chunks differ. The gpt2 encoding is fetched by tiktoken on
+first use.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+from langchain_community.document_loaders import TextLoader
+from langchain_core.documents import Document
+
+from ingest import chunk_engine
+from ingest.pdf_parsing import iter_pdf_pages
+from ingest.text_cleaning import normalize_extracted_text
+
+
+SAMPLES = Path(__file__).resolve().parent.parent / "sample_documents"
+
+
+def load_samples() -> list[Document]:
+    docs: list[Document] = []
+    for path in sorted(SAMPLES.iterdir()):
+        suffix = path.suffix.lower()
+        if suffix == ".pdf":
+            docs += iter_pdf_pages(str(path), workers=1)
+        elif suffix in {".txt", ".md"}:
+            for d in TextLoader(str(path), autodetect_encoding=True).load():
+                d.page_content = normalize_extracted_text(d.page_content)
+                docs.append(d)
+    return docs
+
+
+def reference(docs: list[Document]) -> list[Document]:
+    stage1 = chunk_engine.structural_splitter().split_documents(docs)
+    return chunk_engine.token_splitter().split_documents(stage1)
+
+
+def _best(fn, repeat: int) -> tuple[float, list[Document]]:
+    best, out = float("inf"), []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=50,
+                        help="repeat the sample documents this many times")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--join", action="store_true",
+                        help="concatenate the repeats into one document per file")
+    args = parser.parse_args()
+
+    docs = load_samples() * args.scale
+    if args.join:
+        by_source: dict[str, list[str]] = {}
+        for d in docs:
+            by_source.setdefault(d.metadata.get("source", ""), []).append(d.page_content)
+        docs = [
+            Document(page_content="\n\n".join(texts), metadata={"source": source})
+            for source, texts in by_source.items()
+        ]
+    chars = sum(len(d.page_content) for d in docs)
+    print(f"{len(docs)} documents, {chars} characters, {os.cpu_count()} CPUs")
+
+    # Warm up the encoding and, for the parallel run, the worker processes.
+    chunk_engine.split_documents(docs[:1])
+    if args.workers > 1:
+        chunk_engine.split_documents(docs, workers=args.workers, min_parallel_chars=0)
+
+    runs = [
+        ("reference", lambda: reference(docs)),
+        ("engine", lambda: chunk_engine.split_documents(docs)),
+    ]
+    if args.workers > 1:
+        runs.append((f"engine x{args.workers}", lambda: chunk_engine.split_documents(
+            docs, workers=args.workers, min_parallel_chars=0)))
+
+    expected = None
+    failures = 0
+    for name, fn in runs:
+        t, out = _best(fn, args.repeat)
+        got = [(d.page_content, d.metadata) for d in out]
+        if expected is None:
+            expected = got
+        elif got != expected:
+            print(f"MISMATCH {name}")
+            failures += 1
+        print(f"{name:12s} {t * 1e3:9.1f} ms  {chars / t / 1e6:7.2f} Mchar/s  "
+              f"{len(out) / t:9.0f} chunks/s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Cost of the chain's relevance overlap check, before and after signatures.
+
+    python -m benchmarks.bench_overlap [--k 6,10,20,30,50] [--repeat N]
+
+Chunks the sample documents structurally, stores each chunk's lexical
+signature the way ingest.chunking does, and times the overlap check for
+k retrieved chunks: "context" tokenizes the joined context on every question
+(the previous implementation), "signatures" intersects the question with the
+stored signatures. Every one of the k chunks is distinct. The sample policy
+only yields a couple of chunks at the ingest chunk size, so the rest are
+synthetic policy chunks of that size, made of its sentences in a seeded
+random order with the numbers varied. Questions are the chain benchmark's
+set plus off-topic ones, which have to look at every chunk. Exits non-zero
+if the two disagree.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+from benchmarks.rag_chain.fakes import corpus_documents
+from ingest.chunk_engine import STRUCTURAL_CHUNK_SIZE, structural_splitter
+from ingest.pdf_parsing import iter_pdf_pages
+from rag.rag_chain import _has_relevance_overlap, join_docs
+from rag.text_pl import SIGNATURE_KEY, lexical_signature, tokens_pl
+from benchmarks.rag_chain.questions import QUESTIONS
+
+
+SAMPLES = Path(__file__).resolve().parent.parent / "sample_documents"
+
+OFF_TOPIC = [
+    "Jaka jest pogoda na Marsie?",
+    "Kto wygrał mundial w piłce nożnej?",
+    "Jak upiec chleb na zakwasie?",
+]
+
+
+def load_chunks(n: int) -> list[Document]:
+    pages = []
+    for path in sorted(SAMPLES.glob("*.pdf")):
+        pages += iter_pdf_pages(str(path), workers=1)
+    chunks = structural_splitter().split_documents(pages)
+
+    sentences = [
+        s for d in chunks + corpus_documents()
+        for s in re.split(r"(?<=[.!?])\s+|\n+", d.page_content) if len(s) > 20
+    ]
+    rng = random.Random(0)
+    section = 0
+    while len(chunks) < n:
+        section += 1
+        parts = [f"§ {section}."]
+        while sum(map(len, parts)) < STRUCTURAL_CHUNK_SIZE * 0.9:
+            parts.append(re.sub(r"\d+", lambda _: str(rng.randint(1, 5000)), rng.choice(sentences)))
+        chunks.append(Document(page_content=" ".join(parts),
+                               metadata={"source": "synthetic", "chunk_position": section}))
+    return chunks
+
+
+def context_overlap(question: str, context: str) -> bool:
+    q = tokens_pl(question)
+    if not q:
+        return True
+    return len(q & tokens_pl(context)) >= 1
+
+
+def _time_us(fn, calls: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, time.perf_counter() - t0)
+    return best / calls * 1e6
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--k", default="6,10,20,30,50",
+                        help="comma-separated numbers of retrieved chunks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--calls", type=int, default=200,
+                        help="checks per timing run")
+    args = parser.parse_args()
+
+    ks = [int(v) for v in args.k.split(",")]
+    chunks = load_chunks(max(ks))
+    t0 = time.perf_counter()
+    for c in chunks:
+        c.metadata[SIGNATURE_KEY] = lexical_signature(c.page_content)
+    sign_us = (time.perf_counter() - t0) / len(chunks) * 1e6
+    questions = [text for _, text, _ in QUESTIONS] + OFF_TOPIC
+    print(f"{len(chunks)} chunks, {len(questions)} questions, "
+          f"signature at ingest {sign_us:.1f} us/chunk")
+
+    print(f"\n{'k':>4s} {'context us':>11s} {'signatures us':>14s} {'speedup':>8s}")
+    failures = 0
+    for k in ks:
+        docs = chunks[:k]
+        context = join_docs(docs)
+        for q in questions:
+            if context_overlap(q, context) != _has_relevance_overlap(q, docs):
+                print(f"MISMATCH k={k}: {q}")
+                failures += 1
+
+        def before():
+            for q in questions:
+                context_overlap(q, context)
+
+        def after():
+            for q in questions:
+                _has_relevance_overlap(q, docs)
+
+        old = _time_us(before, args.calls, args.repeat) / len(questions)
+        new = _time_us(after, args.calls, args.repeat) / len(questions)
+        print(f"{k:4d} {old:11.1f} {new:14.1f} {old / new:7.1f}x")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
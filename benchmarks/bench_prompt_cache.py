@@ -0,0 +1,161 @@
+"""Prompt-cache usage of the RAG chain against the local messages API stub.
+
+    python -m benchmarks.bench_prompt_cache [--mode invoke|stream|ainvoke|astream]
+        [--k N] [--min-cache-tokens N] [--repeat N]
+
+Runs the chain's real Anthropic client against benchmarks/anthropic_stub.py
+with retrieval over the sample documents and the benchmark corpus. It runs
+once for each prompt-cache setting: off, static system prompts, shared
+context block, and both. For each run it reports the input, cache-write,
+cache-read and output tokens. It also reports the input cost relative to no
+caching, with cache writes billed at 1.25x and reads at 0.1x. Exits
+non-zero if the usage recorded by the client differs from what the stub
+returned, or if the context setting produced no cache reads. The stub
+estimates tokens, so compare runs with each other, not with real bills.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+from ingest.chunk_engine import structural_splitter
+from ingest.pdf_parsing import iter_pdf_pages
+from benchmarks.anthropic_stub import StubServer
+from benchmarks.rag_chain.fakes import FakeVectorStore, HashingEmbeddings, Latency, corpus_documents
+from benchmarks.rag_chain.questions import QUESTIONS
+
+
+SAMPLES = Path(__file__).resolve().parent.parent / "sample_documents"
+
+CONFIGS = [
+    ("off", False, False),
+    ("system", True, False),
+    ("context", False, True),
+    ("system+context", True, True),
+]
+
+
+def _documents():
+    pages = []
+    for path in sorted(SAMPLES.glob("*.pdf")):
+        pages += iter_pdf_pages(str(path), workers=1)
+    for d in pages:
+        d.metadata.update(file=Path(d.metadata["source"]).name, doc_id=Path(d.metadata["source"]).name)
+    return corpus_documents() + structural_splitter().split_documents(pages)
+
+
+def _configure_env(args, cache_system: bool, cache_context: bool, url: str) -> None:
+    for name in ("AZURE_STORAGE_CONNECTION_STRING", "AZURE_STORAGE_CONTAINER", "OPENAI_API_KEY"):
+        os.environ.setdefault(name, "benchmark")
+    os.environ.update({
+        "ANTHROPIC_API_URL": url,
+        "ANTHROPIC_API_KEY": "stub",
+        "RAG_VECTOR_BACKEND": "local",
+        "RAG_LEXICAL_INDEX": "0",
+        "RAG_ANSWER_CACHE": "0",
+        "RAG_SPECULATIVE_ANSWER": "0",
+        "RAG_JUDGE_MODE": "llm",
+        "RAG_RETRIEVAL_K": str(args.k),
+        "RAG_PROMPT_CACHE_SYSTEM": "1" if cache_system else "0",
+        "RAG_PROMPT_CACHE_CONTEXT": "1" if cache_context else "0",
+    })
+
+    from config.settings import get_settings
+    from rag.relevance_gate import get_relevance_gate
+
+    get_settings.cache_clear()
+    get_relevance_gate.cache_clear()
+
+
+def build_chain(docs, *, async_chain: bool):
+    import rag.rag_chain as rag_chain
+    import rag.retriever as retriever
+
+    embeddings = HashingEmbeddings(latency=Latency(0, 0, 0, 0))
+    store = FakeVectorStore(embeddings, docs, Latency(0, 0, 0, 0))
+    retriever.get_vector_store = lambda: store
+    retriever.get_lexical_index = lambda: None
+    if async_chain:
+        return rag_chain.get_async_rag_chain()
+    return rag_chain.get_rag_chain()
+
+
+def run(chain, mode: str, repeat: int) -> None:
+    questions = [{"input": text, "chat_history": history} for _, text, history in QUESTIONS]
+
+    async def _async():
+        for _ in range(repeat):
+            for q in questions:
+                if mode == "ainvoke":
+                    await chain.ainvoke(q)
+                else:
+                    async for _ in chain.astream(q):
+                        pass
+
+    if mode in {"ainvoke", "astream"}:
+        asyncio.run(_async())
+        return
+    for _ in range(repeat):
+        for q in questions:
+            if mode == "invoke":
+                chain.invoke(q)
+            else:
+                for _ in chain.stream(q):
+                    pass
+
+
+def _billed(u: dict) -> float:
+    return (u["input_tokens"] + 1.25 * u["cache_creation_input_tokens"]
+            + 0.1 * u["cache_read_input_tokens"])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["invoke", "stream", "ainvoke", "astream"], default="invoke")
+    parser.add_argument("--k", type=int, default=8, help="retrieved chunks per question")
+    parser.add_argument("--min-cache-tokens", type=int, default=1024,
+                        help="shortest cacheable prefix in the stub (2048 for Haiku models)")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    from rag.prompt_cache import USAGE_KEYS, usage_totals
+
+    docs = _documents()
+    failures = 0
+    baseline = None
+    print(f"{'prompt cache':16s} {'calls':>6s} {'input':>8s} {'write':>8s} {'read':>8s} "
+          f"{'output':>7s} {'input cost':>11s}")
+    for name, cache_system, cache_context in CONFIGS:
+        server = StubServer(("127.0.0.1", 0), min_cache_tokens=args.min_cache_tokens).start()
+        try:
+            _configure_env(args, cache_system, cache_context, server.url)
+            chain = build_chain(docs, async_chain=args.mode in {"ainvoke", "astream"})
+            usage_totals.reset()
+            run(chain, args.mode, args.repeat)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        recorded = usage_totals.snapshot()
+        served = {k: sum(c["usage"][k] for c in server.calls) for k in USAGE_KEYS}
+        served["calls"] = len(server.calls)
+        if recorded != served:
+            print(f"MISMATCH {name}: client recorded {recorded}, stub served {served}")
+            failures += 1
+        if cache_context and not recorded["cache_read_input_tokens"]:
+            print(f"NO CACHE READS {name}: is the context shorter than --min-cache-tokens?")
+            failures += 1
+
+        billed = _billed(recorded)
+        baseline = baseline or billed
+        print(f"{name:16s} {recorded['calls']:6d} {recorded['input_tokens']:8d} "
+              f"{recorded['cache_creation_input_tokens']:8d} {recorded['cache_read_input_tokens']:8d} "
+              f"{recorded['output_tokens']:7d} {billed / baseline:10.1%}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+"""Per-stage latency benchmark for the RAG chain.
+
+    python -m benchmarks.bench_rag_chain [--mode invoke|stream|ainvoke|astream]
+        [--repeat N] [--llm-first-token-ms MS] [--llm-token-ms MS]
+        [--embed-ms MS] [--search-ms MS] [--speculative] [--answer-cache]
+        [--no-context-packing] [--judge-mode MODE]
+        [--json OUT] [--baseline PREVIOUS.json]
+
+Builds get_rag_chain (or get_async_rag_chain for the async modes) on
+in-process fakes from benchmarks/rag_chain/fakes.py: a chat model that
+recognises the chain's prompts, hashing embeddings and a brute-force vector
+store over the travel policy, each sleeping for the configured simulated
+latency. The fixed question set in benchmarks/rag_chain/questions.py is run
+`--repeat` times, and p50/p95 are reported per named chain stage, per
+question and for the whole question. Stages nest (render wraps answer, for
+example), so their times do not add up to the total. In the streaming modes
+a stage starts when the stream is set up, so its time includes waiting for
+its input; the "done at" column (time from the start of the question until
+the stage finished) shows the critical path in every mode.
+
+--json writes the results; --baseline prints p50 deltas against an earlier
+--json file, so changes to the chain can be compared run over run.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict
+
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+
+from benchmarks.rag_chain.fakes import (
+    FakeChatModel,
+    FakeVectorStore,
+    HashingEmbeddings,
+    Latency,
+    corpus_documents,
+)
+from benchmarks.rag_chain.questions import QUESTIONS
+
+
+# Run names given to the chain's steps in rag/rag_chain.py.
+STAGES = [
+    "route",
+    "polish_check",
+    "recap",
+    "contextualize",
+    "embed_question",
+    "answer_cache_lookup",
+    "retrieve",
+    "join_docs",
+    "pack_context",
+    "format_sources",
+    "overlap_check",
+    "judge",
+    "judge_llm",
+    "answer",
+    "render",
+]
+
+
+class StageTimer(BaseCallbackHandler):
+    run_inline = True
+
+    def __init__(self):
+        self.samples: dict[str, list[float]] = defaultdict(list)
+        self.done_at: dict[str, list[float]] = defaultdict(list)
+        self._open: dict = {}
+        self._lock = threading.Lock()
+        self._question_start = time.perf_counter()
+
+    def start_question(self) -> None:
+        self._question_start = time.perf_counter()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs):
+        name = kwargs.get("name")
+        if name in STAGES:
+            with self._lock:
+                self._open[run_id] = (name, time.perf_counter())
+
+    def _close(self, run_id) -> None:
+        with self._lock:
+            started = self._open.pop(run_id, None)
+            if started is not None:
+                name, t0 = started
+                now = time.perf_counter()
+                self.samples[name].append((now - t0) * 1e3)
+                self.done_at[name].append((now - self._question_start) * 1e3)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._close(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._close(run_id)
+
+
+def _configure_env(args) -> None:
+    for name in ("AZURE_STORAGE_CONNECTION_STRING", "AZURE_STORAGE_CONTAINER", "OPENAI_API_KEY"):
+        os.environ.setdefault(name, "benchmark")
+    os.environ["RAG_VECTOR_BACKEND"] = "local"
+    os.environ["RAG_LEXICAL_INDEX"] = "0"
+    os.environ["RAG_SPECULATIVE_ANSWER"] = "1" if args.speculative else "0"
+    os.environ["RAG_ANSWER_CACHE"] = "1" if args.answer_cache else "0"
+    os.environ["RAG_CONTEXT_PACKING"] = "0" if args.no_context_packing else "1"
+    os.environ["RAG_JUDGE_MODE"] = args.judge_mode
+
+    from config.settings import get_settings
+    from rag.relevance_gate import get_relevance_gate
+
+    get_settings.cache_clear()
+    get_relevance_gate.cache_clear()
+
+
+def build_chain(latency: Latency, *, async_chain: bool):
+    import rag.rag_chain as rag_chain
+    import rag.retriever as retriever
+    from rag.answer_cache import SemanticAnswerCache
+
+    embeddings = HashingEmbeddings(latency=latency)
+    store = FakeVectorStore(embeddings, corpus_documents(), latency)
+    retriever.get_vector_store = lambda: store
+    retriever.get_lexical_index = lambda: None
+    rag_chain.get_llm = lambda: FakeChatModel(latency=latency)
+    rag_chain.get_embeddings = lambda: embeddings
+    rag_chain.get_answer_cache = lambda: SemanticAnswerCache(
+        threshold=0.95, ttl_s=3600, max_entries=256,
+        etag_lookup=lambda _: "benchmark", etag_ttl_s=3600)
+
+    if async_chain:
+        return rag_chain.get_async_rag_chain()
+    return rag_chain.get_rag_chain()
+
+
+def _run_sync(chain, question: dict, config: dict, stream: bool) -> tuple[float, float | None]:
+    t0 = time.perf_counter()
+    if not stream:
+        chain.invoke(question, config=config)
+        return (time.perf_counter() - t0) * 1e3, None
+    first = None
+    for _ in chain.stream(question, config=config):
+        if first is None:
+            first = (time.perf_counter() - t0) * 1e3
+    return (time.perf_counter() - t0) * 1e3, first
+
+
+async def _run_async(chain, question: dict, config: dict, stream: bool) -> tuple[float, float | None]:
+    t0 = time.perf_counter()
+    if not stream:
+        await chain.ainvoke(question, config=config)
+        return (time.perf_counter() - t0) * 1e3, None
+    first = None
+    async for _ in chain.astream(question, config=config):
+        if first is None:
+            first = (time.perf_counter() - t0) * 1e3
+    return (time.perf_counter() - t0) * 1e3, first
+
+
+def run(chain, mode: str, repeat: int, timer: StageTimer) -> dict:
+    stream = mode in {"stream", "astream"}
+    totals: dict[str, list[float]] = defaultdict(list)
+    first_tokens: list[float] = []
+    config = {"callbacks": [timer]}
+
+    async def _all_async():
+        for _ in range(repeat):
+            for name, text, history in QUESTIONS:
+                q = {"input": text, "chat_history": history}
+                timer.start_question()
+                total, first = await _run_async(chain, q, config, stream)
+                totals[name].append(total)
+                if first is not None:
+                    first_tokens.append(first)
+
+    t0 = time.perf_counter()
+    if mode in {"ainvoke", "astream"}:
+        asyncio.run(_all_async())
+    else:
+        for _ in range(repeat):
+            for name, text, history in QUESTIONS:
+                q = {"input": text, "chat_history": history}
+                timer.start_question()
+                total, first = _run_sync(chain, q, config, stream)
+                totals[name].append(total)
+                if first is not None:
+                    first_tokens.append(first)
+    wall = time.perf_counter() - t0
+    return {"totals": totals, "first_tokens": first_tokens, "wall_s": wall}
+
+
+def _pct(samples: list[float]) -> dict:
+    a = np.asarray(samples, dtype=np.float64)
+    return {
+        "count": int(a.size),
+        "p50_ms": round(float(np.percentile(a, 50)), 3),
+        "p95_ms": round(float(np.percentile(a, 95)), 3),
+    }
+
+
+def summarize(result: dict, timer: StageTimer, repeat: int) -> dict:
+    all_totals = [t for ts in result["totals"].values() for t in ts]
+    summary = {
+        "stages": {
+            name: _pct(timer.samples[name]) for name in STAGES if timer.samples.get(name)
+        },
+        "questions": {name: _pct(ts) for name, ts in result["totals"].items()},
+        "total": _pct(all_totals),
+        "wall_s": round(result["wall_s"], 3),
+    }
+    for name, stats in summary["stages"].items():
+        stats["calls_per_run"] = round(stats.pop("count") / repeat, 2)
+        stats["done_at_p50_ms"] = _pct(timer.done_at[name])["p50_ms"]
+    if result["first_tokens"]:
+        summary["first_token"] = _pct(result["first_tokens"])
+    return summary
+
+
+def _delta(name: str, section: str, p50: float, baseline: dict | None) -> str:
+    if not baseline:
+        return ""
+    prev = baseline.get(section, {}).get(name) if section else baseline.get(name)
+    if not prev:
+        return "       new"
+    return f" {p50 - prev['p50_ms']:+9.1f}"
+
+
+def report(summary: dict, baseline: dict | None) -> None:
+    head = "  Δp50 ms" if baseline else ""
+    print(f"\n{'stage':22s} {'calls/run':>9s} {'p50 ms':>9s} {'p95 ms':>9s} {'done at':>9s}{head}")
+    for name, st in summary["stages"].items():
+        print(f"{name:22s} {st['calls_per_run']:9.2f} {st['p50_ms']:9.1f} {st['p95_ms']:9.1f}"
+              f" {st['done_at_p50_ms']:9.1f}{_delta(name, 'stages', st['p50_ms'], baseline)}")
+
+    print(f"\n{'question':22s} {'runs':>9s} {'p50 ms':>9s} {'p95 ms':>9s}{head}")
+    for name, st in summary["questions"].items():
+        print(f"{name:22s} {st['count']:9d} {st['p50_ms']:9.1f} {st['p95_ms']:9.1f}"
+              f"{_delta(name, 'questions', st['p50_ms'], baseline)}")
+
+    print()
+    for key in ("total", "first_token"):
+        if key in summary:
+            st = summary[key]
+            print(f"{key:22s} {st['count']:9d} {st['p50_ms']:9.1f} {st['p95_ms']:9.1f}"
+                  f"{_delta(key, '', st['p50_ms'], baseline)}")
+    print(f"wall time {summary['wall_s']:.2f} s")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["invoke", "stream", "ainvoke", "astream"], default="invoke")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--llm-first-token-ms", type=float, default=Latency.llm_first_token_ms)
+    parser.add_argument("--llm-token-ms", type=float, default=Latency.llm_token_ms)
+    parser.add_argument("--embed-ms", type=float, default=Latency.embed_ms)
+    parser.add_argument("--search-ms", type=float, default=Latency.search_ms)
+    parser.add_argument("--speculative", action="store_true",
+                        help="run the judge and the answer concurrently")
+    parser.add_argument("--answer-cache", action="store_true",
+                        help="enable the semantic answer cache (repeats become hits)")
+    parser.add_argument("--no-context-packing", action="store_true",
+                        help="join the retrieved chunks verbatim instead of packing them")
+    parser.add_argument("--judge-mode", default="llm",
+                        choices=["llm", "local", "local-then-llm-if-uncertain"])
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare p50s against an earlier --json file")
+    args = parser.parse_args()
+
+    latency = Latency(
+        llm_first_token_ms=args.llm_first_token_ms,
+        llm_token_ms=args.llm_token_ms,
+        embed_ms=args.embed_ms,
+        search_ms=args.search_ms,
+    )
+    _configure_env(args)
+    chain = build_chain(latency, async_chain=args.mode in {"ainvoke", "astream"})
+
+    # One untimed pass pays for imports and first-call setup. It would also
+    # fill the answer cache, so the timed run gets a fresh chain and cache.
+    run(chain, args.mode, 1, StageTimer())
+    if args.answer_cache:
+        chain = build_chain(latency, async_chain=args.mode in {"ainvoke", "astream"})
+    timer = StageTimer()
+    summary = summarize(run(chain, args.mode, args.repeat, timer), timer, args.repeat)
+    summary["config"] = {
+        "mode": args.mode,
+        "repeat": args.repeat,
+        "speculative": args.speculative,
+        "answer_cache": args.answer_cache,
+        "context_packing": not args.no_context_packing,
+        "judge_mode": args.judge_mode,
+        "latency": asdict(latency),
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    report(summary, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
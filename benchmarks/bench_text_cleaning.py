@@ -0,0 +1,111 @@
+"""Golden-output check and throughput benchmark for normalize_extracted_text.
+
+    python -m benchmarks.bench_text_cleaning [--fuzz N] [--repeat N]
+
+Exits non-zero if any corpus file or fuzz case differs from the expected
+output. `reference.py` is the pre-rewrite implementation and is only used
+here, for fuzzing and for timing comparisons.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+from benchmarks.text_cleaning.reference import normalize_extracted_text as reference
+from ingest.text_cleaning import normalize_extracted_text
+
+
+CORPUS = Path(__file__).parent / "text_cleaning" / "corpus"
+
+_FUZZ_PIECES = [
+    "a", "ż", "B", "k", "o", "t", "nie", "ów", "abcd", "Słowo", "zdanie.", "pytanie?",
+    "Nagłówek:", "- punkt", "• punkt", "1. krok", "2) krok", "10-", "przeno-", " ",
+    "\t", "\u00a0", "  ", "\x0c", "x" * 85, "A, b, c", "\r\n", "\r", "\n", "\n", "\n", " \n",
+]
+
+
+def _read(path: Path) -> str:
+    with open(path, encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+def check_golden() -> int:
+    failures = 0
+    for src in sorted(CORPUS.glob("*.txt")):
+        if src.name.endswith(".golden.txt"):
+            continue
+        expected = _read(src.with_name(src.name[:-4] + ".golden.txt"))
+        if normalize_extracted_text(_read(src)) != expected:
+            print(f"MISMATCH {src.name}")
+            failures += 1
+    return failures
+
+
+def fuzz(cases: int, seed: int = 0) -> int:
+    rng = random.Random(seed)
+    failures = 0
+    for n in range(cases):
+        text = "".join(rng.choice(_FUZZ_PIECES) for _ in range(rng.randint(0, 120)))
+        if normalize_extracted_text(text) != reference(text):
+            print(f"FUZZ MISMATCH case {n}: {text!r}")
+            failures += 1
+            if failures >= 5:
+                break
+    return failures
+
+
+def worst_cases() -> dict[str, str]:
+    return {
+        "blank-line runs": "Akapit bez kropki\n" + " \n" * 20000 + "dalszy tekst\n",
+        "spaced single letters": "\n \n".join("abcdefghij" * 2000),
+        "letters after blanks": "wyraz\n" + "\n" * 20000 + "\n".join("ab" * 5000),
+        "one long paragraph": "\n".join(["słowo słowo słowo"] * 20000),
+    }
+
+
+def _time(fn, text: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def benchmark(repeat: int) -> None:
+    pages = [
+        _read(p) for p in sorted(CORPUS.glob("*.txt")) if not p.name.endswith(".golden.txt")
+    ]
+    for name, fn in (("current", normalize_extracted_text), ("reference", reference)):
+        t = min(
+            sum(_time(fn, page, 1) for page in pages) for _ in range(repeat)
+        )
+        print(f"corpus   {name:9s} {len(pages) / t:10.0f} pages/s")
+
+    for case, text in worst_cases().items():
+        cur = _time(normalize_extracted_text, text, repeat)
+        ref = _time(reference, text, 1)
+        print(f"worst    {case:22s} current {cur * 1e3:8.1f} ms   reference {ref * 1e3:9.1f} ms")
+        if normalize_extracted_text(text) != reference(text):
+            print(f"MISMATCH worst case {case}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--no-bench", action="store_true")
+    args = parser.parse_args()
+
+    failures = check_golden() + fuzz(args.fuzz)
+    print(f"golden + fuzz: {'OK' if not failures else f'{failures} failures'}")
+    if not args.no_bench:
+        benchmark(args.repeat)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
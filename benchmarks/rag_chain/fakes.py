@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import re
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Iterable
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.vectorstores import VectorStore
+
+from rag.text_pl import token_list_pl
+
+
+@dataclass(frozen=True)
+class Latency:
+    # Simulated service times, in milliseconds.
+    llm_first_token_ms: float = 300.0
+    llm_token_ms: float = 15.0
+    embed_ms: float = 40.0
+    search_ms: float = 60.0
+
+
+def _sleep(ms: float) -> None:
+    if ms > 0:
+        time.sleep(ms / 1000.0)
+
+
+async def _asleep(ms: float) -> None:
+    if ms > 0:
+        await asyncio.sleep(ms / 1000.0)
+
+
+# Chunks of the sample travel policy, cleaned up by hand.
+CORPUS = [
+    ("procedura.pdf", "Celem procedury jest określenie zasad planowania, zatwierdzania, realizacji "
+     "oraz rozliczania podróży służbowych pracowników firmy."),
+    ("procedura.pdf", "Podróż służbowa to wyjazd pracownika poza miejscowość stałego wykonywania pracy "
+     "w celu realizacji zadań służbowych na polecenie przełożonego."),
+    ("procedura.pdf", "Podróż służbową należy zgłosić nie później niż 5 dni roboczych przed planowanym "
+     "wyjazdem. Zgłoszenie musi zawierać cel podróży, miejsce docelowe, datę i godzinę wyjazdu, "
+     "przewidywaną datę powrotu, szacowany budżet i proponowany środek transportu."),
+    ("procedura.pdf", "Podróż wymaga akceptacji bezpośredniego przełożonego, kierownika działu oraz "
+     "działu finansowego w przypadku kosztu powyżej 3000 PLN. Brak akceptacji oznacza brak "
+     "możliwości rozliczenia kosztów."),
+    ("procedura.pdf", "Rezerwacje powinny być dokonywane przez firmowy system rezerwacyjny. Pociąg na "
+     "trasach krajowych do 500 km, samolot na trasach zagranicznych lub powyżej 500 km, samochód "
+     "służbowy gdy wymagany jest transport lokalny."),
+    ("procedura.pdf", "Noclegi powinny być rezerwowane w hotelach o standardzie maksymalnie 3 gwiazdek, "
+     "chyba że brak dostępności, wymogi klienta lub różnica cenowa jest niższa niż 15%."),
+    ("procedura.pdf", "Pracownikowi przysługuje dieta dzienna: podróż krajowa 45 PLN za dzień, podróż "
+     "zagraniczna według tabeli krajów. Dieta nie przysługuje, jeśli zapewniono pełne wyżywienie."),
+    ("procedura.pdf", "Zwrotowi podlegają bilety transportowe, noclegi, taksówki związane z zadaniem, "
+     "opłaty konferencyjne, parking i autostrady. Nie podlegają zwrotowi minibar, usługi hotelowe "
+     "dodatkowe oraz koszty prywatne."),
+    ("procedura.pdf", "Każdy koszt musi być udokumentowany fakturą lub paragonem zawierającym datę oraz "
+     "kwotę. Zdjęcia paragonów są dopuszczalne."),
+    ("procedura.pdf", "Rozliczenie podróży należy złożyć w ciągu 7 dni roboczych od powrotu. Po tym "
+     "terminie dział finansowy może odmówić zwrotu kosztów."),
+    ("procedura.pdf", "Można wnioskować o zaliczkę przed wyjazdem. Maksymalna zaliczka wynosi 80% "
+     "planowanego budżetu. Niewykorzystana część musi zostać zwrócona w ciągu 3 dni od rozliczenia."),
+    ("procedura.pdf", "W przypadku podróży zagranicznej wymagane jest dodatkowo ubezpieczenie podróżne, "
+     "karta EKUZ lub odpowiednik oraz zgoda dyrektora działu."),
+    ("procedura.pdf", "Wyjątki od procedury wymagają pisemnej zgody dyrektora operacyjnego, dołączonej "
+     "do rozliczenia."),
+]
+
+
+def corpus_documents() -> list[Document]:
+    return [
+        Document(page_content=text, metadata={"file": name, "doc_id": name, "chunk_id": i})
+        for i, (name, text) in enumerate(CORPUS)
+    ]
+
+
+class HashingEmbeddings(Embeddings):
+    # Bag of hashed Polish content words: deterministic, and close enough to
+    # a real embedding that related questions retrieve related chunks.
+    def __init__(self, size: int = 256, latency: Latency = Latency()):
+        self.size = size
+        self.latency = latency
+
+    def _vector(self, text: str) -> list[float]:
+        v = np.zeros(self.size, dtype=np.float32)
+        for token in token_list_pl(text):
+            v[zlib.crc32(token[:6].encode("utf-8")) % self.size] += 1.0
+        n = float(np.linalg.norm(v))
+        return (v / n if n else v).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        _sleep(self.latency.embed_ms)
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        _sleep(self.latency.embed_ms)
+        return self._vector(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await _asleep(self.latency.embed_ms)
+        return [self._vector(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        await _asleep(self.latency.embed_ms)
+        return self._vector(text)
+
+
+def _with_scores(hits: list[tuple[Document, float]]) -> list[Document]:
+    # Like the local store, scores ride along in the metadata.
+    return [
+        Document(page_content=d.page_content, metadata={**d.metadata, "retrieval_score": score})
+        for d, score in hits
+    ]
+
+
+class FakeVectorStore(VectorStore):
+    def __init__(self, embedding: HashingEmbeddings, docs: list[Document], latency: Latency = Latency()):
+        self._embedding = embedding
+        self.latency = latency
+        self.docs = list(docs)
+        self.matrix = np.asarray(
+            [embedding._vector(d.page_content) for d in self.docs], dtype=np.float32)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        metadatas = metadatas or [{} for _ in texts]
+        return cls(embedding, [Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas)])
+
+    def add_texts(self, texts: Iterable[str], metadatas=None, **kwargs) -> list[str]:
+        raise NotImplementedError
+
+    def _search(self, vector: list[float], k: int) -> list[tuple[Document, float]]:
+        scores = self.matrix @ np.asarray(vector, dtype=np.float32)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(self.docs[i], float(scores[i])) for i in top]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any):
+        vector = self._embedding.embed_query(query)
+        _sleep(self.latency.search_ms)
+        return self._search(vector, k)
+
+    async def asimilarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any):
+        vector = await self._embedding.aembed_query(query)
+        await _asleep(self.latency.search_ms)
+        return self._search(vector, k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return _with_scores(self.similarity_search_with_score(query, k))
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return _with_scores(await self.asimilarity_search_with_score(query, k))
+
+    def _similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs: Any):
+        return self.similarity_search_with_score(query, k)
+
+    async def _asimilarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs: Any):
+        return await self.asimilarity_search_with_score(query, k)
+
+
+_WORDS = re.compile(r"\s*\S+")
+
+
+class FakeChatModel(BaseChatModel):
+    # Answers by recognising which chain prompt it was given. Replies are
+    # streamed word by word after a first-token delay.
+    latency: Latency = Latency()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self, messages) -> str:
+        system = " ".join(str(m.content) for m in messages if m.type == "system")
+        last = str(messages[-1].content)
+        if "YES albo NO" in system:
+            return "NO" if "Mars" in last or "pogod" in last else "YES"
+        if "samodzielne pytanie" in system:
+            return f"{last.strip().rstrip('?')} w podróży służbowej?"
+        if "Poprzednie pytanie" in last:
+            question = last.split("\n", 1)[-1].strip()
+            return f"Pytałeś o to: {question}"
+        return ("Zgodnie z kontekstem, zgodnie z procedurą podróży służbowych obowiązują zasady "
+                "opisane w dokumencie. Szczegóły zależą od rodzaju podróży i akceptacji przełożonego.")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = self._reply(messages)
+        _sleep(self.latency.llm_first_token_ms
+               + self.latency.llm_token_ms * (len(_WORDS.findall(text)) - 1))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = self._reply(messages)
+        await _asleep(self.latency.llm_first_token_ms
+                      + self.latency.llm_token_ms * (len(_WORDS.findall(text)) - 1))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        _sleep(self.latency.llm_first_token_ms)
+        for i, word in enumerate(_WORDS.findall(self._reply(messages))):
+            if i:
+                _sleep(self.latency.llm_token_ms)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word))
+            if run_manager:
+                run_manager.on_llm_new_token(word, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await _asleep(self.latency.llm_first_token_ms)
+        for i, word in enumerate(_WORDS.findall(self._reply(messages))):
+            if i:
+                await _asleep(self.latency.llm_token_ms)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word))
+            if run_manager:
+                await run_manager.on_llm_new_token(word, chunk=chunk)
+            yield chunk
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+
+def _history(*turns: tuple[str, str]) -> list:
+    out: list = []
+    for question, answer in turns:
+        out += [HumanMessage(content=question), AIMessage(content=answer)]
+    return out
+
+
+_DIET = ("Ile wynosi dieta w podróży krajowej?", "Dieta krajowa wynosi 45 PLN za dzień.")
+_ACCEPT = ("Kto akceptuje podróż służbową?",
+           "Bezpośredni przełożony i kierownik działu, a powyżej 3000 PLN także dział finansowy.")
+
+# (name, input, chat history). Covers single questions, follow-ups that need
+# contextualizing, standalone questions mid-conversation, RECAP, the
+# non-Polish refusal and an off-topic question.
+QUESTIONS = [
+    ("single/diet", "Ile wynosi dieta w podróży krajowej?", []),
+    ("single/deadline", "Jaki jest termin rozliczenia podróży służbowej?", []),
+    ("single/minibar", "Czy minibar podlega zwrotowi kosztów?", []),
+    ("single/advance", "Jaka jest maksymalna zaliczka na wyjazd służbowy?", []),
+    ("followup/abroad", "A za granicą?", _history(_DIET)),
+    ("followup/pronoun", "Czy to dotyczy też kosztów powyżej 3000 PLN?", _history(_ACCEPT)),
+    ("multiturn/standalone", "Jakie dokumenty są wymagane przy podróży zagranicznej?",
+     _history(_DIET, _ACCEPT)),
+    ("recap/previous", "O co pytałem wcześniej?", _history(_DIET)),
+    ("recap/empty", "Przypomnij mi moje ostatnie pytanie.", []),
+    ("non_polish", "What is the daily allowance for domestic business trips?", []),
+    ("off_topic", "Jaka jest pogoda na Marsie?", []),
+]
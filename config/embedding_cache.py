@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from hashlib import sha256
+
+from langchain_core.embeddings import Embeddings
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query_text(text: str) -> str:
+    t = unicodedata.normalize("NFC", text or "")
+    return _WHITESPACE.sub(" ", t).strip()
+
+
+def encode_vector(vector: list[float]) -> bytes:
+    return array("d", vector).tobytes()
+
+
+def decode_vector(raw: bytes) -> list[float]:
+    out = array("d")
+    out.frombytes(raw)
+    return out.tolist()
+
+
+class _SqliteTier:
+    def __init__(self, path: str):
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> list[float] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        return decode_vector(row[0]) if row else None
+
+    def put(self, key: str, model: str, vector: list[float]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, model, vector) VALUES (?, ?, ?)",
+                (key, model, encode_vector(vector)),
+            )
+            self._conn.commit()
+
+
+class EmbeddingCache:
+    def __init__(self, *, max_entries: int = 1024, path: str | None = None):
+        self.max_entries = max(0, int(max_entries))
+        self._entries: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = _SqliteTier(path) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        raw = f"{model}\x00{normalize_query_text(text)}"
+        return sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> list[float] | None:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+
+        vector = self._disk.get(key) if self._disk else None
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, vector)
+        return vector
+
+    def put(self, key: str, model: str, vector: list[float]) -> None:
+        with self._lock:
+            self._remember(key, vector)
+        if self._disk:
+            self._disk.put(key, model, vector)
+
+    def _remember(self, key: str, vector: list[float]) -> None:
+        if self.max_entries == 0:
+            return
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, inner: Embeddings, *, model: str, cache: EmbeddingCache):
+        self.inner = inner
+        self.model = model
+        self.cache = cache
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.cache.key(self.model, text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.inner.embed_query(text)
+            self.cache.put(key, self.model, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self.cache.key(self.model, text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = await self.inner.aembed_query(text)
+            self.cache.put(key, self.model, vector)
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.inner.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.inner.aembed_documents(texts)
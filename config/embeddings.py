@@ -2,10 +2,36 @@ from functools import lru_cache
 
 from langchain_openai import OpenAIEmbeddings
 
+from config.embedding_cache import CachedEmbeddings, EmbeddingCache
 from config.settings import get_settings
 
 
 @lru_cache(maxsize=1)
-def get_embeddings() -> OpenAIEmbeddings:
+def get_embedding_cache() -> EmbeddingCache:
     s = get_settings()
-    return OpenAIEmbeddings(model=s.embedding_model, api_key=s.openai_api_key)
+    return EmbeddingCache(
+        max_entries=s.embedding_cache_size,
+        path=s.embedding_cache_path,
+    )
+
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> CachedEmbeddings:
+    s = get_settings()
+    return CachedEmbeddings(
+        OpenAIEmbeddings(model=s.embedding_model, api_key=s.openai_api_key),
+        model=s.embedding_model,
+        cache=get_embedding_cache(),
+    )
+
+
+def get_document_embeddings() -> OpenAIEmbeddings:
+    # Bulk ingestion handles batching and rate-limit retries itself, so the
+    # client sends each batch as one request and never retries on its own.
+    s = get_settings()
+    return OpenAIEmbeddings(
+        model=s.embedding_model,
+        api_key=s.openai_api_key,
+        chunk_size=2048,
+        max_retries=0,
+    )
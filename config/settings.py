@@ -42,11 +42,27 @@ def _get_env_float(name: str, *, default: float | None = None) -> float | None:
         raise RuntimeError(f"{name} must be a number, got: {raw!r}") from e
 
 
+def _get_env_bool(name: str, *, default: bool) -> bool:
+    raw = os.environ.get(name)
+    if raw is None or raw.strip() == "":
+        return default
+    v = raw.strip().lower()
+    if v in {"1", "true", "yes", "on"}:
+        return True
+    if v in {"0", "false", "no", "off"}:
+        return False
+    raise RuntimeError(f"{name} must be a boolean, got: {raw!r}")
+
+
 @dataclass(frozen=True)
 class Settings:
+    vector_backend: str
     azure_search_endpoint: str
     azure_search_key: str
     azure_search_index: str
+    local_index_path: str
+    local_ann_min_rows: int
+    local_ann_nprobe: int
 
     azure_storage_connection_string: str
     azure_storage_container: str
@@ -56,17 +72,92 @@ class Settings:
     embedding_model: str
     llm_model: str
 
+    embedding_cache_size: int
+    embedding_cache_path: str | None
+    chunk_embedding_store_path: str | None
+
     retrieval_k: int
     retrieval_search_type: str
     retrieval_score_threshold: float | None
 
+    context_packing: bool
+    context_token_budget: int
+    context_dedup_jaccard: float
+    context_sentence_filter: bool
+
+    prompt_cache_system: bool
+    prompt_cache_context: bool
+    anthropic_beta: str | None
+
+    judge_mode: str
+    judge_model_path: str | None
+    judge_log_path: str | None
+
+    speculative_answer: bool
+    local_standalone_detector: bool
+
+    answer_cache_enabled: bool
+    answer_cache_threshold: float
+    answer_cache_ttl_s: int
+    answer_cache_max_entries: int
+    answer_cache_etag_ttl_s: int
+
+    lexical_index_enabled: bool
+    lexical_index_path: str
+    lexical_fetch_k: int
+    rrf_k: int
+
+    ingest_download_workers: int
+    ingest_max_inflight_mb: int
+    ingest_chunk_workers: int
+    ingest_embed_workers: int
+    ingest_index_workers: int
+    ingest_queue_size: int
+    ingest_report_every_s: int
+    ingest_state_batch: int
+
+    pdf_workers: int
+    pdf_pages_per_task: int
+    pdf_parallel_min_pages: int
+    pdf_max_memory_mb: int
+
+    chunk_workers: int
+    chunk_parallel_min_chars: int
+
+    embed_batch_tokens: int
+    embed_concurrency: int
+    embed_max_retries: int
+    index_upload_batch: int
+    index_upload_concurrency: int
+
 
 @lru_cache(maxsize=1)
 def get_settings() -> Settings:
+    vector_backend = os.environ.get(
+        "RAG_VECTOR_BACKEND", "azure").strip().lower() or "azure"
+    if vector_backend not in {"azure", "local"}:
+        raise RuntimeError(
+            f"RAG_VECTOR_BACKEND must be 'azure' or 'local', got: {vector_backend!r}"
+        )
+    azure_search = vector_backend == "azure"
+    judge_mode = os.environ.get("RAG_JUDGE_MODE", "llm").strip().lower() or "llm"
+    if judge_mode not in {"llm", "local", "local-then-llm-if-uncertain"}:
+        raise RuntimeError(
+            "RAG_JUDGE_MODE must be 'llm', 'local' or 'local-then-llm-if-uncertain', "
+            f"got: {judge_mode!r}"
+        )
     return Settings(
-        azure_search_endpoint=_get_env("AZURE_SEARCH_ENDPOINT"),
-        azure_search_key=_get_env("AZURE_SEARCH_KEY"),
-        azure_search_index=_get_env("AZURE_SEARCH_INDEX"),
+        vector_backend=vector_backend,
+        azure_search_endpoint=_get_env(
+            "AZURE_SEARCH_ENDPOINT", required=azure_search),
+        azure_search_key=_get_env("AZURE_SEARCH_KEY", required=azure_search),
+        azure_search_index=_get_env(
+            "AZURE_SEARCH_INDEX", required=azure_search),
+        local_index_path=os.environ.get(
+            "RAG_LOCAL_INDEX_PATH", ".rag_index") or ".rag_index",
+        local_ann_min_rows=_get_env_int(
+            "RAG_LOCAL_ANN_MIN_ROWS", default=50000),
+        local_ann_nprobe=_get_env_int("RAG_LOCAL_ANN_NPROBE", default=8),
         azure_storage_connection_string=_get_env(
             "AZURE_STORAGE_CONNECTION_STRING"),
         azure_storage_container=_get_env("AZURE_STORAGE_CONTAINER"),
@@ -75,8 +166,75 @@ def get_settings() -> Settings:
         embedding_model=os.environ.get(
             "OPENAI_EMBEDDING_MODEL", "text-embedding-3-small"),
         llm_model=os.environ.get("ANTHROPIC_MODEL", "claude-3-haiku-20240307"),
+        embedding_cache_size=_get_env_int(
+            "RAG_EMBEDDING_CACHE_SIZE", default=1024),
+        embedding_cache_path=os.environ.get(
+            "RAG_EMBEDDING_CACHE_PATH") or None,
+        chunk_embedding_store_path=os.environ.get(
+            "RAG_CHUNK_EMBEDDING_STORE", ".rag_cache/chunk_embeddings.sqlite") or None,
         retrieval_k=_get_env_int("RAG_RETRIEVAL_K", default=6),
         retrieval_search_type=os.environ.get("RAG_SEARCH_TYPE", "hybrid"),
         retrieval_score_threshold=_get_env_float(
             "RAG_SCORE_THRESHOLD", default=None),
+        context_packing=_get_env_bool("RAG_CONTEXT_PACKING", default=True),
+        context_token_budget=_get_env_int(
+            "RAG_CONTEXT_TOKEN_BUDGET", default=0),
+        context_dedup_jaccard=_get_env_float(
+            "RAG_CONTEXT_DEDUP_JACCARD", default=1.0),
+        context_sentence_filter=_get_env_bool(
+            "RAG_CONTEXT_SENTENCE_FILTER", default=False),
+        prompt_cache_system=_get_env_bool(
+            "RAG_PROMPT_CACHE_SYSTEM", default=False),
+        prompt_cache_context=_get_env_bool(
+            "RAG_PROMPT_CACHE_CONTEXT", default=False),
+        anthropic_beta=os.environ.get("RAG_ANTHROPIC_BETA") or None,
+        judge_mode=judge_mode,
+        judge_model_path=os.environ.get(
+            "RAG_JUDGE_MODEL_PATH", ".rag_cache/relevance_gate.json") or None,
+        judge_log_path=os.environ.get("RAG_JUDGE_LOG_PATH") or None,
+        speculative_answer=_get_env_bool(
+            "RAG_SPECULATIVE_ANSWER", default=False),
+        local_standalone_detector=_get_env_bool(
+            "RAG_LOCAL_STANDALONE_DETECTOR", default=True),
+        answer_cache_enabled=_get_env_bool("RAG_ANSWER_CACHE", default=False),
+        answer_cache_threshold=_get_env_float(
+            "RAG_ANSWER_CACHE_THRESHOLD", default=0.95),
+        answer_cache_ttl_s=_get_env_int("RAG_ANSWER_CACHE_TTL", default=3600),
+        answer_cache_max_entries=_get_env_int(
+            "RAG_ANSWER_CACHE_MAX_ENTRIES", default=512),
+        answer_cache_etag_ttl_s=_get_env_int(
+            "RAG_ANSWER_CACHE_ETAG_TTL", default=30),
+        lexical_index_enabled=_get_env_bool("RAG_LEXICAL_INDEX", default=False),
+        lexical_index_path=os.environ.get(
+            "RAG_LEXICAL_INDEX_PATH", ".rag_index/lexical") or ".rag_index/lexical",
+        lexical_fetch_k=_get_env_int("RAG_LEXICAL_FETCH_K", default=20),
+        rrf_k=_get_env_int("RAG_RRF_K", default=60),
+        ingest_download_workers=_get_env_int(
+            "RAG_INGEST_DOWNLOAD_WORKERS", default=8),
+        ingest_max_inflight_mb=_get_env_int(
+            "RAG_INGEST_MAX_INFLIGHT_MB", default=256),
+        ingest_chunk_workers=_get_env_int("RAG_INGEST_CHUNK_WORKERS", default=2),
+        ingest_embed_workers=_get_env_int("RAG_INGEST_EMBED_WORKERS", default=4),
+        ingest_index_workers=_get_env_int("RAG_INGEST_INDEX_WORKERS", default=2),
+        ingest_queue_size=_get_env_int("RAG_INGEST_QUEUE_SIZE", default=8),
+        ingest_report_every_s=_get_env_int(
+            "RAG_INGEST_REPORT_EVERY_S", default=10),
+        ingest_state_batch=_get_env_int("RAG_INGEST_STATE_BATCH", default=1000),
+        pdf_workers=_get_env_int(
+            "RAG_PDF_WORKERS", default=min(4, os.cpu_count() or 1)),
+        pdf_pages_per_task=_get_env_int("RAG_PDF_PAGES_PER_TASK", default=16),
+        pdf_parallel_min_pages=_get_env_int(
+            "RAG_PDF_PARALLEL_MIN_PAGES", default=32),
+        pdf_max_memory_mb=_get_env_int("RAG_PDF_MAX_MEMORY_MB", default=1024),
+        chunk_workers=_get_env_int(
+            "RAG_CHUNK_WORKERS", default=min(4, os.cpu_count() or 1)),
+        chunk_parallel_min_chars=_get_env_int(
+            "RAG_CHUNK_PARALLEL_MIN_CHARS", default=200000),
+        embed_batch_tokens=_get_env_int(
+            "RAG_EMBED_BATCH_TOKENS", default=100000),
+        embed_concurrency=_get_env_int("RAG_EMBED_CONCURRENCY", default=4),
+        embed_max_retries=_get_env_int("RAG_EMBED_MAX_RETRIES", default=8),
+        index_upload_batch=_get_env_int("RAG_INDEX_UPLOAD_BATCH", default=500),
+        index_upload_concurrency=_get_env_int(
+            "RAG_INDEX_UPLOAD_CONCURRENCY", default=2),
     )
@@ -3,14 +3,17 @@ import logging
 import json
 import os
 import tempfile
+import threading
 import time
 import traceback
+from collections import OrderedDict
 from pathlib import PurePath
 import azure.functions as func
 
-from ingest.text_cleaning import normalize_extracted_text
+from rag import telemetry
 
 logging.basicConfig(level=logging.INFO)
+telemetry.install_log_formatter()
 logger = logging.getLogger(__name__)
 
 app = func.FunctionApp()
@@ -23,6 +26,16 @@ def healthz(req: func.HttpRequest) -> func.HttpResponse:
     return func.HttpResponse("ok", status_code=200)
 
 
+@app.function_name(name="metrics")
+@app.route(route="metrics", auth_level=func.AuthLevel.FUNCTION)
+def metrics(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(
+        telemetry.prometheus_text(),
+        status_code=200,
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
 # ------------------------
 # STORAGE
 # ------------------------
@@ -66,73 +79,57 @@ def _supported(blob_name: str) -> bool:
     return ok
 
 
-def _download(container_client, blob_name: str, local_path: str) -> str:
+def _current_etag(container_client, blob_name: str) -> str | None:
+    from azure.core.exceptions import ResourceNotFoundError
+
+    blob = container_client.get_blob_client(blob=blob_name)
+    try:
+        return str(blob.get_blob_properties().etag or "")
+    except ResourceNotFoundError:
+        return None
+
+
+def _download(container_client, blob_name: str, local_path: str, etag: str) -> None:
+    from azure.core import MatchConditions
+
     logger.info("Downloading blob", extra={"blob": blob_name})
 
     os.makedirs(os.path.dirname(local_path), exist_ok=True)
     blob = container_client.get_blob_client(blob=blob_name)
 
-    with open(local_path, "wb") as f:
-        stream = blob.download_blob()
-        stream.readinto(f)
+    # Pinned to the ETag that was compared against state, so a concurrent
+    # overwrite fails here instead of being indexed under the old ETag.
+    with telemetry.span("download") as sp, open(local_path, "wb") as f:
+        stream = blob.download_blob(
+            etag=etag, match_condition=MatchConditions.IfNotModified)
+        sp.set(bytes=stream.readinto(f))
 
-    etag = str(blob.get_blob_properties().etag or "")
     logger.info("Download complete", extra={"blob": blob_name, "etag": etag})
-    return etag
 
 
 def _load_docs(local_path: str, blob_name: str):
-    suffix = PurePath(blob_name).suffix.lower()
-
-    if suffix == ".pdf":
-        logger.info("Loading PDF", extra={"blob": blob_name})
-        from langchain_community.document_loaders import PyPDFLoader
-        docs = PyPDFLoader(local_path).load()
-    else:
-        logger.info("Loading text file", extra={"blob": blob_name})
-        from langchain_community.document_loaders import TextLoader
-        docs = TextLoader(local_path, encoding=None,
-                          autodetect_encoding=True).load()
+    from ingest.blob_loader import parse_file
+
+    logger.info("Loading document", extra={"blob": blob_name})
+    docs = parse_file(local_path, blob_name)
 
     logger.info("Documents loaded", extra={
                 "count": len(docs), "blob": blob_name})
 
-    for d in docs:
-        d.page_content = normalize_extracted_text(d.page_content)
-        md = d.metadata or {}
-        md["blob_name"] = blob_name
-        md["source_path"] = blob_name
-        md["source"] = "azure_blob"
-        md["file"] = PurePath(blob_name).name
-        md["doc_id"] = blob_name
-        d.metadata = md
-
     return docs
 
 
 def _delete_ids(doc_id: str, *_):
-    from rag.vector_store import get_vector_store
-    store = get_vector_store()
-
-    safe = doc_id.replace("'", "''")
-
-    results = store.client.search(
-        search_text="*",
-        filter=f"doc_id eq '{safe}'",
-        select=["id"],
-        top=1000
-    )
+    from ingest.index_azure_search import delete_document
 
-    ids = [r["id"] for r in results]
+    count = delete_document(doc_id)
 
-    if not ids:
+    if not count:
         logger.warning("No documents found to delete",
                        extra={"doc_id": doc_id})
         return
 
-    store.delete(ids=ids)
-
-    logger.info("Deleted chunks", extra={"count": len(ids), "doc_id": doc_id})
+    logger.info("Deleted chunks", extra={"count": count, "doc_id": doc_id})
 
 
 # ------------------------
@@ -145,9 +142,10 @@ def _handle_upsert(blob_name: str) -> None:
     if not _supported(blob_name):
         return
 
+    from config.settings import get_settings
     from ingest.chunking import production_chunk_documents
-    from ingest.index_azure_search import index_documents
-    from ingest.state_store import DocState, load_state, save_state
+    from ingest.index_azure_search import upsert_document
+    from ingest.state_store import load_state, save_state
 
     container = _container_client()
     doc_id = blob_name
@@ -156,32 +154,34 @@ def _handle_upsert(blob_name: str) -> None:
     logger.info("Loaded previous state", extra={
                 "doc_id": doc_id, "state": str(prev)})
 
+    etag = _current_etag(container, blob_name)
+
+    if etag is None:
+        logger.info("Blob no longer exists — skipping", extra={"doc_id": doc_id})
+        return
+
+    if prev and prev.etag == etag:
+        logger.info("ETag unchanged — skipping", extra={"doc_id": doc_id})
+        return
+
     with tempfile.TemporaryDirectory() as temp_dir:
         local_path = os.path.join(
             temp_dir, container.container_name, blob_name)
 
-        etag = _download(container, blob_name, local_path)
-
-        if prev and prev.etag == etag:
-            logger.info("ETag unchanged — skipping", extra={"doc_id": doc_id})
-            return
+        _download(container, blob_name, local_path, etag)
 
         docs = _load_docs(local_path, blob_name)
 
-    chunks = production_chunk_documents(docs)
+    s = get_settings()
+    chunks = production_chunk_documents(
+        docs, workers=s.chunk_workers, min_parallel_chars=s.chunk_parallel_min_chars)
     logger.info("Chunking complete", extra={
                 "chunks": len(chunks), "doc_id": doc_id})
 
-    _delete_ids(doc_id)
-
     logger.info("Indexing chunks", extra={"doc_id": doc_id})
-    index_documents(chunks)
+    state = upsert_document(doc_id, chunks, prev, etag=etag)
 
-    save_state(container, DocState(
-        doc_id=doc_id,
-        etag=etag,
-        chunk_count=len(chunks)
-    ))
+    save_state(container, state)
 
     logger.info("UPSERT completed", extra={"doc_id": doc_id})
 
@@ -205,12 +205,105 @@ def _handle_delete(blob_name: str) -> None:
                        extra={"doc_id": doc_id})
         return
 
+    if _current_etag(container, blob_name) is not None:
+        logger.info("Blob was recreated — skipping delete",
+                    extra={"doc_id": doc_id})
+        return
+
     _delete_ids(doc_id, 0, prev.chunk_count)
     delete_state(container, doc_id)
 
     logger.info("DELETE completed", extra={"doc_id": doc_id})
 
 
+# ------------------------
+# EVENT COALESCING
+# ------------------------
+
+class _EventCoalescer:
+    # Blob events carry a per-blob `sequencer` that orders writes and
+    # deletes. An event waits out the window and is dropped if a newer one
+    # for the same blob arrived meanwhile (or had already been seen); the
+    # newest event's invocation does the work. With `shared`, sequencers
+    # are also compared through storage, so events handled by different
+    # instances supersede each other too. Handling is serialised per blob
+    # so bursts never index the same document concurrently.
+    def __init__(self, window_s: float, max_blobs: int = 10000, shared=None):
+        self.window_s = window_s
+        self.max_blobs = max_blobs
+        self.shared = shared
+        self._latest: OrderedDict[str, str] = OrderedDict()
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def admit(self, blob_name: str, sequencer: str) -> bool:
+        if not sequencer:
+            return True
+        with self._lock:
+            latest = self._latest.get(blob_name)
+            if latest is not None and sequencer < latest:
+                return False
+            self._latest[blob_name] = sequencer
+            self._latest.move_to_end(blob_name)
+            while len(self._latest) > self.max_blobs:
+                old, _ = self._latest.popitem(last=False)
+                lock = self._locks.get(old)
+                if lock is not None and not lock.locked():
+                    del self._locks[old]
+
+        shared = self.shared if self.window_s > 0 else None
+        if shared is not None and shared.record(blob_name, sequencer) > sequencer:
+            return False
+        if self.window_s > 0:
+            time.sleep(self.window_s)
+        with self._lock:
+            latest = self._latest.get(blob_name)
+            if latest is not None and latest != sequencer:
+                return False
+        return shared is None or shared.latest(blob_name) <= sequencer
+
+    def blob_lock(self, blob_name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(blob_name, threading.Lock())
+
+
+class _StoredSequencers:
+    # A storage error only costs the coalescing: the event is handled.
+    def record(self, blob_name: str, sequencer: str) -> str:
+        from ingest.state_store import record_sequencer
+
+        try:
+            return record_sequencer(_container_client(), blob_name, sequencer)
+        except Exception as e:
+            logger.warning("Could not record event sequencer",
+                           extra={"blob": blob_name, "error": str(e)})
+            return sequencer
+
+    def latest(self, blob_name: str) -> str:
+        from ingest.state_store import latest_sequencer
+
+        try:
+            return latest_sequencer(_container_client(), blob_name)
+        except Exception as e:
+            logger.warning("Could not read event sequencer",
+                           extra={"blob": blob_name, "error": str(e)})
+            return ""
+
+
+def _coalesce_window_s() -> float:
+    # Off by default: every admitted event would otherwise hold its
+    # invocation for the whole window. A window collapses bursts of writes
+    # to one blob into a single ingest, at the cost of that delay and two
+    # small storage requests per event.
+    try:
+        return float(os.environ.get("RAG_EVENT_COALESCE_WINDOW_S", "0"))
+    except ValueError:
+        return 0.0
+
+
+_coalescer = _EventCoalescer(_coalesce_window_s(), shared=_StoredSequencers())
+
+
 # ------------------------
 # TRIGGER
 # ------------------------
@@ -234,11 +327,19 @@ def blob_ingest(event: func.EventGridEvent):
             return
 
         blob_name = _blob_name_from_url(url)
+        sequencer = str(data.get("sequencer") or "")
+
+        if not _coalescer.admit(blob_name, sequencer):
+            logger.info("Event superseded by a newer one — skipping",
+                        extra={"blob": blob_name, "sequencer": sequencer})
+            return
 
-        if "blobdeleted" in et:
-            _handle_delete(blob_name)
-        else:
-            _handle_upsert(blob_name)
+        op = "delete" if "blobdeleted" in et else "upsert"
+        with _coalescer.blob_lock(blob_name), telemetry.span("ingest_blob", op=op):
+            if op == "delete":
+                _handle_delete(blob_name)
+            else:
+                _handle_upsert(blob_name)
 
         logger.info("Event processed successfully")
 
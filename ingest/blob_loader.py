@@ -1,16 +1,42 @@
+import logging
 import os
 import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import PurePath
+from typing import Iterable, Iterator
 
-from langchain_community.document_loaders import (
-    PyPDFLoader,
-    TextLoader,
-)
+from langchain_community.document_loaders import TextLoader
 
+from ingest.pdf_parsing import iter_pdf_pages
 from ingest.text_cleaning import normalize_extracted_text
+from rag import telemetry
 
 
-def load_documents():
+logger = logging.getLogger(__name__)
+
+SUPPORTED_SUFFIXES = {".pdf", ".txt"}
+
+
+@dataclass
+class LoadReport:
+    loaded: int = 0
+    documents: int = 0
+    bytes: int = 0
+    failed: dict[str, str] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.monotonic)
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return (
+            f"{self.loaded} blobs ({self.documents} documents, "
+            f"{self.bytes / 1e6:.1f} MB) in {elapsed:.1f}s, "
+            f"{self.loaded / elapsed:.1f} blobs/s, {len(self.failed)} failed"
+        )
+
+
+def container_client():
     try:
         from azure.storage.blob import ContainerClient
     except ImportError as exc:
@@ -22,45 +48,145 @@ def load_documents():
     conn_str = os.environ["AZURE_STORAGE_CONNECTION_STRING"]
     container_name = os.environ["AZURE_STORAGE_CONTAINER"]
 
-    container = ContainerClient.from_connection_string(
+    return ContainerClient.from_connection_string(
         conn_str=conn_str, container_name=container_name
     )
 
-    docs = []
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for blob in container.list_blobs():
-            blob_name = blob.name
-            suffix = PurePath(blob_name).suffix.lower()
-
-            if suffix not in {".pdf", ".txt"}:
-                continue
 
-            local_path = os.path.join(temp_dir, container_name, blob_name)
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+def supported(blob_name: str) -> bool:
+    return PurePath(blob_name).suffix.lower() in SUPPORTED_SUFFIXES
 
-            blob_client = container.get_blob_client(blob=blob_name)
-            with open(local_path, "wb") as f:
-                stream = blob_client.download_blob()
-                stream.readinto(f)
 
-            if suffix == ".pdf":
-                file_docs = PyPDFLoader(local_path).load()
-            else:
-                file_docs = TextLoader(
-                    local_path,
-                    encoding=None,
-                    autodetect_encoding=True,
-                ).load()
+def parse_file(local_path: str, blob_name: str):
+    if PurePath(blob_name).suffix.lower() == ".pdf":
+        from config.settings import get_settings
 
+        s = get_settings()
+        # Pages come back already cleaned by the parsing workers, so the
+        # parse span includes cleaning for PDFs.
+        with telemetry.span("parse", kind="pdf") as sp:
+            file_docs = list(iter_pdf_pages(
+                local_path,
+                workers=s.pdf_workers,
+                pages_per_task=s.pdf_pages_per_task,
+                min_parallel_pages=s.pdf_parallel_min_pages,
+                max_memory_mb=s.pdf_max_memory_mb,
+            ))
+            sp.set(documents=len(file_docs))
+    else:
+        with telemetry.span("parse", kind="text") as sp:
+            file_docs = TextLoader(
+                local_path,
+                encoding=None,
+                autodetect_encoding=True,
+            ).load()
+            sp.set(documents=len(file_docs))
+        with telemetry.span("clean") as sp:
             for d in file_docs:
                 d.page_content = normalize_extracted_text(d.page_content)
-                md = d.metadata or {}
-                md["blob_name"] = blob_name
-                md["source_path"] = blob_name
-                md["source"] = "azure_blob"
-                md["file"] = PurePath(blob_name).name
-                md["doc_id"] = blob_name
-                d.metadata = md
-            docs.extend(file_docs)
-
-    return docs
+            sp.set(chars=sum(len(d.page_content) for d in file_docs))
+
+    for d in file_docs:
+        md = d.metadata or {}
+        md["blob_name"] = blob_name
+        md["source_path"] = blob_name
+        md["source"] = "azure_blob"
+        md["file"] = PurePath(blob_name).name
+        md["doc_id"] = blob_name
+        d.metadata = md
+    return file_docs
+
+
+def _load_blob(container, temp_dir: str, blob_name: str):
+    local_path = os.path.join(temp_dir, container.container_name, blob_name)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    try:
+        blob_client = container.get_blob_client(blob=blob_name)
+        with telemetry.span("download") as sp, open(local_path, "wb") as f:
+            stream = blob_client.download_blob()
+            sp.set(bytes=stream.readinto(f))
+        return parse_file(local_path, blob_name)
+    finally:
+        try:
+            os.remove(local_path)
+        except FileNotFoundError:
+            pass
+
+
+def iter_blob_documents(
+    container=None,
+    *,
+    blobs: Iterable | None = None,
+    max_workers: int = 8,
+    max_bytes_in_flight: int = 256 * 1024 * 1024,
+    report: LoadReport | None = None,
+) -> Iterator:
+    # Downloads run in a bounded pool and (blob_name, documents) pairs are
+    # yielded in completion order. A blob's bytes count as in flight from submission
+    # until its documents have been handed to the consumer; a single blob
+    # larger than the cap is still admitted once nothing else is in flight.
+    container = container or container_client()
+    report = report if report is not None else LoadReport()
+    blobs = container.list_blobs() if blobs is None else blobs
+
+    pending: dict = {}
+    in_flight = 0
+
+    def drain(block: bool):
+        nonlocal in_flight
+        if not pending:
+            return
+        done, _ = wait(list(pending), timeout=None if block else 0,
+                       return_when=FIRST_COMPLETED)
+        for fut in done:
+            blob_name, size = pending.pop(fut)
+            in_flight -= size
+            try:
+                file_docs = fut.result()
+            except Exception as e:
+                report.failed[blob_name] = f"{type(e).__name__}: {e}"
+                logger.warning("Failed to load blob %s: %s", blob_name, e)
+                continue
+            report.loaded += 1
+            report.documents += len(file_docs)
+            report.bytes += size
+            yield blob_name, file_docs
+
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        for blob in blobs:
+            blob_name = blob.name
+            if not supported(blob_name):
+                continue
+            size = int(getattr(blob, "size", 0) or 0)
+
+            while pending and (
+                len(pending) >= 2 * max_workers
+                or in_flight + size > max_bytes_in_flight
+            ):
+                yield from drain(block=True)
+            yield from drain(block=False)
+
+            fut = pool.submit(_load_blob, container, temp_dir, blob_name)
+            pending[fut] = (blob_name, size)
+            in_flight += size
+
+        while pending:
+            yield from drain(block=True)
+
+    logger.info("Blob load: %s", report.summary())
+
+
+def iter_documents(container=None, **kwargs) -> Iterator:
+    for _, file_docs in iter_blob_documents(container, **kwargs):
+        yield from file_docs
+
+
+def load_documents():
+    from config.settings import get_settings
+
+    s = get_settings()
+    return list(iter_documents(
+        max_workers=s.ingest_download_workers,
+        max_bytes_in_flight=s.ingest_max_inflight_mb * 1024 * 1024,
+    ))
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import copy
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import regex
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter, TokenTextSplitter
+
+
+STRUCTURAL_SEPARATORS = [
+    "\n## ",
+    "\n# ",
+    "\n### ",
+    "\n- ",
+    "\n• ",
+    "\n1. ",
+    "\nStep ",
+    "\n\n",
+    "\n",
+    " "
+]
+STRUCTURAL_CHUNK_SIZE = 2000
+STRUCTURAL_CHUNK_OVERLAP = 200
+TOKEN_CHUNK_SIZE = 700
+TOKEN_CHUNK_OVERLAP = 150
+ENCODING_NAME = "gpt2"
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def structural_splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=STRUCTURAL_CHUNK_SIZE,
+        chunk_overlap=STRUCTURAL_CHUNK_OVERLAP,
+        separators=STRUCTURAL_SEPARATORS,
+    )
+
+
+@lru_cache(maxsize=1)
+def token_splitter() -> TokenTextSplitter:
+    return TokenTextSplitter(
+        encoding_name=ENCODING_NAME,
+        chunk_size=TOKEN_CHUNK_SIZE,
+        chunk_overlap=TOKEN_CHUNK_OVERLAP,
+    )
+
+
+def reference_split_text(text: str) -> list[str]:
+    token = token_splitter()
+    return [c for part in structural_splitter().split_text(text) for c in token.split_text(part)]
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    import tiktoken
+
+    enc = tiktoken.get_encoding(ENCODING_NAME)
+    byte_lens = np.zeros(enc.n_vocab, dtype=np.int64)
+    for token in range(enc.n_vocab):
+        try:
+            byte_lens[token] = len(enc.decode_single_token_bytes(token))
+        except KeyError:
+            pass
+    return enc, byte_lens
+
+
+# A letter run (or digit run) followed by anything else always ends a
+# pretokenizer piece, whatever the surrounding text: no piece of the gpt2
+# pattern continues past the last letter of ` ?\p{L}+` or a contraction, or
+# past the last digit of ` ?\p{N}+`.
+_HARD_BOUNDARY = regex.compile(r"(?<=\p{L})(?!\p{L})|(?<=\p{N})(?!\p{N})")
+
+
+def _first_hard_boundary(text: str, start: int, stop: int) -> int:
+    # First hard boundary in (start, stop]. The search runs one character
+    # past `stop` so the lookahead sees the full text, not the substring.
+    m = _HARD_BOUNDARY.search(text, start + 1, min(len(text), stop + 1))
+    return m.start() if m and m.start() <= stop else -1
+
+
+def _last_hard_boundary(text: str, start: int, stop: int) -> int:
+    # Last hard boundary in (start, stop], scanning back from `stop`.
+    window = 64
+    while True:
+        lo = max(start + 1, stop - window)
+        found = -1
+        for m in _HARD_BOUNDARY.finditer(text, lo, min(len(text), stop + 1)):
+            if m.start() <= stop:
+                found = m.start()
+        if found >= 0 or lo == start + 1:
+            return found
+        window *= 4
+
+
+class TokenizedText:
+    # The text's BPE tokens, computed once. Tokens for a substring are
+    # sliced out of them between the first and last hard piece boundaries
+    # inside it; only the few characters outside those are encoded again.
+
+    def __init__(self, text: str):
+        enc, byte_lens = _encoding()
+        self.text = text
+        self._enc = enc
+        self.tokens: list[int] = enc.encode_ordinary(text)
+        # token_ends[i] is the UTF-8 byte offset where token i ends.
+        self.token_ends = np.cumsum(byte_lens[np.asarray(self.tokens, dtype=np.int64)])
+        self._ascii = text.isascii()
+        self._cursor = (0, 0)
+
+    def _byte_offset(self, pos: int) -> int:
+        if self._ascii:
+            return pos
+        char, byte = self._cursor
+        if pos < char:
+            char, byte = 0, 0
+        byte += len(self.text[char:pos].encode("utf-8"))
+        self._cursor = (pos, byte)
+        return byte
+
+    def _token_at(self, byte: int) -> int:
+        # Index of the token starting at `byte`, which must be a token boundary.
+        if byte == 0:
+            return 0
+        i = int(np.searchsorted(self.token_ends, byte))
+        if i >= len(self.token_ends) or self.token_ends[i] != byte:
+            return -1
+        return i + 1
+
+    def encode(self, start: int, stop: int) -> list[int]:
+        # Tokens for text[start:stop], identical to encoding it on its own.
+        # The pattern has no lookbehind, so between two hard boundaries the
+        # substring pretokenizes exactly like the full text.
+        text = self.text
+        head = _first_hard_boundary(text, start, stop)
+        tail = _last_hard_boundary(text, head, stop) if head >= 0 else -1
+        if tail <= head:
+            return self._enc.encode_ordinary(text[start:stop])
+
+        head_byte = self._byte_offset(head)
+        first = self._token_at(head_byte)
+        last = self._token_at(head_byte + len(text[head:tail].encode("utf-8")))
+        if first < 0 or last < 0:
+            return self._enc.encode_ordinary(text[start:stop])
+        return (
+            self._enc.encode_ordinary(text[start:head])
+            + self.tokens[first:last]
+            + self._enc.encode_ordinary(text[tail:stop])
+        )
+
+
+def token_windows(ids: list[int], decode, size: int, overlap: int) -> list[str]:
+    # Same windows as langchain_text_splitters.split_text_on_tokens.
+    out = []
+    start = 0
+    while start < len(ids):
+        stop = min(start + size, len(ids))
+        out.append(decode(ids[start:stop]))
+        if stop == len(ids):
+            break
+        start += size - overlap
+    return out
+
+
+def _needs_reference(enc, text: str) -> bool:
+    # tiktoken rejects special-token text and repairs lone surrogates before
+    # encoding; leave both cases to the stock splitters.
+    try:
+        text.encode("utf-8")
+    except UnicodeEncodeError:
+        return True
+    return any(t in text for t in enc.special_tokens_set)
+
+
+def split_text(text: str) -> list[str]:
+    enc, _ = _encoding()
+    if _needs_reference(enc, text):
+        return reference_split_text(text)
+
+    parts = structural_splitter().split_text(text)
+    if len(parts) <= 1:
+        # Nothing overlaps, so there is nothing to share.
+        return [
+            c for part in parts
+            for c in token_windows(enc.encode_ordinary(part), enc.decode,
+                                   TOKEN_CHUNK_SIZE, TOKEN_CHUNK_OVERLAP)
+        ]
+    tokenized = TokenizedText(text)
+    out: list[str] = []
+    pos = 0
+    for part in parts:
+        # Structural chunks are stripped substrings of the text, in order.
+        start = text.find(part, pos)
+        if start < 0:
+            start = text.find(part)
+        if start < 0:
+            ids = enc.encode_ordinary(part)
+        else:
+            ids = tokenized.encode(start, start + len(part))
+            pos = start
+        out += token_windows(ids, enc.decode, TOKEN_CHUNK_SIZE, TOKEN_CHUNK_OVERLAP)
+    return out
+
+
+def _split_texts(texts: list[str]) -> list[list[str]]:
+    return [split_text(t) for t in texts]
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    # One pool per process, sized by the first caller.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _batches(texts: list[str], batch_chars: int) -> list[list[str]]:
+    batches: list[list[str]] = []
+    size = 0
+    for t in texts:
+        if not batches or size >= batch_chars:
+            batches.append([])
+            size = 0
+        batches[-1].append(t)
+        size += len(t)
+    return batches
+
+
+def split_documents(
+    docs,
+    *,
+    workers: int = 1,
+    min_parallel_chars: int = 200_000,
+) -> list[Document]:
+    # Drop-in for structural_splitter().split_documents() followed by
+    # token_splitter().split_documents(). Documents are split in a process
+    # pool when there is enough text to be worth shipping to it.
+    docs = list(docs)
+    texts = [d.page_content for d in docs]
+    total = sum(map(len, texts))
+
+    if workers <= 1 or len(docs) < 2 or total < min_parallel_chars:
+        splits = _split_texts(texts)
+    else:
+        batch_chars = max(1, total // (4 * workers))
+        pool = _get_pool(workers)
+        splits = [s for part in pool.map(_split_texts, _batches(texts, batch_chars)) for s in part]
+
+    return [
+        Document(page_content=chunk, metadata=copy.deepcopy(d.metadata))
+        for d, chunks in zip(docs, splits)
+        for chunk in chunks
+    ]
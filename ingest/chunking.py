@@ -1,37 +1,35 @@
-from langchain_text_splitters import RecursiveCharacterTextSplitter, TokenTextSplitter
 import hashlib
+from collections import Counter
 
+from ingest.chunk_engine import split_documents
+from rag import telemetry
+from rag.text_pl import SIGNATURE_KEY, STEM_SIGNATURE_KEY, lexical_signature, stem_signature
+
+
+def _doc_key(chunk) -> str:
+    md = chunk.metadata or {}
+    return str(md.get("doc_id") or md.get("source_path") or md.get("file") or "")
+
+
+def production_chunk_documents(docs, *, workers: int = 1, min_parallel_chars: int = 200_000):
+    # Same chunks as RecursiveCharacterTextSplitter(2000/200) followed by
+    # TokenTextSplitter(700/150), see ingest.chunk_engine.
+    docs = list(docs)
+    with telemetry.span("chunk") as sp:
+        final_chunks = split_documents(
+            docs, workers=workers, min_parallel_chars=min_parallel_chars)
+        sp.set(documents=len(docs), chunks=len(final_chunks))
+
+    # Positions count within each document so one document's chunks keep
+    # their numbering when another document changes.
+    totals = Counter(_doc_key(c) for c in final_chunks)
+    positions = Counter()
+
+    for chunk in final_chunks:
+        key = _doc_key(chunk)
+        i = positions[key]
+        positions[key] += 1
 
-def production_chunk_documents(docs):
-    structural_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=2000,
-        chunk_overlap=200,
-        separators=[
-            "\n## ",
-            "\n# ",
-            "\n### ",
-            "\n- ",
-            "\n• ",
-            "\n1. ",
-            "\nStep ",
-            "\n\n",
-            "\n",
-            " "
-        ]
-    )
-
-    stage1_chunks = structural_splitter.split_documents(docs)
-
-    token_splitter = TokenTextSplitter(
-        chunk_size=700,
-        chunk_overlap=150
-    )
-
-    final_chunks = token_splitter.split_documents(stage1_chunks)
-
-    total = len(final_chunks)
-
-    for i, chunk in enumerate(final_chunks):
         content_hash = hashlib.sha256(
             chunk.page_content.encode()
         ).hexdigest()
@@ -40,7 +38,9 @@ def production_chunk_documents(docs):
             "chunk_id": i,
             "chunk_hash": content_hash,
             "chunk_position": i,
-            "total_chunks": total,
+            "total_chunks": totals[key],
+            SIGNATURE_KEY: lexical_signature(chunk.page_content),
+            STEM_SIGNATURE_KEY: stem_signature(chunk.page_content),
             "source": chunk.metadata.get("source", "unknown"),
             "file": chunk.metadata.get("file", "unknown")
         })
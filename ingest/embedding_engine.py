@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, TypeVar
+
+from langchain_core.embeddings import Embeddings
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# OpenAI accepts at most 2048 inputs per embeddings request.
+MAX_BATCH_ITEMS = 2048
+
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def _status(e: Exception) -> int | None:
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status
+
+
+def _retry_after(e: Exception) -> float | None:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    for name in ("retry-after-ms", "retry-after"):
+        raw = headers.get(name)
+        if raw is None:
+            continue
+        try:
+            value = float(raw)
+        except ValueError:
+            continue
+        return value / 1000.0 if name.endswith("-ms") else value
+    return None
+
+
+class AdaptiveLimiter:
+    # AIMD concurrency limit shared by every caller: a rate-limit response
+    # halves the allowed in-flight requests and pauses new ones for the
+    # backoff delay; each run of successes widens the limit by one again.
+    def __init__(self, max_concurrency: int, *, recover_after: int = 4):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.limit = self.max_concurrency
+        self.recover_after = recover_after
+        self.throttled = 0
+        self._active = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while True:
+                wait_s = self._paused_until - time.monotonic()
+                if wait_s <= 0 and self._active < self.limit:
+                    self._active += 1
+                    return
+                self._cond.wait(timeout=wait_s if wait_s > 0 else None)
+
+    def release(self, *, ok: bool) -> None:
+        with self._cond:
+            self._active -= 1
+            if ok:
+                self._successes += 1
+                if self._successes >= self.recover_after and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+    def backoff(self, delay_s: float) -> None:
+        with self._cond:
+            self.throttled += 1
+            self._successes = 0
+            self.limit = max(1, self.limit // 2)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay_s)
+            self._cond.notify_all()
+
+
+def call_with_backoff(
+    fn: Callable[[], T],
+    limiter: AdaptiveLimiter,
+    *,
+    max_retries: int = 8,
+    base_delay_s: float = 1.0,
+    max_delay_s: float = 60.0,
+) -> T:
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            limiter.release(ok=False)
+            status = _status(e)
+            if status not in _RETRYABLE_STATUS or attempt >= max_retries:
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(max_delay_s, base_delay_s * 2 ** attempt)
+                delay *= random.uniform(0.5, 1.0)
+            attempt += 1
+            logger.warning("Request failed with %s, retry %d/%d in %.1fs",
+                           status, attempt, max_retries, delay)
+            if status == 429:
+                limiter.backoff(delay)
+            else:
+                time.sleep(delay)
+            continue
+        limiter.release(ok=True)
+        return result
+
+
+def _token_counter(model: str) -> Callable[[str], int]:
+    try:
+        import tiktoken
+
+        enc = tiktoken.encoding_for_model(model)
+        return lambda text: len(enc.encode(text, disallowed_special=()))
+    except Exception:
+        # Without the tokenizer files a Polish-safe over-estimate keeps
+        # batches under the request token limit.
+        return lambda text: len(text) // 2 + 1
+
+
+def token_batches(
+    token_counts: list[int], *, max_tokens: int, max_items: int = MAX_BATCH_ITEMS
+) -> list[range]:
+    batches: list[range] = []
+    start, tokens = 0, 0
+    for i, n in enumerate(token_counts):
+        if i > start and (tokens + n > max_tokens or i - start >= max_items):
+            batches.append(range(start, i))
+            start, tokens = i, 0
+        tokens += n
+    if start < len(token_counts):
+        batches.append(range(start, len(token_counts)))
+    return batches
+
+
+@dataclass
+class ThroughputStats:
+    chunks: int = 0
+    tokens: int = 0
+    requests: int = 0
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    def record(self, *, chunks: int, tokens: int, requests: int, started_at: float) -> None:
+        self.chunks += chunks
+        self.tokens += tokens
+        self.requests += requests
+        if self.started_at is None:
+            self.started_at = started_at
+        self.finished_at = time.monotonic()
+
+    @property
+    def elapsed_s(self) -> float:
+        # Wall-clock span, since concurrent callers overlap.
+        return max((self.finished_at or 0.0) - (self.started_at or 0.0), 1e-9)
+
+    def line(self) -> str:
+        elapsed = self.elapsed_s
+        return (
+            f"{self.chunks} chunks, {self.tokens} tokens in {self.requests} requests; "
+            f"{self.tokens / elapsed:.0f} tokens/s, {self.chunks / elapsed:.1f} chunks/s"
+        )
+
+
+class EmbeddingEngine(Embeddings):
+    def __init__(
+        self,
+        inner: Embeddings,
+        *,
+        model: str,
+        max_batch_tokens: int = 100_000,
+        concurrency: int = 4,
+        max_retries: int = 8,
+    ):
+        self.inner = inner
+        self.max_batch_tokens = max(1, int(max_batch_tokens))
+        self.max_retries = max_retries
+        self.limiter = AdaptiveLimiter(concurrency)
+        self.stats = ThroughputStats()
+        self._count_tokens = _token_counter(model)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(concurrency)),
+                                        thread_name_prefix="embed")
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        started = time.monotonic()
+        counts = [self._count_tokens(t) for t in texts]
+        batches = token_batches(counts, max_tokens=self.max_batch_tokens)
+
+        def run(batch: range) -> list[list[float]]:
+            part = [texts[i] for i in batch]
+            return call_with_backoff(
+                lambda: self.inner.embed_documents(part),
+                self.limiter,
+                max_retries=self.max_retries,
+            )
+
+        vectors: list[list[float]] = []
+        for part in self._pool.map(run, batches):
+            vectors.extend(part)
+
+        with self._lock:
+            self.stats.record(chunks=len(texts), tokens=sum(counts),
+                              requests=len(batches), started_at=started)
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.inner.embed_query(text)
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from hashlib import sha256
+
+from config.embedding_cache import decode_vector, encode_vector
+
+
+logger = logging.getLogger(__name__)
+
+# SQLite caps the number of bound parameters per statement.
+_LOOKUP_BATCH = 500
+
+
+@dataclass(frozen=True)
+class EmbeddingReport:
+    embedded: int
+    reused: int
+
+
+def chunk_hash(chunk) -> str:
+    md = chunk.metadata or {}
+    h = md.get("chunk_hash")
+    if h:
+        return str(h)
+    return sha256(chunk.page_content.encode()).hexdigest()
+
+
+class ChunkEmbeddingStore:
+    def __init__(self, path: str):
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_embeddings ("
+                "model TEXT NOT NULL, chunk_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, chunk_hash))"
+            )
+            self._conn.commit()
+
+    def get_many(self, model: str, hashes: list[str]) -> dict[str, list[float]]:
+        found: dict[str, list[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for i in range(0, len(unique), _LOOKUP_BATCH):
+                batch = unique[i:i + _LOOKUP_BATCH]
+                marks = ",".join("?" for _ in batch)
+                rows = self._conn.execute(
+                    f"SELECT chunk_hash, vector FROM chunk_embeddings "
+                    f"WHERE model = ? AND chunk_hash IN ({marks})",
+                    (model, *batch),
+                ).fetchall()
+                for h, raw in rows:
+                    found[h] = decode_vector(raw)
+        return found
+
+    def put_many(self, model: str, vectors: dict[str, list[float]]) -> None:
+        if not vectors:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (model, chunk_hash, vector) VALUES (?, ?, ?)",
+                [(model, h, encode_vector(v)) for h, v in vectors.items()],
+            )
+            self._conn.commit()
+
+
+def open_chunk_embedding_store(path: str | None) -> ChunkEmbeddingStore | None:
+    if not path:
+        return None
+    try:
+        return ChunkEmbeddingStore(path)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Chunk embedding store unavailable, embedding everything: %s", e)
+        return None
+
+
+def embed_chunks(chunks, embeddings, *, model: str, store: ChunkEmbeddingStore | None):
+    hashes = [chunk_hash(c) for c in chunks]
+    known = store.get_many(model, hashes) if store else {}
+
+    missing: dict[str, str] = {}
+    for h, c in zip(hashes, chunks):
+        if h not in known and h not in missing:
+            missing[h] = c.page_content
+
+    fresh: dict[str, list[float]] = {}
+    if missing:
+        vectors = embeddings.embed_documents(list(missing.values()))
+        fresh = dict(zip(missing.keys(), vectors))
+        if store:
+            store.put_many(model, fresh)
+
+    vectors = [known[h] if h in known else fresh[h] for h in hashes]
+    return vectors, EmbeddingReport(embedded=len(fresh), reused=len(chunks) - len(fresh))
@@ -1,26 +1,297 @@
 import base64
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 
-from rag.vector_store import get_vector_store
+from config.embeddings import get_document_embeddings
+from config.settings import get_settings
+from ingest.embedding_engine import (
+    AdaptiveLimiter,
+    EmbeddingEngine,
+    ThroughputStats,
+    call_with_backoff,
+)
+from ingest.embedding_store import chunk_hash, embed_chunks, open_chunk_embedding_store
+from ingest.state_store import DocState
+from rag import telemetry
+from rag.lexical_index import get_lexical_index
+from rag.vector_store import find_ids_by_doc_id, get_vector_store
 
 
-def chunk_id_from_doc_id(doc_id: str, chunk_position: int) -> str:
-    raw = f"{doc_id}:{chunk_position}"
+logger = logging.getLogger(__name__)
+
+
+# Azure Search accepts at most 1000 actions per indexing request.
+_INDEX_BATCH = 1000
+
+
+def chunk_id_from_doc_id(doc_id: str, chunk_key: str) -> str:
+    raw = f"{doc_id}:{chunk_key}"
     return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
 
 
-def _stable_id_from_chunk(chunk) -> str:
+def chunk_ids(doc_id: str, hashes) -> list[str]:
+    # Content-addressed: a chunk keeps its id for as long as its text is
+    # unchanged, wherever it moves in the document. Repeated identical
+    # chunks are told apart by their occurrence number.
+    seen: Counter = Counter()
+    ids = []
+    for h in hashes:
+        n = seen[h]
+        seen[h] += 1
+        ids.append(chunk_id_from_doc_id(doc_id, h if n == 0 else f"{h}:{n}"))
+    return ids
+
+
+def _doc_id_of(chunk) -> str:
     md = chunk.metadata or {}
-    doc_id = md.get("source_path") or md.get(
-        "blob_name") or md.get("file") or "unknown"
-    pos = md.get("chunk_position")
-    try:
-        chunk_position = int(pos)
-    except Exception:
-        chunk_position = 0
-    return chunk_id_from_doc_id(str(doc_id), chunk_position)
+    return str(md.get("doc_id") or md.get("source_path") or md.get(
+        "blob_name") or md.get("file") or "unknown")
+
+
+def _chunk_ids_for(chunks) -> list[str]:
+    by_doc: dict[str, list[int]] = {}
+    for i, c in enumerate(chunks):
+        by_doc.setdefault(_doc_id_of(c), []).append(i)
+    ids = [""] * len(chunks)
+    for doc_id, rows in by_doc.items():
+        for i, key in zip(rows, chunk_ids(doc_id, [chunk_hash(chunks[i]) for i in rows])):
+            ids[i] = key
+    return ids
+
+
+def _stored_ids(keys: list[str]) -> list[str]:
+    # The langchain AzureSearch store base64-encodes keys once more on write.
+    if hasattr(get_vector_store(), "ids_for_doc_id"):
+        return list(keys)
+    return [base64.urlsafe_b64encode(k.encode("utf-8")).decode("ascii") for k in keys]
+
+
+@lru_cache(maxsize=1)
+def _chunk_embedding_store():
+    return open_chunk_embedding_store(get_settings().chunk_embedding_store_path)
+
+
+@lru_cache(maxsize=1)
+def _embedding_engine() -> EmbeddingEngine:
+    s = get_settings()
+    return EmbeddingEngine(
+        get_document_embeddings(),
+        model=s.embedding_model,
+        max_batch_tokens=s.embed_batch_tokens,
+        concurrency=s.embed_concurrency,
+        max_retries=s.embed_max_retries,
+    )
+
+
+class _Uploader:
+    def __init__(self, batch_size: int, concurrency: int, max_retries: int):
+        self.batch_size = max(1, batch_size)
+        self.max_retries = max_retries
+        self.limiter = AdaptiveLimiter(concurrency)
+        self.stats = ThroughputStats()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency),
+                                        thread_name_prefix="upload")
+        self._lock = threading.Lock()
+
+    def upload(self, texts, vectors, metadatas, ids) -> list[str]:
+        started = time.monotonic()
+        store = get_vector_store()
+
+        def run(start: int) -> list[str]:
+            end = start + self.batch_size
+            return call_with_backoff(
+                lambda: store.add_embeddings(
+                    zip(texts[start:end], vectors[start:end]),
+                    metadatas[start:end],
+                    keys=ids[start:end],
+                ),
+                self.limiter,
+                max_retries=self.max_retries,
+            )
+
+        starts = range(0, len(texts), self.batch_size)
+        added = [key for part in self._pool.map(run, starts) for key in part]
+        with self._lock:
+            self.stats.record(chunks=len(texts), tokens=0,
+                              requests=len(starts), started_at=started)
+        return added
+
+
+@lru_cache(maxsize=1)
+def _uploader() -> _Uploader:
+    s = get_settings()
+    return _Uploader(s.index_upload_batch, s.index_upload_concurrency, s.embed_max_retries)
+
+
+def embed_for_index(chunks) -> list[list[float]]:
+    engine = _embedding_engine()
+    with telemetry.span("embed") as sp:
+        vectors, report = embed_chunks(
+            chunks,
+            engine,
+            model=get_settings().embedding_model,
+            store=_chunk_embedding_store(),
+        )
+        sp.set(chunks=len(vectors), embedded=report.embedded, reused=report.reused)
+    logger.info("Chunk embeddings: %d embedded, %d reused; %s, %d throttled",
+                report.embedded, report.reused, engine.stats.line(),
+                engine.limiter.throttled)
+    return vectors
+
+
+def upload_embedded(chunks, vectors, ids: list[str] | None = None) -> list[str]:
+    if not chunks:
+        return []
+    ids = ids or _chunk_ids_for(chunks)
+    uploader = _uploader()
+    with telemetry.span("index", chunks=len(chunks)):
+        added = uploader.upload(
+            [c.page_content for c in chunks],
+            list(vectors),
+            [c.metadata for c in chunks],
+            ids,
+        )
+    stats = uploader.stats
+    logger.info("Index upload: %d documents in %d batches, %.1f documents/s",
+                stats.chunks, stats.requests, stats.chunks / stats.elapsed_s)
+
+    lexical_index = get_lexical_index()
+    if lexical_index is not None:
+        lexical_index.upsert(ids, chunks)
+
+    return added
 
 
 def index_documents(chunks) -> list[str]:
+    chunks = list(chunks)
+    if not chunks:
+        return []
+    return upload_embedded(chunks, embed_for_index(chunks))
+
+
+def _delete_stored(ids: list[str]) -> None:
+    store = get_vector_store()
+    with telemetry.span("delete", chunks=len(ids)):
+        for start in range(0, len(ids), _INDEX_BATCH):
+            store.delete(ids=ids[start:start + _INDEX_BATCH])
+
+
+def _update_metadata(keys: list[str], metadatas: list[dict]) -> None:
     store = get_vector_store()
-    ids = [_stable_id_from_chunk(c) for c in chunks]
-    return store.add_documents(chunks, ids=ids)
+    if hasattr(store, "update_metadata"):
+        store.update_metadata(keys, metadatas)
+        return
+    field_names = {f.name for f in store.fields}
+    actions = []
+    for stored, md in zip(_stored_ids(keys), metadatas):
+        action = {"id": stored, "metadata": json.dumps(md)}
+        action.update({k: v for k, v in md.items() if k in field_names and k != "id"})
+        actions.append(action)
+    for start in range(0, len(actions), _INDEX_BATCH):
+        store.client.merge_documents(documents=actions[start:start + _INDEX_BATCH])
+
+
+def delete_document(doc_id: str) -> int:
+    lexical_index = get_lexical_index()
+    if lexical_index is not None:
+        lexical_index.remove_doc(doc_id)
+
+    ids = find_ids_by_doc_id(doc_id)
+    _delete_stored(ids)
+    return len(ids)
+
+
+@dataclass
+class DocumentDiff:
+    doc_id: str
+    hashes: list[str]
+    ids: list[str]
+    # Indexes into the new chunk list.
+    upload: list[int] = field(default_factory=list)
+    moved: list[int] = field(default_factory=list)
+    stale: list[str] = field(default_factory=list)
+    replace_all: bool = False
+
+    def describe(self) -> str:
+        if self.replace_all:
+            return f"{self.doc_id}: replace with {len(self.ids)} chunks"
+        kept = len(self.ids) - len(self.upload)
+        return (
+            f"{self.doc_id}: {len(self.upload)} new, {len(self.stale)} removed, "
+            f"{kept} kept ({len(self.moved)} moved)"
+        )
+
+
+def plan_document(doc_id: str, chunks, prev: DocState | None) -> DocumentDiff:
+    hashes = [chunk_hash(c) for c in chunks]
+    ids = chunk_ids(doc_id, hashes)
+    diff = DocumentDiff(doc_id=doc_id, hashes=hashes, ids=ids)
+
+    if prev is None or (prev.chunk_count and not prev.chunk_hashes):
+        # Nothing reliable to diff against (no state, or state written
+        # before chunk hashes were recorded).
+        diff.replace_all = True
+        diff.upload = list(range(len(chunks)))
+        return diff
+
+    prev_ids = chunk_ids(doc_id, prev.chunk_hashes)
+    prev_pos = {key: i for i, key in enumerate(prev_ids)}
+    resized = len(prev_ids) != len(ids)
+    for i, key in enumerate(ids):
+        if key not in prev_pos:
+            diff.upload.append(i)
+        elif resized or prev_pos[key] != i:
+            diff.moved.append(i)
+    current = set(ids)
+    diff.stale = [key for key in prev_ids if key not in current]
+    return diff
+
+
+def apply_document(diff: DocumentDiff, chunks, vectors, *, etag: str) -> DocState:
+    # `vectors` line up with diff.upload. New chunks are written before
+    # stale ones are removed, so the document never disappears from search.
+    lexical_index = get_lexical_index()
+    if diff.replace_all:
+        delete_document(diff.doc_id)
+
+    upload_embedded(
+        [chunks[i] for i in diff.upload],
+        vectors,
+        ids=[diff.ids[i] for i in diff.upload],
+    )
+
+    if diff.moved:
+        _update_metadata(
+            [diff.ids[i] for i in diff.moved],
+            [chunks[i].metadata for i in diff.moved],
+        )
+        if lexical_index is not None:
+            lexical_index.upsert(
+                [diff.ids[i] for i in diff.moved], [chunks[i] for i in diff.moved])
+
+    if diff.stale:
+        _delete_stored(_stored_ids(diff.stale))
+        if lexical_index is not None:
+            lexical_index.remove_ids(diff.stale)
+
+    logger.info("Upserted %s", diff.describe())
+    return DocState(
+        doc_id=diff.doc_id,
+        etag=etag,
+        chunk_count=len(diff.ids),
+        chunk_hashes=tuple(diff.hashes),
+    )
+
+
+def upsert_document(doc_id: str, chunks, prev: DocState | None, *, etag: str) -> DocState:
+    chunks = list(chunks)
+    diff = plan_document(doc_id, chunks, prev)
+    to_embed = [chunks[i] for i in diff.upload]
+    vectors = embed_for_index(to_embed) if to_embed else []
+    return apply_document(diff, chunks, vectors, etag=etag)
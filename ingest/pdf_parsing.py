@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import gc
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+from langchain_core.documents import Document
+
+from ingest.text_cleaning import normalize_extracted_text
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+# Worker-side cache of the last opened reader, so consecutive page ranges of
+# one file do not re-parse its cross-reference table.
+_reader_key: tuple | None = None
+_reader = None
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+
+def _open(path: str):
+    global _reader_key, _reader
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if _reader_key != key:
+        import pypdf
+
+        _reader, _reader_key = None, None
+        _reader = pypdf.PdfReader(path)
+        _reader_key = key
+    return _reader
+
+
+def _drop_reader() -> None:
+    global _reader_key, _reader
+    _reader, _reader_key = None, None
+    gc.collect()
+
+
+def _extract(reader, start: int, stop: int) -> list[str]:
+    return [
+        normalize_extracted_text(reader.pages[n].extract_text(extraction_mode="plain"))
+        for n in range(start, stop)
+    ]
+
+
+def _extract_range(path: str, start: int, stop: int, max_rss_mb: float) -> list[str]:
+    # Runs in pool workers only; the reader cache is per process.
+    texts = _extract(_open(path), start, stop)
+    # pypdf keeps every resolved object alive on the reader; past the cap
+    # the worker starts over with a fresh one.
+    if max_rss_mb and _rss_mb() > max_rss_mb:
+        _drop_reader()
+    return texts
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    # One pool per process, sized by the first caller.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Loader threads may be running, so workers are spawned rather
+            # than forked.
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _page_document(path: str, page: int, text: str) -> Document:
+    return Document(page_content=text, metadata={"source": path, "page": page})
+
+
+def iter_pdf_pages(
+    path: str,
+    *,
+    workers: int = 4,
+    pages_per_task: int = 16,
+    min_parallel_pages: int = 32,
+    max_memory_mb: int = 1024,
+) -> Iterator[Document]:
+    # Yields one cleaned Document per page, in page order. Large files are
+    # split into page ranges that run in a shared process pool; at most
+    # 2 * workers ranges are submitted or buffered at once, and each worker
+    # keeps its resident set under max_memory_mb / workers.
+    import pypdf
+
+    reader = pypdf.PdfReader(path)
+    pages = len(reader.pages)
+    if workers <= 1 or pages < max(min_parallel_pages, 2):
+        for n in range(pages):
+            yield _page_document(path, n, _extract(reader, n, n + 1)[0])
+        return
+    del reader
+
+    pool = _get_pool(workers)
+    per_worker_mb = max_memory_mb / workers if max_memory_mb else 0
+    window = 2 * workers
+    pages_per_task = max(1, pages_per_task)
+    ranges = iter(range(0, pages, pages_per_task))
+    pending: deque = deque()
+
+    def submit_next() -> bool:
+        start = next(ranges, None)
+        if start is None:
+            return False
+        stop = min(pages, start + pages_per_task)
+        pending.append((start, pool.submit(_extract_range, path, start, stop, per_worker_mb)))
+        return True
+
+    try:
+        while len(pending) < window and submit_next():
+            pass
+        while pending:
+            start, fut = pending.popleft()
+            texts = fut.result()
+            submit_next()
+            for offset, text in enumerate(texts):
+                yield _page_document(path, start + offset, text)
+    finally:
+        for _, fut in pending:
+            fut.cancel()
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+_POLL_S = 0.1
+
+
+class _Stopped(Exception):
+    pass
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items_in: int = 0
+    items_out: int = 0
+    busy_s: float = 0.0
+    depth: int = 0
+    max_depth: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def line(self, elapsed: float) -> str:
+        elapsed = max(elapsed, 1e-9)
+        busy = self.busy_s / (elapsed * self.workers)
+        return (
+            f"{self.name}: in={self.items_in} out={self.items_out} "
+            f"({self.items_out / elapsed:.2f}/s) busy={busy:.0%} "
+            f"queue={self.depth} max_queue={self.max_depth}"
+        )
+
+
+@dataclass
+class Stage:
+    # fn maps one input item to an iterable of output items, so a stage can
+    # drop, pass through or fan out work.
+    name: str
+    fn: Callable[[Any], Iterable[Any]]
+    workers: int = 1
+    queue_size: int = 16
+
+
+class Pipeline:
+    def __init__(
+        self,
+        source: Iterable[Any],
+        stages: list[Stage],
+        *,
+        report_every_s: float = 10.0,
+    ):
+        self.source = source
+        self.stages = stages
+        self.report_every_s = report_every_s
+        self.stats = [StageStats(s.name, max(1, s.workers)) for s in stages]
+        self._queues = [queue.Queue(maxsize=max(1, s.queue_size)) for s in stages]
+        self._out: queue.Queue = queue.Queue(maxsize=max(1, stages[-1].queue_size))
+        self._stop = threading.Event()
+        self._error: BaseException | None = None
+        self._error_lock = threading.Lock()
+
+    def _fail(self, e: BaseException) -> None:
+        with self._error_lock:
+            if self._error is None:
+                self._error = e
+        self._stop.set()
+
+    def _put(self, q: queue.Queue, item, stats: StageStats | None = None) -> None:
+        while True:
+            try:
+                q.put(item, timeout=_POLL_S)
+                break
+            except queue.Full:
+                if self._stop.is_set():
+                    raise _Stopped()
+        if stats is not None and item is not _DONE:
+            depth = q.qsize()
+            with stats._lock:
+                stats.max_depth = max(stats.max_depth, depth)
+
+    def _get(self, q: queue.Queue):
+        while True:
+            try:
+                return q.get(timeout=_POLL_S)
+            except queue.Empty:
+                if self._stop.is_set():
+                    raise _Stopped()
+
+    def _feed(self) -> None:
+        try:
+            for item in self.source:
+                self._put(self._queues[0], item, self.stats[0])
+            self._put(self._queues[0], _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            close = getattr(self.source, "close", None)
+            if close is not None:
+                close()
+
+    def _work(self, i: int, remaining: list[int], lock: threading.Lock) -> None:
+        stage, stats = self.stages[i], self.stats[i]
+        inbox = self._queues[i]
+        outbox = self._queues[i + 1] if i + 1 < len(self.stages) else self._out
+        out_stats = self.stats[i + 1] if i + 1 < len(self.stages) else None
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    # Let sibling workers see the end marker too; the last
+                    # one out closes the next queue.
+                    self._put(inbox, _DONE)
+                    with lock:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last:
+                        self._put(outbox, _DONE)
+                    return
+                with stats._lock:
+                    stats.items_in += 1
+                t0 = time.monotonic()
+                results = list(stage.fn(item))
+                with stats._lock:
+                    stats.busy_s += time.monotonic() - t0
+                for result in results:
+                    self._put(outbox, result, out_stats)
+                    with stats._lock:
+                        stats.items_out += 1
+        except _Stopped:
+            pass
+        except BaseException as e:
+            logger.error("Pipeline stage %s failed: %s", stage.name, e)
+            self._fail(e)
+
+    def _log(self, started: float, final: bool = False) -> None:
+        elapsed = time.monotonic() - started
+        for q, stats in zip(self._queues, self.stats):
+            stats.depth = q.qsize()
+        logger.info(
+            "Pipeline %s after %.1fs:\n  %s",
+            "finished" if final else "progress",
+            elapsed,
+            "\n  ".join(s.line(elapsed) for s in self.stats),
+        )
+
+    def run(self) -> list[Any]:
+        started = time.monotonic()
+        threads = [threading.Thread(target=self._feed, name="pipeline-source", daemon=True)]
+        for i, stage in enumerate(self.stages):
+            remaining, lock = [max(1, stage.workers)], threading.Lock()
+            for w in range(remaining[0]):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(i, remaining, lock),
+                    name=f"pipeline-{stage.name}-{w}",
+                    daemon=True,
+                ))
+        for t in threads:
+            t.start()
+
+        results = []
+        next_report = started + self.report_every_s
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = self._out.get(timeout=_POLL_S)
+                except queue.Empty:
+                    item = None
+                if item is _DONE:
+                    break
+                if item is not None:
+                    results.append(item)
+                if self.report_every_s and time.monotonic() >= next_report:
+                    self._log(started)
+                    next_report = time.monotonic() + self.report_every_s
+        finally:
+            self._stop.set()
+            for t in threads:
+                t.join()
+
+        self._log(started, final=True)
+        if self._error is not None:
+            raise self._error
+        return results
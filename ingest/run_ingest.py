@@ -1,16 +1,195 @@
+import argparse
+import logging
+import threading
+from dataclasses import dataclass, field
+
 from dotenv import load_dotenv
 
-from ingest.blob_loader import load_documents
+from config.settings import get_settings
+from ingest.blob_loader import container_client, iter_blob_documents, supported
 from ingest.chunking import production_chunk_documents
-from ingest.index_azure_search import index_documents
+from ingest.index_azure_search import (
+    apply_document,
+    delete_document,
+    embed_for_index,
+    plan_document,
+)
+from ingest.pipeline import Pipeline, Stage
+from ingest.state_store import DocState, delete_states, list_states, save_states
+from rag import telemetry
+from rag.vector_store import get_vector_store
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IngestPlan:
+    new: list = field(default_factory=list)
+    changed: list = field(default_factory=list)
+    unchanged: list = field(default_factory=list)
+    removed: list[DocState] = field(default_factory=list)
+    states: dict[str, DocState] = field(default_factory=dict, repr=False)
+
+    @property
+    def to_process(self) -> list:
+        return self.new + self.changed
+
+    def describe(self) -> str:
+        lines = [
+            f"new: {len(self.new)}, changed: {len(self.changed)}, "
+            f"unchanged: {len(self.unchanged)}, removed: {len(self.removed)}"
+        ]
+        lines += [f"  + {b.name}" for b in self.new]
+        lines += [f"  ~ {b.name}" for b in self.changed]
+        lines += [f"  - {st.doc_id} ({st.chunk_count} chunks)" for st in self.removed]
+        return "\n".join(lines)
+
+
+def _etag(blob) -> str:
+    return str(blob.etag or "")
+
+
+def plan_ingest(container, *, incremental: bool = True) -> IngestPlan:
+    states = list_states(container)
+    listed = [b for b in container.list_blobs() if supported(b.name)]
+
+    plan = IngestPlan()
+    for blob in listed:
+        prev = states.get(blob.name)
+        if prev is None:
+            plan.new.append(blob)
+        elif not incremental or prev.etag != _etag(blob):
+            plan.changed.append(blob)
+        else:
+            plan.unchanged.append(blob)
+
+    names = {b.name for b in listed}
+    plan.removed = [st for doc_id, st in states.items() if doc_id not in names]
+    plan.states = states
+    return plan
+
+
+def _chunker(states: dict[str, DocState], workers: int, min_parallel_chars: int):
+    def chunk(item):
+        blob_name, docs = item
+        chunks = production_chunk_documents(
+            docs, workers=workers, min_parallel_chars=min_parallel_chars)
+        yield blob_name, chunks, plan_document(blob_name, chunks, states.get(blob_name))
 
+    return chunk
 
-def run():
+
+def _embed(item):
+    blob_name, chunks, diff = item
+    to_embed = [chunks[i] for i in diff.upload]
+    yield blob_name, chunks, diff, embed_for_index(to_embed) if to_embed else []
+
+
+class _StateWriter:
+    # Every save rewrites whole manifest shards, so the states of indexed
+    # documents are saved in batches and once more when the run ends.
+    def __init__(self, container, batch_size: int):
+        self.container = container
+        self.batch_size = max(1, batch_size)
+        self._pending: list[DocState] = []
+        self._lock = threading.Lock()
+
+    def add(self, state: DocState) -> None:
+        with self._lock:
+            self._pending.append(state)
+            if len(self._pending) < self.batch_size:
+                return
+            batch, self._pending = self._pending, []
+        save_states(self.container, batch)
+
+    def flush(self) -> None:
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            save_states(self.container, batch)
+
+
+def _uploader(states: _StateWriter, etags: dict[str, str]):
+    def upload(item):
+        blob_name, chunks, diff, vectors = item
+        states.add(apply_document(diff, chunks, vectors, etag=etags[blob_name]))
+        yield blob_name, len(diff.upload)
+
+    return upload
+
+
+def run(*, incremental: bool = False, dry_run: bool = False):
     load_dotenv()
-    docs = load_documents()
-    chunks = production_chunk_documents(docs)
-    index_documents(chunks)
+    s = get_settings()
+    container = container_client()
+
+    plan = plan_ingest(container, incremental=incremental)
+    if dry_run:
+        print(plan.describe())
+        return plan
+
+    removed = []
+    try:
+        for st in plan.removed:
+            count = delete_document(st.doc_id)
+            removed.append(st.doc_id)
+            logger.info("Removed vanished blob %s (%d chunks)", st.doc_id, count)
+    finally:
+        if removed:
+            delete_states(container, removed)
+
+    if not plan.to_process:
+        logger.info("Nothing to ingest")
+        return plan
+
+    # Build the shared store before worker threads race on its lru_cache.
+    get_vector_store()
+
+    source = iter_blob_documents(
+        container,
+        blobs=plan.to_process,
+        max_workers=s.ingest_download_workers,
+        max_bytes_in_flight=s.ingest_max_inflight_mb * 1024 * 1024,
+    )
+    states = _StateWriter(container, s.ingest_state_batch)
+    pipeline = Pipeline(
+        source,
+        [
+            Stage("chunk", _chunker(plan.states, s.chunk_workers, s.chunk_parallel_min_chars),
+                  workers=s.ingest_chunk_workers,
+                  queue_size=s.ingest_queue_size),
+            Stage("embed", _embed, workers=s.ingest_embed_workers,
+                  queue_size=s.ingest_queue_size),
+            Stage("index", _uploader(states, {b.name: _etag(b) for b in plan.to_process}),
+                  workers=s.ingest_index_workers, queue_size=s.ingest_queue_size),
+        ],
+        report_every_s=s.ingest_report_every_s,
+    )
+    try:
+        indexed = pipeline.run()
+    finally:
+        # Documents indexed before a failure keep their state.
+        states.flush()
+    logger.info("Uploaded %d new chunks from %d blobs",
+                sum(n for _, n in indexed), len(indexed))
+    return plan
 
 
 if __name__ == "__main__":
-    run()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Ingest the blob container into the index.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process blobs whose ETag differs from the stored state")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the ingest plan without changing anything")
+    parser.add_argument("--metrics-out",
+                        help="write span histograms here in Prometheus text format "
+                             "(needs RAG_TELEMETRY=1)")
+    args = parser.parse_args()
+    telemetry.install_log_formatter()
+    run(incremental=args.incremental, dry_run=args.dry_run)
+    telemetry.flush()
+    if args.metrics_out and telemetry.enabled():
+        with open(args.metrics_out, "w", encoding="utf-8") as f:
+            f.write(telemetry.prometheus_text())
@@ -1,17 +1,31 @@
 from __future__ import annotations
 
 import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from hashlib import sha256
 
+from rag import telemetry
+
+
+logger = logging.getLogger(__name__)
+
+# Fixed so a doc_id always routes to the same shard blob.
+_SHARDS = 16
+_MAX_WRITE_ATTEMPTS = 10
+
 
 @dataclass(frozen=True)
 class DocState:
     doc_id: str
     etag: str
     chunk_count: int
+    chunk_hashes: tuple[str, ...] = ()
 
 
 def _prefix() -> str:
@@ -20,41 +34,320 @@ def _prefix() -> str:
     return v or "_rag_state"
 
 
-def _name(doc_id: str) -> str:
-    h = sha256(doc_id.encode("utf-8")).hexdigest()
-    return f"{_prefix()}/{h}.json"
+def _cache_ttl_s() -> float:
+    try:
+        return float(os.environ.get("RAG_STATE_CACHE_TTL", "5"))
+    except ValueError:
+        return 5.0
 
 
-def load_state(container_client, doc_id: str) -> DocState | None:
-    blob = container_client.get_blob_client(_name(doc_id))
+def _shard_of(doc_id: str) -> int:
+    return int(sha256(doc_id.encode("utf-8")).hexdigest()[:8], 16) % _SHARDS
+
+
+def _shard_name(shard: int) -> str:
+    return f"{_prefix()}/manifest/{shard:03d}.jsonl"
+
+
+def _state_from(data: dict, doc_id: str = "") -> DocState:
+    return DocState(
+        doc_id=str(data.get("doc_id") or doc_id),
+        etag=str(data.get("etag") or ""),
+        chunk_count=int(data.get("chunk_count") or 0),
+        chunk_hashes=tuple(data.get("chunk_hashes") or ()),
+    )
+
+
+def _record(state: DocState) -> dict:
+    return {
+        "doc_id": state.doc_id,
+        "etag": state.etag,
+        "chunk_count": int(state.chunk_count),
+        "chunk_hashes": list(state.chunk_hashes),
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _parse_shard(raw: bytes) -> dict[str, DocState]:
+    # One JSON record per line; later lines win and tombstones drop the
+    # document, so a shard can be appended to and compacted on rewrite.
+    docs: dict[str, DocState] = {}
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        doc_id = str(data.get("doc_id") or "")
+        if not doc_id:
+            continue
+        if data.get("deleted"):
+            docs.pop(doc_id, None)
+        else:
+            docs[doc_id] = _state_from(data)
+    return docs
+
+
+def _dump_shard(docs: dict[str, DocState]) -> bytes:
+    return "".join(
+        json.dumps(_record(st), ensure_ascii=False) + "\n"
+        for _, st in sorted(docs.items())
+    ).encode("utf-8")
+
+
+class _Shard:
+    __slots__ = ("etag", "docs", "checked_at")
+
+    def __init__(self, etag: str | None, docs: dict[str, DocState], checked_at: float):
+        self.etag = etag
+        self.docs = docs
+        self.checked_at = checked_at
+
+
+class StateManifest:
+    def __init__(self, container_client, *, cache_ttl_s: float = 5.0):
+        self.container = container_client
+        self.cache_ttl_s = cache_ttl_s
+        self._shards: dict[int, _Shard] = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, shard: int, cached: _Shard | None) -> _Shard:
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
+
+        blob = self.container.get_blob_client(_shard_name(shard))
+        now = time.monotonic()
+        try:
+            if cached is not None and cached.etag:
+                stream = blob.download_blob(
+                    etag=cached.etag, match_condition=MatchConditions.IfModified)
+            else:
+                stream = blob.download_blob()
+            raw = stream.readall()
+        except ResourceNotModifiedError:
+            cached.checked_at = now
+            return cached
+        except ResourceNotFoundError:
+            return _Shard(None, {}, now)
+        return _Shard(str(stream.properties.etag), _parse_shard(raw), now)
+
+    def _shard(self, shard: int, *, fresh: bool = False) -> _Shard:
+        with self._lock:
+            cached = self._shards.get(shard)
+        if (
+            cached is not None
+            and not fresh
+            and time.monotonic() - cached.checked_at < self.cache_ttl_s
+        ):
+            return cached
+        loaded = self._fetch(shard, cached)
+        with self._lock:
+            self._shards[shard] = loaded
+        return loaded
+
+    def get(self, doc_id: str) -> DocState | None:
+        return self._shard(_shard_of(doc_id)).docs.get(doc_id)
+
+    def all(self, *, max_workers: int = _SHARDS) -> dict[str, DocState]:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            shards = list(pool.map(self._shard, range(_SHARDS)))
+        return {doc_id: st for s in shards for doc_id, st in s.docs.items()}
+
+    def exists(self) -> bool:
+        prefix = f"{_prefix()}/manifest/"
+        return any(True for _ in self.container.list_blobs(name_starts_with=prefix))
+
+    def update(self, changes: dict[str, DocState | None]) -> None:
+        by_shard: dict[int, dict[str, DocState | None]] = {}
+        for doc_id, state in changes.items():
+            by_shard.setdefault(_shard_of(doc_id), {})[doc_id] = state
+        with telemetry.span("save_state", documents=len(changes), shards=len(by_shard)):
+            for shard, shard_changes in by_shard.items():
+                self._write(shard, shard_changes)
+
+    def _write(self, shard: int, changes: dict[str, DocState | None]) -> None:
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+        blob = self.container.get_blob_client(_shard_name(shard))
+        current = self._shard(shard)
+        for _ in range(_MAX_WRITE_ATTEMPTS):
+            docs = dict(current.docs)
+            for doc_id, state in changes.items():
+                if state is None:
+                    docs.pop(doc_id, None)
+                else:
+                    docs[doc_id] = state
+            try:
+                if current.etag:
+                    result = blob.upload_blob(
+                        _dump_shard(docs),
+                        overwrite=True,
+                        etag=current.etag,
+                        match_condition=MatchConditions.IfNotModified,
+                        content_type="application/x-ndjson",
+                    )
+                else:
+                    result = blob.upload_blob(
+                        _dump_shard(docs),
+                        overwrite=False,
+                        content_type="application/x-ndjson",
+                    )
+            except (ResourceModifiedError, ResourceExistsError):
+                # Someone else wrote the shard since we read it; merge our
+                # changes into the new version and try again.
+                current = self._shard(shard, fresh=True)
+                continue
+            with self._lock:
+                self._shards[shard] = _Shard(
+                    str(result.get("etag") or ""), docs, time.monotonic())
+            return
+        raise RuntimeError(f"Could not update state shard {shard}: too many concurrent writers")
+
+
+def _sequencer_name(doc_id: str) -> str:
+    return f"{_prefix()}/sequencers/{sha256(doc_id.encode('utf-8')).hexdigest()}"
+
+
+def record_sequencer(container_client, doc_id: str, sequencer: str) -> str:
+    # Keeps the newest blob event sequencer any instance has seen for the
+    # document and returns it. Sequencers of one blob compare as strings.
+    from azure.core import MatchConditions
+    from azure.core.exceptions import (
+        ResourceExistsError, ResourceModifiedError, ResourceNotFoundError)
+
+    blob = container_client.get_blob_client(_sequencer_name(doc_id))
+    for _ in range(_MAX_WRITE_ATTEMPTS):
+        try:
+            stream = blob.download_blob()
+            latest, etag = stream.readall().decode("utf-8"), str(stream.properties.etag)
+        except ResourceNotFoundError:
+            latest, etag = "", None
+        if latest >= sequencer:
+            return latest
+        try:
+            if etag:
+                blob.upload_blob(sequencer.encode("utf-8"), overwrite=True, etag=etag,
+                                 match_condition=MatchConditions.IfNotModified)
+            else:
+                blob.upload_blob(sequencer.encode("utf-8"), overwrite=False)
+        except (ResourceModifiedError, ResourceExistsError):
+            continue
+        return sequencer
+    raise RuntimeError(f"Could not record the event sequencer of {doc_id}: too many concurrent writers")
+
+
+def latest_sequencer(container_client, doc_id: str) -> str:
+    from azure.core.exceptions import ResourceNotFoundError
+
     try:
-        data = json.loads(blob.download_blob().readall())
-        return DocState(
-            doc_id=str(data.get("doc_id") or doc_id),
-            etag=str(data.get("etag") or ""),
-            chunk_count=int(data.get("chunk_count") or 0),
-        )
+        return container_client.get_blob_client(
+            _sequencer_name(doc_id)).download_blob().readall().decode("utf-8")
+    except ResourceNotFoundError:
+        return ""
+
+
+def _legacy_names(container_client) -> list[str]:
+    prefix = f"{_prefix()}/"
+    return [
+        b.name
+        for b in container_client.list_blobs(name_starts_with=prefix)
+        if "/" not in b.name[len(prefix):] and b.name.endswith(".json")
+    ]
+
+
+def _read_legacy(container_client, blob_name: str) -> DocState | None:
+    blob = container_client.get_blob_client(blob_name)
+    try:
+        return _state_from(json.loads(blob.download_blob().readall()))
     except Exception:
         return None
 
 
+def migrate_legacy_states(
+    container_client, *, delete_legacy: bool = False, max_workers: int = 16
+) -> int:
+    names = _legacy_names(container_client)
+    if not names:
+        return 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        states = [st for st in pool.map(
+            lambda n: _read_legacy(container_client, n), names) if st and st.doc_id]
+
+    manifest = _manifest(container_client)
+    known = manifest.all()
+    # States already in the manifest are newer than their legacy copies.
+    manifest.update({st.doc_id: st for st in states if st.doc_id not in known})
+
+    if delete_legacy:
+        for name in names:
+            try:
+                container_client.get_blob_client(name).delete_blob()
+            except Exception:
+                pass
+    logger.info("Migrated %d legacy state blobs into the manifest", len(states))
+    return len(states)
+
+
+_manifests: dict[tuple[str, str], StateManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def _manifest(container_client) -> StateManifest:
+    key = (getattr(container_client, "url", "") or container_client.container_name, _prefix())
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = StateManifest(container_client, cache_ttl_s=_cache_ttl_s())
+            _manifests[key] = manifest
+            created = True
+        else:
+            created = False
+    if created and not manifest.exists():
+        migrate_legacy_states(container_client)
+    return manifest
+
+
+def load_state(container_client, doc_id: str) -> DocState | None:
+    try:
+        return _manifest(container_client).get(doc_id)
+    except Exception as e:
+        logger.warning("Could not load state for %s: %s", doc_id, e)
+        return None
+
+
+def list_states(container_client) -> dict[str, DocState]:
+    return _manifest(container_client).all()
+
+
 def save_state(container_client, state: DocState) -> None:
-    blob = container_client.get_blob_client(_name(state.doc_id))
-    payload = json.dumps(
-        {
-            "doc_id": state.doc_id,
-            "etag": state.etag,
-            "chunk_count": int(state.chunk_count),
-            "updated_at": datetime.now(timezone.utc).isoformat(),
-        },
-        ensure_ascii=False,
-    ).encode("utf-8")
-    blob.upload_blob(payload, overwrite=True, content_type="application/json")
+    _manifest(container_client).update({state.doc_id: state})
+
+
+def save_states(container_client, states: list[DocState]) -> None:
+    _manifest(container_client).update({st.doc_id: st for st in states})
 
 
 def delete_state(container_client, doc_id: str) -> None:
-    blob = container_client.get_blob_client(_name(doc_id))
-    try:
-        blob.delete_blob()
-    except Exception:
-        return
+    _manifest(container_client).update({doc_id: None})
+
+
+def delete_states(container_client, doc_ids: list[str]) -> None:
+    _manifest(container_client).update(dict.fromkeys(doc_ids))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+
+    from ingest.blob_loader import container_client
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the ingest state manifest.")
+    parser.add_argument("--migrate", action="store_true",
+                        help="copy per-document state blobs into the manifest")
+    parser.add_argument("--delete-legacy", action="store_true",
+                        help="delete per-document state blobs after migrating")
+    args = parser.parse_args()
+    if args.migrate:
+        migrate_legacy_states(container_client(), delete_legacy=args.delete_legacy)
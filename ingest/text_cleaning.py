@@ -3,7 +3,6 @@ from __future__ import annotations
 import re
 
 
-_MANY_NEWLINES = re.compile(r"\n{3,}")
 _MANY_SPACES = re.compile(r"[\t\u00A0 ]{2,}")
 
 _DEHYPHENATE = re.compile(r"(?i)(?<=\w)-\n(?=\w)")
@@ -27,152 +26,146 @@ def _looks_like_heading(line: str) -> bool:
     return False
 
 
-def normalize_extracted_text(text: str) -> str:
-    if not text:
-        return ""
+def _can_append_suffix(prev: str, suffix: str) -> bool:
+    if not prev or not suffix:
+        return False
+    if not prev[-1].isalpha():
+        return False
+    if prev.endswith((".", "?", "!", ":")):
+        return False
+    if _BULLET_LINE.match(prev):
+        return False
+    return True
 
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-    text = text.replace("\u00A0", " ")
 
-    text = _DEHYPHENATE.sub("", text)
+def _is_structural(line: str) -> bool:
+    return bool(_BULLET_LINE.match(line) or _NUMBERED_LINE.match(line) or _looks_like_heading(line))
 
-    text = _MANY_NEWLINES.sub("\n\n", text)
-
-    split_lines = text.split("\n")
-    raw_lines: list[str] = []
-    whitespace_only: list[bool] = []
-    for ln in split_lines:
-        stripped = ln.strip()
-        raw_lines.append(stripped)
-        whitespace_only.append((ln != "") and (stripped == ""))
-
-    def can_append_suffix(prev: str, suffix: str) -> bool:
-        if not prev or not suffix:
-            return False
-        if not prev[-1].isalpha():
-            return False
-        if prev.endswith((".", "?", "!", ":")):
-            return False
-        if _BULLET_LINE.match(prev):
-            return False
-        return True
 
-    def is_single_letter_alpha(line: str) -> bool:
-        return len(line) == 1 and line.isalpha()
+def _collapse_spaces(line: str) -> str:
+    if "  " in line or "\t" in line:
+        return _MANY_SPACES.sub(" ", line)
+    return line
 
-    def is_short_alpha_suffix(line: str) -> bool:
-        return 2 <= len(line) <= 4 and line.isalpha() and line.islower()
 
+def _join_lines(raw: list[str]) -> list[str]:
+    # Re-attaches letters and short suffixes that PDF extraction split onto
+    # their own lines. Runs of blank lines are kept as a single "", which
+    # every later step treats the same as a longer run; that keeps the
+    # look-behind for the last non-empty line O(1).
     lines: list[str] = []
+    n = len(raw)
     i = 0
-    while i < len(raw_lines):
-        ln = raw_lines[i]
+    while i < n:
+        ln = raw[i].strip()
 
         if ln == "":
-            if whitespace_only[i]:
-                lines.append("")
-            else:
+            if not lines or lines[-1] != "":
                 lines.append("")
             i += 1
             continue
 
-        if is_single_letter_alpha(ln):
-            letters: list[str] = [ln]
+        if len(ln) == 1 and ln.isalpha():
+            letters = [ln]
             j = i + 1
-            while j < len(raw_lines):
-                if raw_lines[j] == "":
-                    if whitespace_only[j]:
+            while j < n:
+                nxt = raw[j].strip()
+                if nxt == "":
+                    if raw[j] != "":
                         break
                     j += 1
                     continue
-                if is_single_letter_alpha(raw_lines[j]):
-                    letters.append(raw_lines[j])
+                if len(nxt) == 1 and nxt.isalpha():
+                    letters.append(nxt)
                     j += 1
                     continue
                 break
 
             word = "".join(letters)
 
-            attach_idx = None
-            if len(word) <= 2 and word.islower() and lines:
-                k = len(lines) - 1
-                while k >= 0 and lines[k] == "":
-                    k -= 1
-                if k >= 0 and " " not in lines[k] and can_append_suffix(lines[k], word):
-                    attach_idx = k
-
-            if attach_idx is not None:
-                while len(lines) - 1 > attach_idx and lines[-1] == "":
-                    lines.pop()
-                lines[attach_idx] = f"{lines[attach_idx]}{word}"
+            k = len(lines) - 1
+            if k >= 0 and lines[k] == "":
+                k -= 1
+            if (
+                len(word) <= 2
+                and word.islower()
+                and k >= 0
+                and " " not in lines[k]
+                and _can_append_suffix(lines[k], word)
+            ):
+                del lines[k + 1:]
+                lines[k] = f"{lines[k]}{word}"
             else:
                 lines.append(word)
 
             i = j
             continue
 
-        if is_short_alpha_suffix(ln) and lines and lines[-1] != "" and can_append_suffix(lines[-1], ln) and lines[-1][-1].islower():
+        if (
+            2 <= len(ln) <= 4
+            and ln.isalpha()
+            and ln.islower()
+            and lines
+            and lines[-1] != ""
+            and _can_append_suffix(lines[-1], ln)
+            and lines[-1][-1].islower()
+        ):
             lines[-1] = f"{lines[-1]}{ln}"
-            i += 1
-            continue
-
-        lines.append(ln)
+        else:
+            lines.append(ln)
         i += 1
+    return lines
 
-    out_lines: list[str] = []
-    paragraph: list[str] = []
 
-    def is_structural(line: str) -> bool:
-        return bool(_BULLET_LINE.match(line) or _NUMBERED_LINE.match(line) or _looks_like_heading(line))
-
-    def flush_paragraph() -> None:
-        nonlocal paragraph
-        if not paragraph:
-            return
-        merged = " ".join(paragraph).strip()
-        merged = _MANY_SPACES.sub(" ", merged)
-        out_lines.append(merged)
-        paragraph = []
-
-    def next_non_empty(start: int) -> str:
-        for k in range(start, len(lines)):
-            if lines[k] != "":
-                return lines[k]
+def normalize_extracted_text(text: str) -> str:
+    # Linear in the input: the replacements and de-hyphenation are single
+    # regex/C passes, and both line passes only ever look one line back or
+    # ahead. Output is byte-identical to the earlier multi-pass version;
+    # benchmarks/bench_text_cleaning.py checks it against a golden corpus.
+    if not text:
         return ""
 
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = text.replace("\u00A0", " ")
+    text = _DEHYPHENATE.sub("", text)
+
+    lines = _join_lines(text.split("\n"))
+
+    out_lines: list[str] = []
+    paragraph: list[str] = []
+    last = len(lines) - 1
+
     for idx, ln in enumerate(lines):
         if ln == "":
             prev = paragraph[-1] if paragraph else (
                 out_lines[-1] if out_lines else "")
-            nxt = next_non_empty(idx + 1)
-
-            hard_break = False
             if not prev:
-                hard_break = False
-            elif prev.endswith((".", "?", "!", ":")):
-                hard_break = True
-            elif is_structural(prev) or is_structural(nxt):
-                hard_break = True
-            elif len(prev) >= 80:
-                hard_break = True
-
-            if hard_break:
-                flush_paragraph()
-                if out_lines and out_lines[-1] != "":
+                continue
+            nxt = lines[idx + 1] if idx < last else ""
+            if (
+                prev.endswith((".", "?", "!", ":"))
+                or _is_structural(prev)
+                or _is_structural(nxt)
+                or len(prev) >= 80
+            ):
+                if paragraph:
+                    out_lines.append(" ".join(paragraph))
+                    paragraph = []
+                if out_lines[-1] != "":
                     out_lines.append("")
             continue
 
-        ln = _MANY_SPACES.sub(" ", ln)
-        if is_structural(ln):
-            flush_paragraph()
+        ln = _collapse_spaces(ln)
+        if _is_structural(ln):
+            if paragraph:
+                out_lines.append(" ".join(paragraph))
+                paragraph = []
             out_lines.append(ln)
         else:
             paragraph.append(ln)
 
-    flush_paragraph()
-
-    text = "\n".join(out_lines)
-    text = _MANY_NEWLINES.sub("\n\n", text)
-    text = _MANY_SPACES.sub(" ", text)
-
-    return text.strip()
+    if paragraph:
+        out_lines.append(" ".join(paragraph))
+    if out_lines and out_lines[-1] == "":
+        out_lines.pop()
+    return "\n".join(out_lines)
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable
+
+import numpy as np
+
+from config.settings import get_settings
+
+
+@dataclass
+class _Entry:
+    answer: str
+    doc_etags: dict[str, str]
+    created_at: float
+    last_used: float
+
+
+def _doc_id(doc) -> str:
+    md = doc.metadata or {}
+    return str(md.get("doc_id") or md.get("source_path") or md.get("blob_name") or "")
+
+
+class _EtagView:
+    # Re-reading state for every cache hit would cost a blob GET per cited
+    # document, so current ETags are memoised for a short interval. Entries
+    # are kept in the order they were looked up, so expired ones are dropped
+    # from the front; at most `max_entries` are kept.
+    def __init__(self, lookup: Callable[[str], str | None], ttl_s: float, max_entries: int = 4096):
+        self._lookup = lookup
+        self._ttl_s = ttl_s
+        self._max_entries = max(1, int(max_entries))
+        self._seen: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _memoised(self, doc_id: str, now: float) -> str | None:
+        with self._lock:
+            hit = self._seen.get(doc_id)
+            if hit and now - hit[0] < self._ttl_s:
+                return hit[1]
+        return None
+
+    def _remember(self, doc_id: str, now: float, etag: str | None) -> str:
+        etag = etag or ""
+        with self._lock:
+            self._seen[doc_id] = (now, etag)
+            self._seen.move_to_end(doc_id)
+            while self._seen:
+                oldest, (seen_at, _) = next(iter(self._seen.items()))
+                if len(self._seen) <= self._max_entries and now - seen_at < self._ttl_s:
+                    break
+                del self._seen[oldest]
+        return etag
+
+    def get(self, doc_id: str) -> str:
+        now = time.monotonic()
+        etag = self._memoised(doc_id, now)
+        if etag is not None:
+            return etag
+        return self._remember(doc_id, now, self._lookup(doc_id))
+
+    async def aget_many(self, doc_ids) -> dict[str, str]:
+        # The lookup is a blocking blob GET; on the event loop it runs in
+        # the default executor, all cited documents at once.
+        now = time.monotonic()
+        out = {d: self._memoised(d, now) for d in doc_ids}
+        missing = [d for d, etag in out.items() if etag is None]
+        if missing:
+            loop = asyncio.get_running_loop()
+            found = await asyncio.gather(
+                *(loop.run_in_executor(None, self._lookup, d) for d in missing))
+            for d, etag in zip(missing, found):
+                out[d] = self._remember(d, now, etag)
+        return out
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        *,
+        threshold: float,
+        ttl_s: float,
+        max_entries: int,
+        etag_lookup: Callable[[str], str | None],
+        etag_ttl_s: float = 30.0,
+    ):
+        self.threshold = float(threshold)
+        self.ttl_s = float(ttl_s)
+        self.max_entries = max(1, int(max_entries))
+        self._etags = _EtagView(etag_lookup, etag_ttl_s)
+        self._matrix: np.ndarray | None = None
+        self._slots: list[_Entry | None] = [None] * self.max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray | None:
+        v = np.asarray(vector, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        if n == 0.0:
+            return None
+        return v / n
+
+    def _pick(self, vector) -> tuple[int, _Entry] | None:
+        q = self._unit(vector)
+        with self._lock:
+            if q is None or self._matrix is None or self._matrix.shape[1] != q.shape[0]:
+                return None
+            scores = self._matrix @ q
+            candidates = np.flatnonzero(scores >= self.threshold)
+            order = candidates[np.argsort(-scores[candidates])]
+            now = time.time()
+            for slot in order:
+                entry = self._slots[slot]
+                if entry is None:
+                    continue
+                if now - entry.created_at > self.ttl_s:
+                    self._evict(slot)
+                    continue
+                return slot, entry
+        return None
+
+    def _settle(self, picked, etags: dict[str, str] | None) -> str | None:
+        # A hit only counts while every cited document is unchanged.
+        with self._lock:
+            if picked is not None:
+                slot, entry = picked
+                if all(etags[d] == e for d, e in entry.doc_etags.items()):
+                    entry.last_used = time.time()
+                    self.hits += 1
+                    return entry.answer
+                if self._slots[slot] is entry:
+                    self._evict(slot)
+            self.misses += 1
+        return None
+
+    def get(self, vector) -> str | None:
+        picked = self._pick(vector)
+        etags = None
+        if picked is not None:
+            etags = {d: self._etags.get(d) for d in picked[1].doc_etags}
+        return self._settle(picked, etags)
+
+    async def aget(self, vector) -> str | None:
+        picked = self._pick(vector)
+        etags = None
+        if picked is not None:
+            etags = await self._etags.aget_many(picked[1].doc_etags)
+        return self._settle(picked, etags)
+
+    @staticmethod
+    def _cited(docs) -> list[str]:
+        return sorted({d for d in (_doc_id(doc) for doc in docs or []) if d})
+
+    def put(self, vector, answer: str, docs) -> None:
+        doc_ids = self._cited(docs)
+        if not doc_ids or not answer:
+            return
+        self._store(vector, answer, {d: self._etags.get(d) for d in doc_ids})
+
+    async def aput(self, vector, answer: str, docs) -> None:
+        doc_ids = self._cited(docs)
+        if not doc_ids or not answer:
+            return
+        self._store(vector, answer, await self._etags.aget_many(doc_ids))
+
+    def _store(self, vector, answer: str, doc_etags: dict[str, str]) -> None:
+        q = self._unit(vector)
+        if q is None:
+            return
+        now = time.time()
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != q.shape[0]:
+                self._matrix = np.zeros((self.max_entries, q.shape[0]), dtype=np.float32)
+                self._slots = [None] * self.max_entries
+            slot = self._free_slot()
+            self._matrix[slot] = q
+            self._slots[slot] = _Entry(
+                answer=answer, doc_etags=doc_etags, created_at=now, last_used=now)
+
+    def _free_slot(self) -> int:
+        oldest, oldest_used = 0, float("inf")
+        for i, entry in enumerate(self._slots):
+            if entry is None:
+                return i
+            if entry.last_used < oldest_used:
+                oldest, oldest_used = i, entry.last_used
+        return oldest
+
+    def _evict(self, slot: int) -> None:
+        self._slots[slot] = None
+        if self._matrix is not None:
+            self._matrix[slot] = 0.0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": sum(1 for e in self._slots if e is not None),
+            }
+
+
+def _state_store_etag_lookup() -> Callable[[str], str | None]:
+    from azure.storage.blob import ContainerClient
+
+    from ingest.state_store import load_state
+
+    s = get_settings()
+    container = ContainerClient.from_connection_string(
+        conn_str=s.azure_storage_connection_string,
+        container_name=s.azure_storage_container,
+    )
+
+    def lookup(doc_id: str) -> str | None:
+        state = load_state(container, doc_id)
+        return state.etag if state else None
+
+    return lookup
+
+
+@lru_cache(maxsize=1)
+def get_answer_cache() -> SemanticAnswerCache:
+    s = get_settings()
+    return SemanticAnswerCache(
+        threshold=s.answer_cache_threshold,
+        ttl_s=s.answer_cache_ttl_s,
+        max_entries=s.answer_cache_max_entries,
+        etag_lookup=_state_store_etag_lookup(),
+        etag_ttl_s=s.answer_cache_etag_ttl_s,
+    )
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from rag.relevance_gate import FEATURES, GateModel
+
+
+def load_log(paths: list[str], modes: set[str] | None = None) -> tuple[np.ndarray, np.ndarray]:
+    rows, labels = [], []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                rec = json.loads(line)
+                if modes and rec.get("mode") not in modes:
+                    continue
+                verdict = str(rec.get("verdict") or "").upper()
+                if verdict not in {"YES", "NO"}:
+                    continue
+                features = rec.get("features") or {}
+                # Rows logged with an older feature set.
+                if any(f not in features for f in FEATURES):
+                    continue
+                rows.append([float(features[f]) for f in FEATURES])
+                labels.append(1.0 if verdict == "YES" else 0.0)
+    return np.asarray(rows, dtype=np.float64).reshape(-1, len(FEATURES)), np.asarray(labels)
+
+
+def fit_logistic(x: np.ndarray, y: np.ndarray, *, l2: float = 1.0, iterations: int = 50):
+    # Newton's method on the L2-regularised log loss; the bias is not
+    # regularised.
+    a = np.hstack([x, np.ones((len(x), 1))])
+    w = np.zeros(a.shape[1])
+    reg = np.full(a.shape[1], l2)
+    reg[-1] = 0.0
+    for _ in range(iterations):
+        p = 1.0 / (1.0 + np.exp(-np.clip(a @ w, -30, 30)))
+        grad = a.T @ (p - y) + reg * w
+        hess = (a * (p * (1 - p))[:, None]).T @ a + np.diag(reg) + 1e-9 * np.eye(a.shape[1])
+        step = np.linalg.solve(hess, grad)
+        w -= step
+        if np.max(np.abs(step)) < 1e-8:
+            break
+    return w[:-1], float(w[-1])
+
+
+def _probabilities(model: GateModel, x: np.ndarray) -> np.ndarray:
+    return np.asarray([model.probability(dict(zip(FEATURES, row))) for row in x])
+
+
+def best_threshold(p: np.ndarray, y: np.ndarray) -> float:
+    candidates = np.unique(np.concatenate([p, [0.5]]))
+    accuracy = [np.mean((p >= t) == (y == 1)) for t in candidates]
+    return float(candidates[int(np.argmax(accuracy))])
+
+
+def uncertainty_band(p: np.ndarray, y: np.ndarray, target: float, threshold: float) -> tuple[float, float]:
+    # hi: the lowest cut whose YES side agrees with the judge at `target`;
+    # lo: the highest cut whose NO side does. Outside (lo, hi) the gate
+    # decides locally.
+    hi, lo = 1.0, 0.0
+    for t in np.unique(p):
+        above = p >= t
+        if np.mean(y[above] == 1) >= target:
+            hi = float(t)
+            break
+    for t in np.unique(p)[::-1]:
+        below = p <= t
+        if np.mean(y[below] == 0) >= target:
+            lo = float(t)
+            break
+    if lo >= hi:
+        lo = hi = threshold
+    return lo, hi
+
+
+def calibrate(x: np.ndarray, y: np.ndarray, *, l2: float, target: float) -> GateModel:
+    weights, bias = fit_logistic(x, y, l2=l2)
+    model = GateModel(weights=tuple(float(w) for w in weights), bias=bias, calibrated=True)
+    p = _probabilities(model, x)
+    threshold = best_threshold(p, y)
+    lo, hi = uncertainty_band(p, y, target, threshold)
+    return GateModel(weights=model.weights, bias=bias, threshold=threshold,
+                     lo=lo, hi=hi, calibrated=True)
+
+
+def evaluate(model: GateModel, x: np.ndarray, y: np.ndarray) -> dict:
+    p = _probabilities(model, x)
+    local = p >= model.threshold
+    sure = (p >= model.hi) | (p <= model.lo)
+    return {
+        "rows": int(len(y)),
+        "local_agreement": round(float(np.mean(local == (y == 1))), 4),
+        "local_false_yes": int(np.sum(local & (y == 0))),
+        "local_false_no": int(np.sum(~local & (y == 1))),
+        "uncertain_decided_locally": round(float(np.mean(sure)), 4),
+        "uncertain_agreement": round(
+            float(np.mean((p[sure] >= model.hi) == (y[sure] == 1))), 4) if sure.any() else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fit the local relevance gate against logged LLM judge decisions.")
+    parser.add_argument("logs", nargs="+", help="judge logs written via RAG_JUDGE_LOG_PATH")
+    parser.add_argument("--out", default=os.environ.get(
+        "RAG_JUDGE_MODEL_PATH", ".rag_cache/relevance_gate.json"))
+    parser.add_argument("--target-agreement", type=float, default=0.98,
+                        help="agreement with the judge required outside the uncertainty band")
+    parser.add_argument("--l2", type=float, default=1.0)
+    parser.add_argument("--holdout", type=float, default=0.2,
+                        help="share of rows held out to report agreement on")
+    parser.add_argument("--mode", action="append",
+                        help="only use rows logged in this judge mode; rows from "
+                             "'llm' mode are an unbiased sample")
+    parser.add_argument("--dry-run", action="store_true", help="report without writing --out")
+    args = parser.parse_args()
+
+    x, y = load_log(args.logs, set(args.mode) if args.mode else None)
+    if len(y) < 20 or y.min() == y.max():
+        print(f"Need at least 20 logged decisions with both verdicts, got {len(y)}.")
+        sys.exit(1)
+    print(f"{len(y)} decisions, {y.mean():.1%} YES")
+
+    order = np.random.default_rng(0).permutation(len(y))
+    n_test = int(len(y) * args.holdout)
+    if n_test >= 10:
+        test, train = order[:n_test], order[n_test:]
+        held = calibrate(x[train], y[train], l2=args.l2, target=args.target_agreement)
+        print("holdout:", json.dumps(evaluate(held, x[test], y[test])))
+
+    model = calibrate(x, y, l2=args.l2, target=args.target_agreement)
+    print("all rows:", json.dumps(evaluate(model, x, y)))
+    print("model:", json.dumps(model.to_dict()))
+    if not args.dry_run:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(model.to_dict(), f, indent=2)
+        print(f"Wrote {args.out}")
@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import logging
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+from rag import telemetry
+from rag.text_pl import stems_pl
+
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n\n"
+
+# Chunk overlaps are 200 characters or 150 tokens; a shared prefix shorter
+# than this is too likely to be a coincidence.
+_MIN_OVERLAP_CHARS = 20
+_MAX_OVERLAP_CHARS = 4000
+# A passage cut mid-sentence to fill less room than this isn't worth adding.
+_MIN_CUT_TOKENS = 32
+# A sentence ends at terminal punctuation, a blank line or a list item.
+_SENTENCE = re.compile(r".+?(?:[.!?]+(?=\s)|\n\s*\n|\n(?=\s*(?:[-•]|\d+\.)\s)|$)", re.S)
+
+
+@dataclass(frozen=True)
+class PackedContext:
+    text: str
+    chunks: int
+    passages: int
+    tokens_in: int
+    tokens_out: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_in - self.tokens_out
+
+
+@dataclass
+class _Passage:
+    key: str
+    rank: int
+    position: int | None
+    text: str
+
+
+@lru_cache(maxsize=1)
+def token_counter():
+    try:
+        import tiktoken
+
+        enc = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(enc.encode(text, disallowed_special=()))
+    except Exception:
+        # Same Polish-safe over-estimate as the embedding batcher.
+        return lambda text: len(text) // 2 + 1
+
+
+def _doc_key(doc) -> str:
+    md = doc.metadata or {}
+    return str(md.get("doc_id") or md.get("source_path") or md.get("file") or "")
+
+
+def _position(doc) -> int | None:
+    pos = (doc.metadata or {}).get("chunk_position")
+    return pos if isinstance(pos, int) else None
+
+
+def suffix_prefix_overlap(a: str, b: str) -> int:
+    # Length of the longest suffix of `a` that is also a prefix of `b`.
+    probe = b[:_MIN_OVERLAP_CHARS]
+    if len(probe) < _MIN_OVERLAP_CHARS:
+        return 0
+    i = a.find(probe, max(0, len(a) - _MAX_OVERLAP_CHARS))
+    while i >= 0:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(probe, i + 1)
+    return 0
+
+
+_WORD = re.compile(r"\w+")
+_SHINGLE_WORDS = 3
+
+
+def _normalized(text: str) -> str:
+    return " ".join(text.split())
+
+
+def _shingles(text: str) -> set[tuple[str, ...]]:
+    # Runs of consecutive words, digits and stopwords included, so versions
+    # of a passage that differ in an amount or a negation don't match.
+    words = _WORD.findall(text.casefold())
+    n = min(_SHINGLE_WORDS, len(words))
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)} if words else set()
+
+
+def _near_duplicate(shingles: set, kept: list[set], threshold: float) -> bool:
+    for other in kept:
+        small, large = sorted((len(shingles), len(other)))
+        # Jaccard can't reach the threshold when the sizes are too far apart.
+        if not large or small < threshold * large:
+            continue
+        common = len(shingles & other)
+        if common >= threshold * (len(shingles) + len(other) - common):
+            return True
+    return False
+
+
+def _dedupe(docs, threshold: float) -> list[tuple[int, object]]:
+    # Exact duplicates (up to whitespace) are dropped wherever they come
+    # from; near duplicates only within one document, since another
+    # document with almost the same text is usually another version of it.
+    kept: list[tuple[int, object]] = []
+    seen: set[str] = set()
+    shingles: dict[str, list[set]] = {}
+    for rank, d in enumerate(docs):
+        text = _normalized(d.page_content)
+        if not text or text in seen:
+            continue
+        seen.add(text)
+        key = _doc_key(d)
+        if threshold < 1.0 and key:
+            sh = _shingles(text)
+            if _near_duplicate(sh, shingles.get(key, []), threshold):
+                continue
+            shingles.setdefault(key, []).append(sh)
+        kept.append((rank, d))
+    return kept
+
+
+def _merge(ranked) -> list[_Passage]:
+    # Chunks of one document are merged in document order: overlapping
+    # chunks are stitched at the overlap and adjacent ones joined.
+    by_doc: dict[str, list[tuple[int, object]]] = {}
+    for rank, d in ranked:
+        by_doc.setdefault(_doc_key(d), []).append((rank, d))
+
+    passages: list[_Passage] = []
+    for key, items in by_doc.items():
+        if key and all(_position(d) is not None for _, d in items):
+            items.sort(key=lambda item: (_position(item[1]), item[0]))
+        current: _Passage | None = None
+        for rank, d in items:
+            text = d.page_content.strip()
+            pos = _position(d)
+            if current is not None and key:
+                if text in current.text:
+                    current.rank = min(current.rank, rank)
+                    current.position = pos if pos is not None else current.position
+                    continue
+                overlap = suffix_prefix_overlap(current.text, text)
+                adjacent = pos is not None and current.position is not None and pos == current.position + 1
+                if overlap or adjacent:
+                    current.text += text[overlap:] if overlap else "\n" + text
+                    current.rank = min(current.rank, rank)
+                    current.position = pos
+                    continue
+            current = _Passage(key, rank, pos, text)
+            passages.append(current)
+    passages.sort(key=lambda p: p.rank)
+    return passages
+
+
+def _sentences(text: str) -> list[str]:
+    return [s.strip() for s in _SENTENCE.findall(text) if s.strip()]
+
+
+def _relevant_sentences(passages: list[_Passage], question: str) -> list[_Passage]:
+    q = stems_pl(question)
+    if not q:
+        return passages
+    # One shared word is usually the topic of the whole document.
+    min_hits = min(2, len(q))
+    out = []
+    seen: set[str] = set()
+    for p in passages:
+        keep = []
+        for s in _sentences(p.text):
+            if s not in seen and len(q & stems_pl(s)) >= min_hits:
+                seen.add(s)
+                keep.append(s)
+        if keep:
+            out.append(_Passage(p.key, p.rank, p.position, "\n".join(keep)))
+    # With no sentence matching anywhere there is nothing to choose by.
+    return out or passages
+
+
+def _truncate(text: str, budget: int, count) -> str:
+    # The longest prefix within the budget, cut back to a word boundary.
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    head = text[:lo]
+    cut = head.rfind(" ")
+    if lo < len(text) and cut > lo // 2:
+        head = head[:cut]
+    return head.rstrip()
+
+
+def _fit(passages: list[_Passage], budget: int, count) -> list[str]:
+    out: list[str] = []
+    used = 0
+    sep = count(SEPARATOR) if passages else 0
+    for p in passages:
+        room = budget - used - (sep if out else 0)
+        if room <= 0:
+            break
+        if count(p.text) <= room:
+            text = p.text
+        else:
+            # The leading sentences of a passage that overflows, or its
+            # leading tokens when not even the first sentence fits.
+            head: list[str] = []
+            for s in _sentences(p.text):
+                if count("\n".join(head + [s])) > room:
+                    break
+                head.append(s)
+            if head:
+                text = "\n".join(head)
+            elif not out or room >= _MIN_CUT_TOKENS:
+                text = _truncate(p.text, room, count)
+            else:
+                text = ""
+            if not text:
+                continue
+        used += count(text) + (sep if out else 0)
+        out.append(text)
+    return out
+
+
+def pack_context(
+    docs,
+    question: str = "",
+    *,
+    token_budget: int = 0,
+    dedup_jaccard: float = 1.0,
+    sentence_filter: bool = False,
+) -> PackedContext:
+    # Drop-in for joining the retrieved chunks. The most relevant chunks come
+    # first and win when the budget (0 = unlimited) runs out.
+    docs = list(docs)
+    count = token_counter()
+    with telemetry.span("context_packing", chunks=len(docs)) as sp:
+        passages = _merge(_dedupe(docs, dedup_jaccard))
+        if sentence_filter:
+            passages = _relevant_sentences(passages, question)
+        if token_budget > 0:
+            texts = _fit(passages, token_budget, count)
+        else:
+            texts = [p.text for p in passages]
+        text = SEPARATOR.join(texts)
+        packed = PackedContext(
+            text=text,
+            chunks=len(docs),
+            passages=len(texts),
+            tokens_in=count(SEPARATOR.join(d.page_content for d in docs)) if docs else 0,
+            tokens_out=count(text) if text else 0,
+        )
+        sp.set(passages=packed.passages, tokens_in=packed.tokens_in,
+               tokens_out=packed.tokens_out, tokens_saved=packed.tokens_saved)
+    logger.info("Context packed: %d chunks -> %d passages, %d -> %d tokens (%d saved)",
+                packed.chunks, packed.passages, packed.tokens_in, packed.tokens_out,
+                packed.tokens_saved)
+    return packed
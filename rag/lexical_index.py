@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import threading
+from collections import Counter
+from functools import lru_cache
+from hashlib import sha256
+from typing import Any, Hashable
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from config.settings import get_settings
+from rag.segments import SegmentedDir, tail_to_merge
+from rag.text_pl import token_list_pl
+
+
+_RECORDS_FILE = "chunks.jsonl"
+_POSTINGS_FILE = "postings.npz"
+_VOCAB_FILE = "vocab.json"
+
+_TF_MAX = np.iinfo(np.uint16).max
+
+
+def chunk_key(doc: Document) -> str:
+    md = doc.metadata or {}
+    h = md.get("chunk_hash") or sha256(doc.page_content.encode()).hexdigest()
+    return f"{md.get('doc_id') or md.get('source_path') or ''}\x00{h}"
+
+
+def _doc_of(rec: dict) -> str | None:
+    return rec["metadata"].get("doc_id") or rec["metadata"].get("source_path")
+
+
+class _Segment:
+    # Posting lists are stored CSR-style: term t owns
+    # doc_idx[offsets[t]:offsets[t + 1]] and the matching tf entries.
+    def __init__(self, path: str):
+        with open(os.path.join(path, _RECORDS_FILE), encoding="utf-8") as f:
+            self.records = [json.loads(line) for line in f]
+        with open(os.path.join(path, _VOCAB_FILE), encoding="utf-8") as f:
+            self.vocab = {t: i for i, t in enumerate(json.load(f))}
+        with np.load(os.path.join(path, _POSTINGS_FILE)) as data:
+            self.offsets = data["offsets"]
+            self.doc_idx = data["doc_idx"]
+            self.tf = data["tf"]
+            self.doc_len = data["doc_len"]
+
+    @staticmethod
+    def write(path: str, records: list[dict]) -> None:
+        postings: dict[str, list[tuple[int, int]]] = {}
+        doc_len = np.zeros(len(records), dtype=np.float32)
+        for row, rec in enumerate(records):
+            tf = rec["tf"]
+            doc_len[row] = sum(tf.values())
+            for term, count in tf.items():
+                postings.setdefault(term, []).append((row, count))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for i, term in enumerate(terms):
+            offsets[i + 1] = offsets[i] + len(postings[term])
+        doc_idx = np.empty(int(offsets[-1]), dtype=np.int32)
+        tfs = np.empty(int(offsets[-1]), dtype=np.uint16)
+        for i, term in enumerate(terms):
+            rows, counts = zip(*postings[term])
+            doc_idx[offsets[i]:offsets[i + 1]] = rows
+            tfs[offsets[i]:offsets[i + 1]] = np.minimum(counts, _TF_MAX)
+
+        with open(os.path.join(path, _RECORDS_FILE), "w", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        with open(os.path.join(path, _VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        with open(os.path.join(path, _POSTINGS_FILE), "wb") as f:
+            np.savez(f, offsets=offsets, doc_idx=doc_idx, tf=tfs, doc_len=doc_len)
+
+
+class BM25Index:
+    # Chunks live in immutable segments (rag.segments), each with its own
+    # postings: a write adds a segment with the new chunks and marks the
+    # ones it replaces or removes as dead. Term statistics are computed
+    # over the live rows of all segments at query time.
+    def __init__(self, path: str, *, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = float(k1)
+        self.b = float(b)
+        self._dir = SegmentedDir(path, legacy_files=(_POSTINGS_FILE, _RECORDS_FILE, _VOCAB_FILE))
+        self._lock = threading.RLock()
+        self._loaded_version: tuple | None = None
+        self._manifest: dict = {"segments": []}
+        self._segments: dict[str, _Segment] = {}
+        self._alive: dict[str, np.ndarray] = {}
+        self._rows: dict[str, tuple[str, int]] = {}
+        self._n = 0
+        self._avg_len = 1.0
+        self._maybe_reload()
+
+    def _maybe_reload(self) -> None:
+        version = self._dir.version()
+        if version is None or version == self._loaded_version:
+            return
+        for attempt in range(3):
+            manifest = self._dir.manifest()
+            try:
+                segments = {
+                    e["name"]: self._segments.get(e["name"])
+                    or _Segment(self._dir.segment_path(e["name"]))
+                    for e in manifest["segments"]
+                }
+                break
+            except FileNotFoundError:
+                # Collected by a writer between reading the manifest and
+                # the segment; the next manifest no longer lists it.
+                if attempt == 2:
+                    raise
+                version = self._dir.version()
+        alive, rows = {}, {}
+        total_len = 0.0
+        for e in manifest["segments"]:
+            seg = segments[e["name"]]
+            mask = np.ones(len(seg.records), dtype=bool)
+            mask[e.get("dead") or []] = False
+            alive[e["name"]] = mask
+            total_len += float(seg.doc_len[mask].sum())
+            for row in np.flatnonzero(mask):
+                rows[seg.records[row]["id"]] = (e["name"], int(row))
+        self._manifest, self._segments, self._alive, self._rows = manifest, segments, alive, rows
+        self._n = len(rows)
+        self._avg_len = total_len / self._n if self._n else 1.0
+        self._loaded_version = version
+
+    def _write(self, drop: list[tuple[str, int]], records: list[dict]) -> None:
+        # Call with the write lock held and the latest manifest loaded.
+        entries = [{"name": e["name"], "dead": list(e.get("dead") or ())}
+                   for e in self._manifest["segments"]]
+        by_name = {e["name"]: e for e in entries}
+        for name, row in drop:
+            by_name[name]["dead"].append(row)
+        if records:
+            entries.append(self._new_segment(records))
+        entries = [e for e in entries if len(e["dead"]) < len(self._segments[e["name"]].records)]
+
+        live = [len(self._segments[e["name"]].records) - len(e["dead"]) for e in entries]
+        dead = sum(len(e["dead"]) for e in entries)
+        n = len(entries) if dead > sum(live) else tail_to_merge(live)
+        if n > 1:
+            merged = []
+            for e in entries[-n:]:
+                seg = self._segments[e["name"]]
+                dead_rows = set(e["dead"])
+                merged += [r for i, r in enumerate(seg.records) if i not in dead_rows]
+            entries = entries[:-n] + [self._new_segment(merged)]
+        self._dir.publish(entries)
+        self._maybe_reload()
+
+    def _new_segment(self, records: list[dict]) -> dict:
+        name, path = self._dir.new_segment()
+        _Segment.write(path, records)
+        self._segments[name] = _Segment(path)
+        return {"name": name, "dead": []}
+
+    def upsert(self, ids: list[str], docs: list[Document]) -> None:
+        if not docs:
+            return
+        new = [
+            {
+                "id": i,
+                "content": d.page_content,
+                "metadata": d.metadata or {},
+                "tf": dict(Counter(token_list_pl(d.page_content))),
+            }
+            for i, d in zip(ids, docs)
+        ]
+        with self._lock, self._dir.write_lock():
+            self._maybe_reload()
+            self._write([self._rows[i] for i in set(ids) if i in self._rows], new)
+
+    def remove_ids(self, ids: list[str]) -> int:
+        drop = set(ids)
+        if not drop:
+            return 0
+        with self._lock, self._dir.write_lock():
+            self._maybe_reload()
+            rows = [self._rows[i] for i in drop if i in self._rows]
+            if rows:
+                self._write(rows, [])
+            return len(rows)
+
+    def remove_doc(self, doc_id: str) -> int:
+        with self._lock, self._dir.write_lock():
+            self._maybe_reload()
+            rows = [
+                (name, row) for name, row in self._rows.values()
+                if _doc_of(self._segments[name].records[row]) == doc_id
+            ]
+            if rows:
+                self._write(rows, [])
+            return len(rows)
+
+    def search(self, query: str, k: int) -> list[tuple[Document, float]]:
+        with self._lock:
+            self._maybe_reload()
+            n = self._n
+            terms = set(token_list_pl(query))
+            if not n or not terms or k <= 0:
+                return []
+            live = [(self._segments[name], self._alive[name]) for name in self._alive]
+
+            # Document frequencies over the live rows of every segment.
+            df = dict.fromkeys(terms, 0)
+            for seg, alive in live:
+                for t in terms:
+                    i = seg.vocab.get(t)
+                    if i is not None:
+                        df[t] += int(alive[seg.doc_idx[seg.offsets[i]:seg.offsets[i + 1]]].sum())
+            idf = {
+                t: math.log(1.0 + (n - d + 0.5) / (d + 0.5))
+                for t, d in df.items() if d
+            }
+            if not idf:
+                return []
+
+            hits: list[tuple[float, _Segment, int]] = []
+            for seg, alive in live:
+                norm = self.k1 * (1.0 - self.b + self.b * seg.doc_len / self._avg_len)
+                scores = np.zeros(len(seg.records), dtype=np.float32)
+                for t, w in idf.items():
+                    i = seg.vocab.get(t)
+                    if i is None:
+                        continue
+                    lo, hi = seg.offsets[i], seg.offsets[i + 1]
+                    rows = seg.doc_idx[lo:hi]
+                    tf = seg.tf[lo:hi].astype(np.float32)
+                    scores[rows] += w * tf * (self.k1 + 1.0) / (tf + norm[rows])
+                scores[~alive] = 0.0
+                top = np.flatnonzero(scores)
+                if top.size > k:
+                    top = top[np.argpartition(-scores[top], k - 1)[:k]]
+                hits += [(float(scores[row]), seg, int(row)) for row in top]
+
+            hits.sort(key=lambda h: -h[0])
+            return [
+                (
+                    Document(
+                        page_content=seg.records[row]["content"],
+                        metadata=dict(seg.records[row]["metadata"]),
+                    ),
+                    score,
+                )
+                for score, seg, row in hits[:k]
+            ]
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[Hashable]],
+    *,
+    k: int = 60,
+    weights: list[float] | None = None,
+) -> list[tuple[Hashable, float]]:
+    index: dict[Hashable, int] = {}
+    for ranking in rankings:
+        for key in ranking:
+            index.setdefault(key, len(index))
+    if not index:
+        return []
+    scores = np.zeros(len(index), dtype=np.float64)
+    for w, ranking in zip(weights or [1.0] * len(rankings), rankings):
+        if not ranking:
+            continue
+        rows = np.fromiter((index[key] for key in ranking), dtype=np.int64, count=len(ranking))
+        # A key repeated within one ranking only counts at its best rank.
+        rows, first = np.unique(rows, return_index=True)
+        np.add.at(scores, rows, w / (k + first + 1.0))
+    keys = list(index)
+    order = np.argsort(-scores, kind="stable")
+    return [(keys[i], float(scores[i])) for i in order]
+
+
+class HybridRetriever(BaseRetriever):
+    vector_retriever: Any
+    lexical_index: Any
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _fuse(self, vector_docs: list[Document], query: str) -> list[Document]:
+        lexical = self.lexical_index.search(query, self.fetch_k)
+        by_key: dict[str, Document] = {}
+        rankings: list[list[str]] = []
+        for docs in (vector_docs, [d for d, _ in lexical]):
+            ranking = []
+            for d in docs:
+                key = chunk_key(d)
+                by_key.setdefault(key, d)
+                ranking.append(key)
+            rankings.append(ranking)
+        fused = reciprocal_rank_fusion(rankings, k=self.rrf_k)
+        return [by_key[key] for key, _ in fused[:self.k]]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector_docs = self.vector_retriever.invoke(
+            query, config={"callbacks": run_manager.get_child()})
+        return self._fuse(vector_docs, query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        vector_docs = await self.vector_retriever.ainvoke(
+            query, config={"callbacks": run_manager.get_child()})
+        return self._fuse(vector_docs, query)
+
+
+@lru_cache(maxsize=1)
+def get_lexical_index() -> BM25Index | None:
+    s = get_settings()
+    if not s.lexical_index_enabled:
+        return None
+    return BM25Index(s.lexical_index_path)
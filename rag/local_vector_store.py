@@ -0,0 +1,404 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import uuid
+from typing import Any, Callable, Iterable
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from rag.segments import SegmentedDir, tail_to_merge
+
+
+_VECTORS_FILE = "vectors.npy"
+_RECORDS_FILE = "records.jsonl"
+
+# Rows scored per matmul; keeps the temporary score buffer small on huge
+# memory-mapped indexes.
+_SCORE_BLOCK_ROWS = 65536
+
+
+def _unit_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+def _with_scores(hits: list[tuple[Document, float]]) -> list[Document]:
+    # The relevance gate reads the score back from the metadata.
+    for d, score in hits:
+        d.metadata["retrieval_score"] = score
+    return [d for d, _ in hits]
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if scores.shape[-1] <= k:
+        return np.argsort(-scores, axis=-1)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.take_along_axis(scores, part, axis=-1).argsort(axis=-1)[..., ::-1]
+    return np.take_along_axis(part, order, axis=-1)
+
+
+class _IvfIndex:
+    # Inverted-file index over spherical k-means centroids. Queries only
+    # score the rows of the `nprobe` closest clusters.
+    def __init__(self, vectors: np.ndarray, *, iterations: int = 10, sample: int = 20000, seed: int = 0):
+        n = vectors.shape[0]
+        nlist = max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        train = vectors[rng.choice(n, size=min(n, sample), replace=False)]
+        centroids = train[rng.choice(train.shape[0], size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(train @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            empty = np.linalg.norm(sums, axis=1) == 0.0
+            sums[empty] = centroids[empty]
+            centroids = _unit_rows(sums)
+
+        assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, _SCORE_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + _SCORE_BLOCK_ROWS])
+            assign[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=nlist)
+        self.centroids = centroids
+        self.rows = order.astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        probe = _top_k(self.centroids @ query, min(nprobe, self.centroids.shape[0]))
+        return np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+
+
+class _Segment:
+    def __init__(self, path: str):
+        ids, texts, metadatas = [], [], []
+        with open(os.path.join(path, _RECORDS_FILE), encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                ids.append(rec["id"])
+                texts.append(rec["content"])
+                metadatas.append(rec.get("metadata") or {})
+        self.vectors = np.load(os.path.join(path, _VECTORS_FILE), mmap_mode="r")
+        self.ids, self.texts, self.metadatas = ids, texts, metadatas
+
+    @staticmethod
+    def write(path: str, vectors: np.ndarray, ids, texts, metadatas) -> None:
+        with open(os.path.join(path, _RECORDS_FILE), "w", encoding="utf-8") as f:
+            for i, t, m in zip(ids, texts, metadatas):
+                f.write(json.dumps({"id": i, "content": t, "metadata": m},
+                        ensure_ascii=False) + "\n")
+        with open(os.path.join(path, _VECTORS_FILE), "wb") as f:
+            np.save(f, vectors)
+
+
+class LocalVectorStore(VectorStore):
+    # Rows live in immutable segments (rag.segments): a write adds a segment
+    # with the new rows and marks the rows it replaces or deletes as dead,
+    # instead of rewriting the whole store.
+    def __init__(
+        self,
+        path: str,
+        embedding: Embeddings,
+        *,
+        ann_min_rows: int = 50000,
+        ann_nprobe: int = 8,
+    ):
+        self.path = path
+        self.embedding = embedding
+        self.ann_min_rows = int(ann_min_rows)
+        self.ann_nprobe = int(ann_nprobe)
+        self._dir = SegmentedDir(path, legacy_files=(_VECTORS_FILE, _RECORDS_FILE))
+        self._lock = threading.RLock()
+        self._loaded_version: tuple | None = None
+        self._manifest: dict = {"segments": []}
+        self._segments: dict[str, _Segment] = {}
+        self._where: list[tuple[str, int]] = []
+        self._live_vectors: np.ndarray | None = None
+        self._ids: list[str] = []
+        self._texts: list[str] = []
+        self._metadatas: list[dict] = []
+        self._ivf: _IvfIndex | None = None
+        self._maybe_reload()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    # ---- persistence ----
+
+    def _maybe_reload(self) -> None:
+        version = self._dir.version()
+        if version is None or version == self._loaded_version:
+            return
+        for attempt in range(3):
+            manifest = self._dir.manifest()
+            try:
+                segments = {
+                    s["name"]: self._segments.get(s["name"])
+                    or _Segment(self._dir.segment_path(s["name"]))
+                    for s in manifest["segments"]
+                }
+                break
+            except FileNotFoundError:
+                # Collected by a writer between reading the manifest and
+                # the segment; the next manifest no longer lists it.
+                if attempt == 2:
+                    raise
+                version = self._dir.version()
+        where, ids, texts, metadatas = [], [], [], []
+        for entry in manifest["segments"]:
+            seg = segments[entry["name"]]
+            dead = set(entry.get("dead") or ())
+            for row in range(len(seg.ids)):
+                if row not in dead:
+                    where.append((entry["name"], row))
+                    ids.append(seg.ids[row])
+                    texts.append(seg.texts[row])
+                    metadatas.append(seg.metadatas[row])
+        self._manifest, self._segments, self._where = manifest, segments, where
+        self._ids, self._texts, self._metadatas = ids, texts, metadatas
+        self._live_vectors = None
+        self._ivf = None
+        self._loaded_version = version
+
+    @property
+    def _vectors(self) -> np.ndarray:
+        # One clean segment is searched memory-mapped; otherwise the live
+        # rows are gathered once per reload.
+        if self._live_vectors is None:
+            entries = self._manifest["segments"]
+            if len(entries) == 1 and not entries[0].get("dead"):
+                self._live_vectors = self._segments[entries[0]["name"]].vectors
+            elif self._where:
+                parts = []
+                for entry in entries:
+                    seg = self._segments[entry["name"]]
+                    dead = entry.get("dead")
+                    if dead:
+                        keep = np.ones(len(seg.ids), dtype=bool)
+                        keep[dead] = False
+                        parts.append(np.asarray(seg.vectors[keep]))
+                    elif len(seg.ids):
+                        parts.append(np.asarray(seg.vectors))
+                self._live_vectors = np.concatenate(parts)
+            else:
+                self._live_vectors = np.zeros((0, 0), dtype=np.float32)
+        return self._live_vectors
+
+    def _write(self, drop_rows: list[int], vectors: np.ndarray | None, ids, texts, metadatas) -> None:
+        # Call with the write lock held and the latest manifest loaded.
+        entries = [{"name": e["name"], "dead": list(e.get("dead") or ())}
+                   for e in self._manifest["segments"]]
+        by_name = {e["name"]: e for e in entries}
+        for row in drop_rows:
+            name, local = self._where[row]
+            by_name[name]["dead"].append(local)
+        if ids:
+            name, path = self._dir.new_segment()
+            _Segment.write(path, vectors, ids, texts, metadatas)
+            self._segments[name] = _Segment(path)
+            entries.append({"name": name, "dead": []})
+        entries = [e for e in entries if len(e["dead"]) < len(self._segments[e["name"]].ids)]
+
+        live = [len(self._segments[e["name"]].ids) - len(e["dead"]) for e in entries]
+        dead = sum(len(e["dead"]) for e in entries)
+        n = len(entries) if dead > sum(live) else tail_to_merge(live)
+        if n > 1:
+            entries = entries[:-n] + [self._merge(entries[-n:])]
+        self._dir.publish(entries)
+        self._maybe_reload()
+
+    def _merge(self, entries: list[dict]) -> dict:
+        vectors, ids, texts, metadatas = [], [], [], []
+        for e in entries:
+            seg = self._segments[e["name"]]
+            keep = np.ones(len(seg.ids), dtype=bool)
+            keep[e["dead"]] = False
+            if keep.any():
+                vectors.append(np.asarray(seg.vectors[keep]))
+            rows = np.flatnonzero(keep)
+            ids += [seg.ids[i] for i in rows]
+            texts += [seg.texts[i] for i in rows]
+            metadatas += [seg.metadatas[i] for i in rows]
+        name, path = self._dir.new_segment()
+        _Segment.write(path, np.concatenate(vectors), ids, texts, metadatas)
+        self._segments[name] = _Segment(path)
+        return {"name": name, "dead": []}
+
+    # ---- writes ----
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        *,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        vectors = self.embedding.embed_documents(texts) if texts else []
+        return self.add_embeddings(zip(texts, vectors), metadatas, keys=ids)
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[tuple[str, list[float]]],
+        metadatas: list[dict] | None = None,
+        *,
+        keys: list[str] | None = None,
+    ) -> list[str]:
+        pairs = list(text_embeddings)
+        if not pairs:
+            return []
+        new_ids = list(keys) if keys else [str(uuid.uuid4()) for _ in pairs]
+        new_texts = [t for t, _ in pairs]
+        new_metadatas = [dict(m or {}) for m in (metadatas or [{}] * len(pairs))]
+        new_vectors = _unit_rows(np.asarray([v for _, v in pairs], dtype=np.float32))
+
+        with self._lock, self._dir.write_lock():
+            self._maybe_reload()
+            replaced = set(new_ids)
+            drop = [i for i, row_id in enumerate(self._ids) if row_id in replaced]
+            self._write(drop, new_vectors, new_ids, new_texts, new_metadatas)
+        return new_ids
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> bool:
+        if not ids:
+            return False
+        with self._lock, self._dir.write_lock():
+            self._maybe_reload()
+            drop_ids = set(ids)
+            drop = [i for i, row_id in enumerate(self._ids) if row_id in drop_ids]
+            if not drop:
+                return False
+            self._write(drop, None, [], [], [])
+        return True
+
+    def update_metadata(self, ids: list[str], metadatas: list[dict]) -> int:
+        if not ids:
+            return 0
+        updates = dict(zip(ids, metadatas))
+        with self._lock, self._dir.write_lock():
+            self._maybe_reload()
+            rows = [i for i, row_id in enumerate(self._ids) if row_id in updates]
+            if not rows:
+                return 0
+            # The updated rows move to a new segment; their vectors are
+            # copied as they are.
+            vectors = np.stack([
+                np.asarray(self._segments[name].vectors[local])
+                for name, local in (self._where[i] for i in rows)
+            ])
+            self._write(
+                rows,
+                vectors,
+                [self._ids[i] for i in rows],
+                [self._texts[i] for i in rows],
+                [dict(updates[self._ids[i]] or {}) for i in rows],
+            )
+        return len(rows)
+
+    def ids_for_doc_id(self, doc_id: str) -> list[str]:
+        with self._lock:
+            self._maybe_reload()
+            return [
+                row_id
+                for row_id, md in zip(self._ids, self._metadatas)
+                if md.get("doc_id") == doc_id
+            ]
+
+    # ---- search ----
+
+    def _search(self, queries: np.ndarray, k: int) -> list[list[tuple[int, float]]]:
+        with self._lock:
+            self._maybe_reload()
+            vectors = self._vectors
+            n = vectors.shape[0]
+            if n == 0 or k <= 0:
+                return [[] for _ in range(queries.shape[0])]
+            queries = _unit_rows(queries)
+
+            if self.ann_min_rows and n >= self.ann_min_rows:
+                if self._ivf is None:
+                    self._ivf = _IvfIndex(vectors)
+                out = []
+                for q in queries:
+                    rows = self._ivf.candidates(q, self.ann_nprobe)
+                    scores = np.asarray(vectors[rows]) @ q
+                    best = _top_k(scores, k)
+                    out.append([(int(rows[i]), float(scores[i])) for i in best])
+                return out
+
+            best_rows = np.empty((queries.shape[0], 0), dtype=np.int64)
+            best_scores = np.empty((queries.shape[0], 0), dtype=np.float32)
+            for start in range(0, n, _SCORE_BLOCK_ROWS):
+                block = np.asarray(vectors[start:start + _SCORE_BLOCK_ROWS])
+                scores = queries @ block.T
+                top = _top_k(scores, k)
+                best_rows = np.concatenate([best_rows, top + start], axis=1)
+                best_scores = np.concatenate(
+                    [best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            order = _top_k(best_scores, k)
+            rows = np.take_along_axis(best_rows, order, axis=1)
+            scores = np.take_along_axis(best_scores, order, axis=1)
+            return [
+                [(int(r), float(s)) for r, s in zip(row_r, row_s)]
+                for row_r, row_s in zip(rows, scores)
+            ]
+
+    def _document(self, row: int) -> Document:
+        return Document(page_content=self._texts[row], metadata=dict(self._metadatas[row]))
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        *,
+        score_threshold: float | None = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        hits = self._search(np.asarray([embedding], dtype=np.float32), k)[0]
+        with self._lock:
+            return [
+                (self._document(row), score)
+                for row, score in hits
+                if score_threshold is None or score >= score_threshold
+            ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, **kwargs)
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        return _with_scores(self.similarity_search_by_vector_with_score(embedding, k, **kwargs))
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return _with_scores(self.similarity_search_with_score(query, k, **kwargs))
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Scores are already cosine similarities.
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        *,
+        path: str = ".rag_index",
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
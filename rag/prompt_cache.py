@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import contextvars
+import logging
+import threading
+from contextlib import contextmanager
+
+from langchain_anthropic import ChatAnthropic
+from langchain_core.language_models.chat_models import generate_from_stream
+from langchain_core.messages import AIMessageChunk, SystemMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+from rag import telemetry
+
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_HEADER = "Kontekst:\n"
+USAGE_KEYS = (
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+)
+
+
+def cached_system(text: str) -> SystemMessage:
+    # A system block that ends with an Anthropic prompt-cache breakpoint.
+    return SystemMessage(content=text, additional_kwargs={"cache_control": {"type": "ephemeral"}})
+
+
+def context_block(context: str) -> list[SystemMessage]:
+    # The retrieved context as the first system block, so the judge and the
+    # answer call share it as a cacheable prefix.
+    return [cached_system(CONTEXT_HEADER + context)]
+
+
+class UsageTotals:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = dict.fromkeys(("calls",) + USAGE_KEYS, 0)
+
+    def add(self, usage: dict) -> None:
+        with self._lock:
+            self._totals["calls"] += 1
+            for k in USAGE_KEYS:
+                self._totals[k] += usage[k]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._totals)
+
+    def reset(self) -> None:
+        with self._lock:
+            for k in self._totals:
+                self._totals[k] = 0
+
+
+usage_totals = UsageTotals()
+
+
+def record_usage(usage, model: str) -> dict:
+    usage = usage or {}
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    numbers = {k: int(usage.get(k) or 0) for k in USAGE_KEYS}
+    usage_totals.add(numbers)
+    logger.debug("Anthropic usage for %s: %s", model, numbers)
+    return numbers
+
+
+_abort_scope: contextvars.ContextVar = contextvars.ContextVar("abort_scope", default=None)
+
+
+class AbortScope:
+    # Lets another thread abort the Anthropic calls made inside it by
+    # closing their HTTP responses. Calls inside a scope are always
+    # streamed, since a plain messages.create cannot be interrupted.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._closers = []
+        self.aborted = False
+
+    @contextmanager
+    def active(self):
+        token = _abort_scope.set(self)
+        try:
+            yield self
+        finally:
+            _abort_scope.reset(token)
+
+    def register(self, close) -> None:
+        with self._lock:
+            if not self.aborted:
+                self._closers.append(close)
+                return
+        close()
+
+    def abort(self) -> None:
+        with self._lock:
+            self.aborted = True
+            closers, self._closers = self._closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                logger.debug("Closing an aborted response failed", exc_info=True)
+
+
+class CachingChatAnthropic(ChatAnthropic):
+    # ChatAnthropic that sends leading system messages carrying
+    # additional_kwargs["cache_control"] as system blocks with cache
+    # breakpoints, and records the token usage (cache reads and writes
+    # included) of every call.
+
+    def _format_params(self, *, messages, stop=None, **kwargs):
+        lead = 0
+        while lead < len(messages) and messages[lead].type == "system":
+            lead += 1
+        if not any("cache_control" in m.additional_kwargs for m in messages[:lead]):
+            return super()._format_params(messages=messages, stop=stop, **kwargs)
+        params = super()._format_params(messages=messages[lead:], stop=stop, **kwargs)
+        params["system"] = [
+            {"type": "text", "text": m.content, **(
+                {"cache_control": m.additional_kwargs["cache_control"]}
+                if "cache_control" in m.additional_kwargs else {}
+            )}
+            for m in messages[:lead]
+            if m.content
+        ]
+        return params
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        if _abort_scope.get() is not None:
+            return generate_from_stream(
+                self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+        with telemetry.span("llm_call", model=self.model) as sp:
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            sp.set(**record_usage((result.llm_output or {}).get("usage"), self.model))
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            return await super()._agenerate(
+                messages, stop=stop, run_manager=run_manager, **kwargs)
+        with telemetry.span("llm_call", model=self.model) as sp:
+            result = await super()._agenerate(
+                messages, stop=stop, run_manager=run_manager, **kwargs)
+            sp.set(**record_usage((result.llm_output or {}).get("usage"), self.model))
+        return result
+
+    # The streaming spans are ended by hand: a generator may be resumed in a
+    # different context than the one it started in.
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        params = self._format_params(messages=messages, stop=stop, **kwargs)
+        if "tools" in params:
+            yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            return
+        sp = telemetry.span("llm_call", model=self.model, stream=True)
+        try:
+            with self._client.messages.stream(**params) as stream:
+                scope = _abort_scope.get()
+                if scope is not None:
+                    scope.register(stream.close)
+                for text in stream.text_stream:
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                    if run_manager:
+                        run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+                usage = stream.get_final_message().usage
+        except BaseException as e:
+            sp.end(e)
+            raise
+        sp.set(**record_usage(usage, self.model))
+        sp.end()
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        params = self._format_params(messages=messages, stop=stop, **kwargs)
+        if "tools" in params:
+            async for chunk in super()._astream(
+                    messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+            return
+        sp = telemetry.span("llm_call", model=self.model, stream=True)
+        try:
+            async with self._async_client.messages.stream(**params) as stream:
+                async for text in stream.text_stream:
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                    if run_manager:
+                        await run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+                usage = (await stream.get_final_message()).usage
+        except BaseException as e:
+            sp.end(e)
+            raise
+        sp.set(**record_usage(usage, self.model))
+        sp.end()
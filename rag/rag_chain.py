@@ -1,19 +1,38 @@
+import asyncio
+import logging
+import queue
 import re
+import threading
 
+import regex
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableBranch, RunnableMap, RunnableLambda, RunnablePassthrough
-from langchain_anthropic import ChatAnthropic
-
-from rag.retriever import get_retriever
+from langchain_core.runnables import RunnableBranch, RunnableGenerator, RunnableMap, RunnableLambda, RunnablePassthrough
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+
+from rag import telemetry
+from rag.answer_cache import get_answer_cache
+from rag.context_packing import pack_context
+from rag.prompt_cache import AbortScope, CachingChatAnthropic, cached_system, context_block
+from rag.relevance_gate import get_relevance_gate
+from rag.text_pl import STOPWORDS_PL as _STOPWORDS_PL, overlap_hits, tokens_pl as _tokens_pl
+from rag.retriever import get_async_retriever, get_retriever
+from config.embeddings import get_embeddings
 from config.settings import get_settings
 
 
+logger = logging.getLogger(__name__)
+
+
 def get_llm():
     s = get_settings()
-    return ChatAnthropic(
+    kwargs = {}
+    if s.anthropic_beta:
+        kwargs["default_headers"] = {"anthropic-beta": s.anthropic_beta}
+    return CachingChatAnthropic(
         model=s.llm_model,
-        temperature=0
+        temperature=0,
+        **kwargs,
     )
 
 
@@ -39,9 +58,26 @@ def format_sources(docs):
     return "\n".join(lines) if lines else ""
 
 
-def get_prompt():
+_ANSWER_SYSTEM = "Odpowiadaj wyłącznie na podstawie kontekstu, ale nie wspominaj, że to robisz, nie użwaj słowa \"kontekst\". tylko po prostu udziel konkretnej odpowiedzi naturalnym językiem. Jeśli kontekst nie pozwala odpowiedzieć na pytanie, odpowiedz dokładnie: Nie mam wiedzy na ten temat. Jeśli kontekst zawiera choćby część odpowiedzi, podaj wyłącznie to, co wynika z kontekstu, w maksymalnie 2 krótkich zdaniach. Nie dodawaj zastrzeżeń typu 'nie mam wystarczających informacji' ani przeprosin."
+
+
+def _system(text: str, cache: bool):
+    return cached_system(text) if cache else ("system", text)
+
+
+def get_prompt(*, cache_system: bool = False, cache_context: bool = False):
+    if cache_context:
+        # The context comes first as its own cached system block (see
+        # rag.prompt_cache.context_block), shared with the judge call.
+        return ChatPromptTemplate.from_messages([
+            MessagesPlaceholder("context_block"),
+            ("system", _ANSWER_SYSTEM),
+            MessagesPlaceholder("chat_history"),
+            ("human", """Pytanie:
+{input}"""),
+        ])
     return ChatPromptTemplate.from_messages([
-        ("system", "Odpowiadaj wyłącznie na podstawie kontekstu, ale nie wspominaj, że to robisz, nie użwaj słowa \"kontekst\". tylko po prostu udziel konkretnej odpowiedzi naturalnym językiem. Jeśli kontekst nie pozwala odpowiedzieć na pytanie, odpowiedz dokładnie: Nie mam wiedzy na ten temat. Jeśli kontekst zawiera choćby część odpowiedzi, podaj wyłącznie to, co wynika z kontekstu, w maksymalnie 2 krótkich zdaniach. Nie dodawaj zastrzeżeń typu 'nie mam wystarczających informacji' ani przeprosin."),
+        _system(_ANSWER_SYSTEM, cache_system),
         MessagesPlaceholder("chat_history"),
         ("human", """Kontekst:
 {context}
@@ -51,25 +87,35 @@ Pytanie:
     ])
 
 
-def get_contextualize_prompt():
+def get_contextualize_prompt(*, cache_system: bool = False):
     return ChatPromptTemplate.from_messages([
-        (
-            "system",
+        _system(
             "Na podstawie HISTORII CZATU i OSTATNIEGO PYTANIA sformułuj jedno, samodzielne pytanie, "
             "które można wysłać do wyszukiwarki dokumentów. "
             "W samodzielnym pytaniu zawsze doprecyzuj temat (np. podróż służbowa / zwrot kosztów) i zachowaj sens pytania "
             "(np. podlegają vs nie podlegają zwrotowi). "
             "Jeśli ostatnie pytanie jest już samodzielne, zwróć je bez zmian. "
-            "Zwróć wyłącznie tekst pytania, bez dodatkowych słów."
+            "Zwróć wyłącznie tekst pytania, bez dodatkowych słów.",
+            cache_system,
         ),
         MessagesPlaceholder("chat_history"),
         ("human", "{input}"),
     ])
 
 
-def get_judge_prompt():
+_JUDGE_SYSTEM = "Oceń, czy KONTEKST zawiera informacje istotne dla PYTANIA (nawet jeśli pozwalają odpowiedzieć tylko częściowo). Zwróć wyłącznie YES albo NO. Jeśli kontekst jest nie na temat, zwróć NO."
+
+
+def get_judge_prompt(*, cache_system: bool = False, cache_context: bool = False):
+    if cache_context:
+        return ChatPromptTemplate.from_messages([
+            MessagesPlaceholder("context_block"),
+            ("system", _JUDGE_SYSTEM),
+            ("human", """PYTANIE:
+{input}"""),
+        ])
     return ChatPromptTemplate.from_messages([
-        ("system", "Oceń, czy KONTEKST zawiera informacje istotne dla PYTANIA (nawet jeśli pozwalają odpowiedzieć tylko częściowo). Zwróć wyłącznie YES albo NO. Jeśli kontekst jest nie na temat, zwróć NO."),
+        _system(_JUDGE_SYSTEM, cache_system),
         ("human", """PYTANIE:
 {input}
 
@@ -100,53 +146,6 @@ def get_recap_prompt():
     ])
 
 
-_STOPWORDS_PL = {
-    "a",
-    "aby",
-    "albo",
-    "ale",
-    "bo",
-    "co",
-    "czy",
-    "dla",
-    "do",
-    "gdzie",
-    "i",
-    "jak",
-    "jaka",
-    "jakie",
-    "jaki",
-    "jest",
-    "kiedy",
-    "która",
-    "które",
-    "który",
-    "ma",
-    "mam",
-    "mi",
-    "mnie",
-    "na",
-    "nad",
-    "nie",
-    "o",
-    "od",
-    "oraz",
-    "po",
-    "pod",
-    "się",
-    "są",
-    "ta",
-    "ten",
-    "to",
-    "tu",
-    "w",
-    "we",
-    "z",
-    "za",
-    "ze",
-}
-
-
 _STOPWORDS_EN = {
     "a",
     "an",
@@ -222,25 +221,13 @@ def _is_probably_polish(text: str) -> bool:
     return pl_hits >= en_hits
 
 
-def _tokens_pl(text: str) -> set[str]:
-    t = (text or "").casefold()
-    raw = re.findall(r"[\wąćęłńóśźż]+", t)
-    out: set[str] = set()
-    for tok in raw:
-        if len(tok) < 3:
-            continue
-        if tok in _STOPWORDS_PL:
-            continue
-        out.add(tok)
-    return out
-
-
-def _has_relevance_overlap(question: str, context: str, *, min_hits: int = 1) -> bool:
+def _has_relevance_overlap(question: str, docs, *, min_hits: int = 1) -> bool:
+    # Uses the token signatures stored with each chunk at ingest instead of
+    # tokenizing the joined context.
     q = _tokens_pl(question)
     if not q:
         return True
-    c = _tokens_pl(context)
-    return len(q & c) >= min_hits
+    return overlap_hits(q, docs) >= min_hits
 
 
 _RECAP_PATTERNS = [
@@ -253,6 +240,79 @@ _RECAP_PATTERNS = [
 ]
 
 
+_QUESTION_WORDS_PL = {
+    "ile",
+    "jak",
+    "jaka",
+    "jakie",
+    "jaki",
+    "jakiej",
+    "jakiego",
+    "jakich",
+    "jakim",
+    "kto",
+    "kiedy",
+    "gdzie",
+    "dlaczego",
+    "czemu",
+    "można",
+    "mogę",
+    "trzeba",
+    "należy",
+    "muszę",
+    "wolno",
+}
+
+
+_FOLLOWUP_CUES = re.compile(
+    r"^\s*(a|i|oraz|ale|no|więc|czyli|zaś)\b|"
+    r"\b(tego|temu|tym|tej|tych|tę|tą|tamt\w+|on|ona|ono|oni|one|jego|jej|ich|nich|niego|niej|nim|"
+    r"tam|wtedy|też|również|także|powyższ\w*|wspomnian\w*|poprzedni\w*|wcześniej\w*|ostatni\w*|"
+    r"taki\w*|tak|ten|ta|te)\b|"
+    r"(?<!co\s)\bto\b(?!\s+(jest|są|znaczy)\b)",
+    re.IGNORECASE,
+)
+
+
+def _recent_turn_tokens(history, turns: int = 3) -> set[str]:
+    out: set[str] = set()
+    for m in list(history)[-turns:]:
+        out |= _tokens_pl(str(getattr(m, "content", "") or ""))
+    return out
+
+
+def _needs_contextualization(question: str, history) -> bool:
+    if not history:
+        return False
+    q = (question or "").strip()
+    if not q or _FOLLOWUP_CUES.search(q):
+        return True
+    content = _tokens_pl(q) - _QUESTION_WORDS_PL
+    if len(content) >= 3:
+        return False
+    if len(content) <= 1:
+        return True
+    # Two content words are only trusted when they open a new topic;
+    # otherwise they are probably an elliptical follow-up.
+    return bool(content & _recent_turn_tokens(history))
+
+
+_contextualize_stats = {"skipped": 0, "rewritten": 0}
+_contextualize_lock = threading.Lock()
+_CONTEXTUALIZE_LOG_EVERY = 20
+
+
+def _record_contextualize(skipped: bool) -> None:
+    with _contextualize_lock:
+        _contextualize_stats["skipped" if skipped else "rewritten"] += 1
+        skipped_n = _contextualize_stats["skipped"]
+        total = skipped_n + _contextualize_stats["rewritten"]
+    logger.debug("Contextualize %s", "skipped" if skipped else "sent to LLM")
+    if total % _CONTEXTUALIZE_LOG_EVERY == 0:
+        logger.info("Contextualize skip rate: %.1f%% (%d/%d)",
+                    100.0 * skipped_n / total, skipped_n, total)
+
+
 def _detect_route(text: str) -> str:
     t = (text or "").strip()
     if not t:
@@ -263,19 +323,239 @@ def _detect_route(text: str) -> str:
     return "RAG"
 
 
-def get_rag_chain():
-    retriever = get_retriever()
-    llm = get_llm()
-    prompt = get_prompt()
-    judge_prompt = get_judge_prompt()
-    contextualize_prompt = get_contextualize_prompt()
+_ANSWER_PREFIX = regex.compile(
+    r"^(zgodnie|na\s+podstawie)\s+z?\s*kontekst(em|u)\s*,\s*", regex.IGNORECASE)
+_REFUSALS = ("nie mam wiedzy", "nie wiem")
+_REFUSAL_OVERLAP = max(len(p) for p in _REFUSALS) - 1
+# Longest opening held back while it could still turn into _ANSWER_PREFIX.
+_PREFIX_WINDOW = 64
+
+
+class AnswerReplace(str):
+    # Streamed in place of everything the answer has yielded so far, when a
+    # refusal phrase shows up after tokens went out. Adding it to the text
+    # streamed so far gives just the replacement, so invoke() returns it too.
+    def __radd__(self, other):
+        return str(self)
+
+
+class _AnswerRenderer:
+    # Tokens are streamed as they arrive. Only the opening that could still
+    # be the stripped prefix, and trailing whitespace, are held back. A
+    # refusal phrase anywhere in the answer turns it into the unknown answer.
+    def __init__(self, unknown: str):
+        self.unknown = unknown
+        self.answer = ""
+        self.text = ""
+        self.rendered = ""
+        self.is_unknown = False
+        self._held = ""
+        self._started = False
+
+    def _refused(self, token: str) -> bool:
+        tail = self.answer[-(len(token) + _REFUSAL_OVERLAP):].casefold()
+        return any(p in tail for p in _REFUSALS)
+
+    def _strip_prefix(self, final: bool) -> bool:
+        head = self._held.lstrip()
+        m = _ANSWER_PREFIX.match(head, partial=not final)
+        if not final and len(head) < _PREFIX_WINDOW and m is not None and (
+                m.partial or m.end() == len(head)):
+            return False
+        self._held = head[m.end():] if m is not None and not m.partial else head
+        self._started = True
+        return True
+
+    def _flush(self) -> list[str]:
+        out = self._held.rstrip()
+        if not out:
+            return []
+        self._held = self._held[len(out):]
+        self.text += out
+        return [out]
+
+    def feed(self, token: str) -> list[str]:
+        if self.is_unknown or not token:
+            return []
+        self.answer += token
+        if self._refused(token):
+            self.is_unknown = True
+            self.rendered = self.unknown
+            return [AnswerReplace(self.unknown)] if self.text else []
+        self._held += token
+        if not self._started and not self._strip_prefix(final=False):
+            return []
+        return self._flush()
+
+    def finish(self, sources: str) -> list[str]:
+        if self.is_unknown:
+            return [] if self.text else [self.unknown]
+        if not self._started:
+            self._strip_prefix(final=True)
+        out = self._flush()
+        s = (sources or "").strip()
+        if not s:
+            if not self.text:
+                out = [self.unknown]
+            self.rendered = self.text or self.unknown
+            return out
+        out.append(f"\n\nSources:\n{s}")
+        self.rendered = f"{self.text}\n\nSources:\n{s}"
+        return out
+
+
+def _fn(func, name: str | None = None):
+    # Cheap synchronous steps also get an async twin, so ainvoke/astream
+    # never hop to the default thread pool for them.
+    async def _afunc(x):
+        return func(x)
+
+    return RunnableLambda(func, afunc=_afunc, name=name)
+
+
+class _SpeculativeGate:
+    # Answer tokens are held back until the judge says YES. Errors are
+    # surfaced exactly when the sequential chain would have raised them.
+    def __init__(self, unknown: str):
+        self.unknown = unknown
+        self.verdict: str | None = None
+        self.buffered: list[str] = []
+        self.answer_done = False
+        self.answer_error: BaseException | None = None
+
+    def feed(self, kind: str, value) -> tuple[list[str], bool]:
+        if kind == "judge_error":
+            raise value
+        if kind == "judge":
+            self.verdict = value
+            if value != "YES":
+                return [self.unknown], True
+            if self.answer_error is not None:
+                raise self.answer_error
+            out, self.buffered = self.buffered, []
+            return out, self.answer_done
+        if kind == "token":
+            if self.verdict == "YES":
+                return [value], False
+            self.buffered.append(value)
+            return [], False
+        if kind == "answer_error":
+            if self.verdict == "YES":
+                raise value
+            self.answer_error = value
+            return [], False
+        self.answer_done = True
+        return [], self.verdict == "YES"
+
+
+def _speculative_answer(judge_runnable, answer_runnable, unknown: str):
+    # Whichever call is no longer needed is stopped as soon as that is
+    # known: the answer on a NO verdict, both when the consumer goes away.
+    # In the sync path Anthropic calls are aborted by closing their HTTP
+    # responses (AbortScope); any other model can only be stopped between
+    # tokens, and a non-streaming call of one runs to completion unobserved.
+    def _transform(chunks, config):
+        x = None
+        for c in chunks:
+            x = c if x is None else x + c
+
+        events: queue.Queue = queue.Queue()
+        stop = threading.Event()
+        judge_scope, answer_scope = AbortScope(), AbortScope()
+
+        def _judge():
+            try:
+                with judge_scope.active():
+                    events.put(("judge", judge_runnable.invoke(x, config)))
+            except Exception as e:
+                events.put(("judge_error", e))
+
+        def _answer():
+            try:
+                with answer_scope.active():
+                    stream = answer_runnable.stream(x, config)
+                    try:
+                        for token in stream:
+                            if stop.is_set():
+                                return
+                            events.put(("token", token))
+                    finally:
+                        stream.close()
+                events.put(("answer_done", None))
+            except Exception as e:
+                events.put(("answer_error", e))
+
+        gate = _SpeculativeGate(unknown)
+        executor = ContextThreadPoolExecutor(max_workers=2)
+        try:
+            executor.submit(_judge)
+            executor.submit(_answer)
+            done = False
+            while not done:
+                out, done = gate.feed(*events.get())
+                if gate.verdict not in (None, "YES"):
+                    stop.set()
+                    answer_scope.abort()
+                yield from out
+        finally:
+            stop.set()
+            judge_scope.abort()
+            answer_scope.abort()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _atransform(chunks, config):
+        x = None
+        async for c in chunks:
+            x = c if x is None else x + c
+
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def _judge():
+            try:
+                events.put_nowait(("judge", await judge_runnable.ainvoke(x, config)))
+            except Exception as e:
+                events.put_nowait(("judge_error", e))
+
+        async def _answer():
+            try:
+                async for token in answer_runnable.astream(x, config):
+                    events.put_nowait(("token", token))
+                events.put_nowait(("answer_done", None))
+            except Exception as e:
+                events.put_nowait(("answer_error", e))
+
+        gate = _SpeculativeGate(unknown)
+        tasks = [asyncio.create_task(_judge()), asyncio.create_task(_answer())]
+        try:
+            done = False
+            while not done:
+                out, done = gate.feed(*await events.get())
+                if gate.verdict not in (None, "YES"):
+                    tasks[1].cancel()
+                for token in out:
+                    yield token
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return RunnableGenerator(_transform, _atransform)
+
+
+def _build_rag_chain(retriever, llm, *, embeddings=None, answer_cache=None):
+    settings = get_settings()
+    cache_system = settings.prompt_cache_system
+    cache_context = settings.prompt_cache_context
+    prompt = get_prompt(cache_system=cache_system, cache_context=cache_context)
+    judge_prompt = get_judge_prompt(cache_system=cache_system, cache_context=cache_context)
+    contextualize_prompt = get_contextualize_prompt(cache_system=cache_system)
     recap_prompt = get_recap_prompt()
 
     unknown = "Nie mam wiedzy na ten temat."
     polish_only = "Na ten moment jestem dostępny tylko w języku polskim."
 
-    route_runnable = RunnableLambda(
-        lambda x: _detect_route(x.get("input") or ""))
+    route_runnable = _fn(
+        lambda x: _detect_route(x.get("input") or ""), "route")
 
     start = RunnablePassthrough.assign(route=route_runnable)
 
@@ -290,88 +570,201 @@ def get_rag_chain():
         return ""
 
     recap_chain = (
-        RunnableLambda(lambda x: {"previous_question": _previous_question(x)})
+        _fn(lambda x: {"previous_question": _previous_question(x)})
         | RunnableBranch(
-            (lambda x: not (x.get("previous_question") or "").strip(),
-             RunnableLambda(lambda _: unknown)),
+            (_fn(lambda x: not (x.get("previous_question") or "").strip()),
+             _fn(lambda _: unknown)),
             recap_prompt | llm | StrOutputParser(),
         )
-    )
+    ).with_config(run_name="recap")
+
+    def _is_standalone(x) -> bool:
+        if not settings.local_standalone_detector:
+            return False
+        skipped = not _needs_contextualization(
+            x.get("input") or "", x.get("chat_history") or [])
+        _record_contextualize(skipped)
+        return skipped
 
     contextualize_runnable = RunnableBranch(
         (
-            lambda x: not (x.get("chat_history") or []),
-            RunnableLambda(lambda x: x.get("input") or ""),
+            _fn(lambda x: not (x.get("chat_history") or [])),
+            _fn(lambda x: x.get("input") or ""),
         ),
+        (_fn(_is_standalone), _fn(lambda x: x.get("input") or "")),
         contextualize_prompt | llm | StrOutputParser(),
-    )
+    ).with_config(run_name="contextualize")
 
     def _q(x):
         q = (x.get("standalone_question") or x.get("input") or "").strip()
         return q
 
-    docs_runnable = RunnableLambda(lambda x: retriever.invoke(_q(x)))
+    async def _adocs(x):
+        return await retriever.ainvoke(_q(x))
+
+    docs_runnable = RunnableLambda(
+        lambda x: retriever.invoke(_q(x)), afunc=_adocs, name="retrieve")
 
-    base = RunnablePassthrough.assign(
+    contextualized = RunnablePassthrough.assign(
         standalone_question=contextualize_runnable)
-    base = base.assign(docs=docs_runnable)
-    base = base.assign(context=RunnableLambda(lambda x: join_docs(x["docs"])))
-    base = base.assign(sources=RunnableLambda(
-        lambda x: format_sources(x["docs"])))
-    base = base.assign(overlap_ok=RunnableLambda(
-        lambda x: _has_relevance_overlap(_q(x), x.get("context") or "")
+    base = RunnablePassthrough.assign(docs=docs_runnable)
+    if settings.context_packing:
+        base = base.assign(context=_fn(
+            lambda x: pack_context(
+                x["docs"],
+                _q(x),
+                token_budget=settings.context_token_budget,
+                dedup_jaccard=settings.context_dedup_jaccard,
+                sentence_filter=settings.context_sentence_filter,
+            ).text,
+            "pack_context",
+        ))
+    else:
+        base = base.assign(context=_fn(lambda x: join_docs(x["docs"]), "join_docs"))
+    base = base.assign(sources=_fn(
+        lambda x: format_sources(x["docs"]), "format_sources"))
+    base = base.assign(overlap_ok=_fn(
+        lambda x: _has_relevance_overlap(_q(x), x.get("docs") or []),
+        "overlap_check",
     ))
 
+    def _with_context_block(x: dict) -> dict:
+        if not cache_context:
+            return x
+        return {**x, "context_block": context_block(x.get("context") or "")}
+
     judge_runnable = (
-        RunnableLambda(lambda x: {"input": _q(
-            x), "context": x.get("context") or ""})
+        _fn(lambda x: _with_context_block({"input": _q(
+            x), "context": x.get("context") or ""}))
         | judge_prompt
         | llm
         | StrOutputParser()
-        | RunnableLambda(lambda s: "YES" if "YES" in str(s).strip().upper() else "NO")
-    )
-    base = base.assign(judge=judge_runnable)
+        | _fn(lambda s: "YES" if "YES" in str(s).strip().upper() else "NO")
+    ).with_config(run_name="judge")
+    gate = get_relevance_gate()
+    if gate.mode != "llm" or gate.log is not None:
+        # The local gate answers for the judge and only falls back to the
+        # LLM call when its mode says so.
+        judge_runnable = gate.wrap(judge_runnable.with_config(run_name="judge_llm"), _q)
 
     def _prep_for_answer(x):
-        return {
+        return _with_context_block({
             **x,
             "input": _q(x),
-        }
-
-    answer = RunnableBranch(
-        (lambda x: not (x.get("context") or "").strip(),
-         RunnableLambda(lambda _: unknown)),
-        (lambda x: not bool(x.get("overlap_ok")),
-         RunnableLambda(lambda _: unknown)),
-        (lambda x: (x.get("judge") or "").strip().upper() != "YES",
-         RunnableLambda(lambda _: unknown)),
-        RunnableLambda(_prep_for_answer) | prompt | llm | StrOutputParser(),
-    )
-
-    out = RunnableMap(
-        {
-            "answer": answer,
-            "sources": RunnableLambda(lambda x: x["sources"]),
-        }
-    )
-
-    def _render(x):
-        a = (x.get("answer") or "").strip()
-        s = (x.get("sources") or "").strip()
-        a = re.sub(r"^(zgodnie|na\s+podstawie)\s+z?\s*kontekst(em|u)\s*,\s*",
-                   "", a, flags=re.IGNORECASE)
-        low = a.casefold()
-        if ("nie mam wiedzy" in low) or ("nie wiem" in low):
-            return unknown
-        if not s:
-            return a or unknown
-        return f"{a}\n\nSources:\n{s}"
+        })
+
+    generate = (_fn(_prep_for_answer) | prompt | llm | StrOutputParser()).with_config(
+        run_name="answer")
+
+    gates = [
+        (_fn(lambda x: not (x.get("context") or "").strip()),
+         _fn(lambda _: unknown)),
+        (_fn(lambda x: not bool(x.get("overlap_ok"))),
+         _fn(lambda _: unknown)),
+    ]
+
+    if settings.speculative_answer:
+        # Judge and answer run concurrently; the answer is discarded on NO.
+        answer = RunnableBranch(
+            *gates,
+            _speculative_answer(judge_runnable, generate, unknown),
+        )
+    else:
+        base = base.assign(judge=judge_runnable)
+        answer = RunnableBranch(
+            *gates,
+            (_fn(lambda x: (x.get("judge") or "").strip().upper() != "YES"),
+             _fn(lambda _: unknown)),
+            generate,
+        )
 
-    rag_chain = base | out | RunnableLambda(_render)
+    outputs = {
+        "answer": answer,
+        "sources": _fn(lambda x: x["sources"]),
+    }
+    if answer_cache is not None:
+        outputs["docs"] = _fn(lambda x: x["docs"])
+        outputs["question_vector"] = _fn(lambda x: x["question_vector"])
+    out = RunnableMap(outputs)
+
+    def _cacheable(renderer, sources) -> bool:
+        return answer_cache is not None and not renderer.is_unknown and bool(sources.strip())
+
+    def _render_transform(chunks):
+        renderer = _AnswerRenderer(unknown)
+        sources = ""
+        extra = {}
+        for c in chunks:
+            sources += c.get("sources") or ""
+            extra.update({k: c[k] for k in ("docs", "question_vector") if k in c})
+            yield from renderer.feed(c.get("answer") or "")
+        yield from renderer.finish(sources)
+        if _cacheable(renderer, sources):
+            answer_cache.put(extra.get("question_vector"), renderer.rendered, extra.get("docs"))
+
+    async def _arender_transform(chunks):
+        renderer = _AnswerRenderer(unknown)
+        sources = ""
+        extra = {}
+        async for c in chunks:
+            sources += c.get("sources") or ""
+            extra.update({k: c[k] for k in ("docs", "question_vector") if k in c})
+            for token in renderer.feed(c.get("answer") or ""):
+                yield token
+        for token in renderer.finish(sources):
+            yield token
+        if _cacheable(renderer, sources):
+            await answer_cache.aput(extra.get("question_vector"), renderer.rendered, extra.get("docs"))
+
+    answered = base | out | RunnableGenerator(
+        _render_transform, _arender_transform).with_config(run_name="render")
+
+    if answer_cache is None:
+        rag_chain = contextualized | answered
+    else:
+        async def _aembed(x):
+            return await embeddings.aembed_query(_q(x))
+
+        async def _alookup(x):
+            return await answer_cache.aget(x["question_vector"])
+
+        # Paraphrases of an already answered question skip retrieval, the
+        # judge and the answer LLM entirely.
+        lookup = contextualized.assign(question_vector=RunnableLambda(
+            lambda x: embeddings.embed_query(_q(x)), afunc=_aembed, name="embed_question"))
+        # Not a _fn step: a hit checks the cited documents' ETags in the
+        # state store, which must not block the event loop.
+        lookup = lookup.assign(cached=RunnableLambda(
+            lambda x: answer_cache.get(x["question_vector"]), afunc=_alookup,
+            name="answer_cache_lookup"))
+        rag_chain = lookup | RunnableBranch(
+            (_fn(lambda x: x.get("cached") is not None),
+             _fn(lambda x: x["cached"])),
+            answered,
+        )
 
     return start | RunnableBranch(
-        (lambda x: (x.get("route") or "").upper() == "RECAP", recap_chain),
-        (lambda x: not _is_probably_polish(x.get("input") or ""),
-         RunnableLambda(lambda _: polish_only)),
+        (_fn(lambda x: (x.get("route") or "").upper() == "RECAP"), recap_chain),
+        (_fn(lambda x: not _is_probably_polish(x.get("input") or ""), "polish_check"),
+         _fn(lambda _: polish_only)),
         rag_chain,
     )
+
+
+def _answer_cache_kwargs() -> dict:
+    if not get_settings().answer_cache_enabled:
+        return {}
+    return {"embeddings": get_embeddings(), "answer_cache": get_answer_cache()}
+
+
+def get_rag_chain():
+    return telemetry.instrument_chain(
+        _build_rag_chain(get_retriever(), get_llm(), **_answer_cache_kwargs()))
+
+
+def get_async_rag_chain():
+    # Same routing and outputs as get_rag_chain, meant for ainvoke/astream:
+    # retrieval, embeddings and LLM calls are awaited instead of being
+    # pushed onto a thread pool.
+    return telemetry.instrument_chain(_build_rag_chain(
+        get_async_retriever(), get_llm(), **_answer_cache_kwargs()))
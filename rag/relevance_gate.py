@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+
+from config.settings import get_settings
+from rag.text_pl import signature_hits, stem_signature_of, stems_pl, token_hashes
+
+
+logger = logging.getLogger(__name__)
+
+MODES = ("llm", "local", "local-then-llm-if-uncertain")
+
+# Model inputs, in weight order. Chunks without a retrieval score (lexical
+# hits, the langchain Azure retriever) leave top_score at 0 and has_score off.
+FEATURES = ("stem_overlap", "best_chunk_stem_overlap", "top_score", "has_score")
+
+
+@dataclass(frozen=True)
+class GateModel:
+    # Logistic model over FEATURES. `threshold` decides in "local" mode; in
+    # "local-then-llm-if-uncertain" the judge is asked between `lo` and `hi`.
+    # Until calibrated, the gate never says NO itself; see RelevanceGate.decide.
+    weights: tuple[float, ...] = (3.0, 3.0, 0.0, 0.0)
+    bias: float = -3.0
+    threshold: float = 0.5
+    lo: float = 0.2
+    hi: float = 0.8
+    calibrated: bool = False
+
+    def probability(self, features: dict) -> float:
+        z = self.bias + sum(w * float(features[f]) for w, f in zip(self.weights, FEATURES))
+        return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "features": list(FEATURES)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GateModel":
+        if list(data.get("features") or FEATURES) != list(FEATURES):
+            raise ValueError(f"gate model features {data.get('features')} != {list(FEATURES)}")
+        return cls(
+            weights=tuple(float(w) for w in data["weights"]),
+            bias=float(data["bias"]),
+            threshold=float(data["threshold"]),
+            lo=float(data["lo"]),
+            hi=float(data["hi"]),
+            calibrated=bool(data.get("calibrated", True)),
+        )
+
+
+def load_model(path: str | None) -> GateModel:
+    if not path or not os.path.exists(path):
+        return GateModel()
+    with open(path, encoding="utf-8") as f:
+        return GateModel.from_dict(json.load(f))
+
+
+def relevance_features(question: str, docs) -> dict:
+    # Share of the question's word stems found in the whole context and in
+    # the best single chunk, from the stem signatures stored at ingest.
+    q = token_hashes(stems_pl(question))
+    found = np.zeros(q.size, dtype=bool)
+    best = 0
+    scores = []
+    for d in docs:
+        hits = signature_hits(stem_signature_of(d), q)
+        found |= hits
+        best = max(best, int(hits.sum()))
+        score = (d.metadata or {}).get("retrieval_score")
+        if isinstance(score, (int, float)):
+            scores.append(float(score))
+    n = max(1, q.size)
+    return {
+        "stem_overlap": round(int(found.sum()) / n, 4),
+        "best_chunk_stem_overlap": round(best / n, 4),
+        "top_score": round(max(scores), 4) if scores else 0.0,
+        "has_score": 1.0 if scores else 0.0,
+    }
+
+
+class JudgeLog:
+    # Append-only JSONL of (features, judge verdict) pairs for
+    # rag.calibrate_gate. Questions are not written.
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def write(self, features: dict, verdict: str, mode: str) -> None:
+        line = json.dumps({"ts": round(time.time(), 3), "mode": mode,
+                           "features": features, "verdict": verdict})
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning("Could not write judge log %s: %s", self.path, e)
+
+
+class RelevanceGate:
+    def __init__(
+        self,
+        mode: str = "llm",
+        model: GateModel | None = None,
+        *,
+        score_threshold: float | None = None,
+        log: JudgeLog | None = None,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"judge mode must be one of {MODES}, got: {mode!r}")
+        self.mode = mode
+        self.model = model or GateModel()
+        self.score_threshold = score_threshold
+        self.log = log
+        if mode != "llm" and not self.model.calibrated:
+            logger.warning(
+                "Judge mode %r without a calibrated gate model: only confident YES "
+                "verdicts are local, the LLM judge decides the rest. "
+                "Fit one with rag.calibrate_gate.", mode)
+
+    def decide(self, question: str, docs) -> tuple[str | None, dict]:
+        # "YES"/"NO", or None when the LLM judge has to decide.
+        features = relevance_features(question, docs)
+        if self.mode == "llm":
+            return None, features
+        if (
+            self.score_threshold is not None
+            and features["has_score"]
+            and features["top_score"] < self.score_threshold
+        ):
+            return "NO", features
+        p = self.model.probability(features)
+        if self.mode == "local" and self.model.calibrated:
+            return ("YES" if p >= self.model.threshold else "NO"), features
+        if p >= self.model.hi:
+            return "YES", features
+        # The default weights are a guess; a wrong local NO refuses an
+        # answerable question without the judge ever seeing it.
+        if p <= self.model.lo and self.model.calibrated:
+            return "NO", features
+        return None, features
+
+    def wrap(self, llm_judge, question_of):
+        # Same input and output as the LLM judge runnable ("YES"/"NO").
+        def _judge(x, config):
+            verdict, features = self.decide(question_of(x), x.get("docs") or [])
+            if verdict is None:
+                verdict = llm_judge.invoke(x, config)
+                self._record(features, verdict)
+            return verdict
+
+        async def _ajudge(x, config):
+            verdict, features = self.decide(question_of(x), x.get("docs") or [])
+            if verdict is None:
+                verdict = await llm_judge.ainvoke(x, config)
+                self._record(features, verdict)
+            return verdict
+
+        return RunnableLambda(_judge, afunc=_ajudge, name="judge")
+
+    def _record(self, features: dict, verdict: str) -> None:
+        if self.log is not None:
+            self.log.write(features, verdict, self.mode)
+
+
+@lru_cache(maxsize=1)
+def get_relevance_gate() -> RelevanceGate:
+    s = get_settings()
+    return RelevanceGate(
+        s.judge_mode,
+        load_model(s.judge_model_path),
+        score_threshold=s.retrieval_score_threshold,
+        log=JudgeLog(s.judge_log_path) if s.judge_log_path else None,
+    )
@@ -1,16 +1,207 @@
+import asyncio
+import json
+import weakref
+from typing import Any
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from rag.lexical_index import HybridRetriever, get_lexical_index
 from rag.vector_store import get_vector_store
+from config.embeddings import get_embeddings
 from config.settings import get_settings
 
 
-def get_retriever():
+# Without the local lexical index the local backend has no lexical half;
+# its hybrid modes fall back to the matching pure vector search.
+_LOCAL_SEARCH_TYPES = {
+    "hybrid": "similarity",
+    "hybrid_score_threshold": "similarity_score_threshold",
+    "semantic_hybrid": "similarity",
+    "semantic_hybrid_score_threshold": "similarity_score_threshold",
+}
+
+
+# With the local lexical index enabled, hybrid modes run a vector-only
+# search and fuse it with BM25 hits via reciprocal-rank fusion.
+_VECTOR_SEARCH_TYPES = {
+    "hybrid": "similarity",
+    "hybrid_score_threshold": "similarity_score_threshold",
+}
+
+
+def _lexical_index_for(search_type: str):
+    if search_type not in _VECTOR_SEARCH_TYPES:
+        return None
+    return get_lexical_index()
+
+
+def _vector_retriever(search_type: str, k: int):
     s = get_settings()
-    search_type = getattr(s, "retrieval_search_type", "hybrid")
     search_kwargs = {}
     score_threshold = getattr(s, "retrieval_score_threshold", None)
     if score_threshold is not None:
         search_kwargs["score_threshold"] = score_threshold
+    if s.vector_backend == "local":
+        search_kwargs["k"] = k
+        return get_vector_store().as_retriever(
+            search_type=_LOCAL_SEARCH_TYPES.get(search_type, search_type),
+            search_kwargs=search_kwargs,
+        )
     return get_vector_store().as_retriever(
         search_type=search_type,
-        k=s.retrieval_k,
+        k=k,
         search_kwargs=search_kwargs,
     )
+
+
+def _hybrid(vector_retriever, lexical_index) -> HybridRetriever:
+    s = get_settings()
+    return HybridRetriever(
+        vector_retriever=vector_retriever,
+        lexical_index=lexical_index,
+        k=s.retrieval_k,
+        fetch_k=max(s.lexical_fetch_k, s.retrieval_k),
+        rrf_k=s.rrf_k,
+    )
+
+
+def get_retriever():
+    s = get_settings()
+    search_type = getattr(s, "retrieval_search_type", "hybrid")
+    lexical_index = _lexical_index_for(search_type)
+    if lexical_index is None:
+        return _vector_retriever(search_type, s.retrieval_k)
+    return _hybrid(
+        _vector_retriever(
+            _VECTOR_SEARCH_TYPES[search_type],
+            max(s.lexical_fetch_k, s.retrieval_k),
+        ),
+        lexical_index,
+    )
+
+
+# The async path of the langchain AzureSearch store closes its shared aio
+# client after every call and iterates async results synchronously, so the
+# async retriever talks to azure.search.documents.aio directly.
+_ASYNC_SEARCH_TYPES = {
+    "similarity": False,
+    "similarity_score_threshold": False,
+    "hybrid": True,
+    "hybrid_score_threshold": True,
+}
+
+
+class AsyncAzureSearchRetriever(BaseRetriever):
+    sync_retriever: Any
+    search_type: str = "hybrid"
+    k: int = 4
+    score_threshold: float | None = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self.sync_retriever.invoke(
+            query, config={"callbacks": run_manager.get_child()})
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        if self.search_type not in _ASYNC_SEARCH_TYPES:
+            return await self.sync_retriever.ainvoke(
+                query, config={"callbacks": run_manager.get_child()})
+
+        from azure.search.documents.models import VectorizedQuery
+
+        embedding = await get_embeddings().aembed_query(query)
+        client = _async_search_client()
+        results = await client.search(
+            search_text=query if _ASYNC_SEARCH_TYPES[self.search_type] else "",
+            vector_queries=[
+                VectorizedQuery(
+                    vector=[float(v) for v in embedding],
+                    k_nearest_neighbors=self.k,
+                    fields="content_vector",
+                )
+            ],
+            top=self.k,
+        )
+
+        docs = []
+        async for r in results:
+            score = float(r["@search.score"])
+            if (
+                self.search_type.endswith("_score_threshold")
+                and self.score_threshold is not None
+                and score < self.score_threshold
+            ):
+                continue
+            doc = _result_to_document(r)
+            doc.metadata["retrieval_score"] = score
+            docs.append(doc)
+        return docs
+
+
+def _result_to_document(result: dict) -> Document:
+    if "metadata" in result:
+        metadata = json.loads(result["metadata"])
+    else:
+        metadata = {k: v for k, v in result.items() if k not in {
+            "content", "content_vector"}}
+    return Document(page_content=result.get("content") or "", metadata=metadata)
+
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _async_search_client():
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.aio import SearchClient
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        s = get_settings()
+        client = SearchClient(
+            endpoint=s.azure_search_endpoint,
+            index_name=s.azure_search_index,
+            credential=AzureKeyCredential(s.azure_search_key),
+            user_agent="langchain",
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def get_async_retriever() -> BaseRetriever:
+    s = get_settings()
+    if s.vector_backend == "local":
+        return get_retriever()
+    search_type = getattr(s, "retrieval_search_type", "hybrid")
+    lexical_index = _lexical_index_for(search_type)
+    if lexical_index is None:
+        return AsyncAzureSearchRetriever(
+            sync_retriever=get_retriever(),
+            search_type=search_type,
+            k=s.retrieval_k,
+            score_threshold=getattr(s, "retrieval_score_threshold", None),
+        )
+    vector_type = _VECTOR_SEARCH_TYPES[search_type]
+    fetch_k = max(s.lexical_fetch_k, s.retrieval_k)
+    return _hybrid(
+        AsyncAzureSearchRetriever(
+            sync_retriever=_vector_retriever(vector_type, fetch_k),
+            search_type=vector_type,
+            k=fetch_k,
+            score_threshold=getattr(s, "retrieval_score_threshold", None),
+        ),
+        lexical_index,
+    )
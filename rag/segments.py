@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+
+
+_CURRENT = "CURRENT"
+_LOCK = ".lock"
+_PREFIX = "seg-"
+
+# Stores written before segments existed keep their files in the root
+# directory; they are read as this one segment until it is merged away.
+LEGACY = "."
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_file(f) -> None:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+
+    def _unlock_file(f) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_file(f) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(f) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class SegmentedDir:
+    # A store kept as immutable segment directories listed in a manifest.
+    # Every write publishes a new manifest by atomically replacing a single
+    # pointer file, so a reader sees either the old or the new set of
+    # segments, never a mix. Writers, in any process, take a file lock.
+    def __init__(self, path: str, legacy_files: tuple[str, ...] = ()):
+        self.path = path
+        self.legacy_files = legacy_files
+        self._thread_lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def segment_path(self, name: str) -> str:
+        return self.path if name == LEGACY else self._file(name)
+
+    def _has_legacy(self) -> bool:
+        return bool(self.legacy_files) and os.path.exists(self._file(self.legacy_files[0]))
+
+    def version(self) -> tuple | None:
+        # Cheap change check: the pointer gets a new inode on every publish.
+        try:
+            st = os.stat(self._file(_CURRENT))
+        except FileNotFoundError:
+            if not self._has_legacy():
+                return None
+            st = os.stat(self._file(self.legacy_files[0]))
+            return (LEGACY, st.st_ino, st.st_mtime_ns)
+        return (st.st_ino, st.st_mtime_ns)
+
+    def manifest(self) -> dict:
+        try:
+            with open(self._file(_CURRENT), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            segments = [{"name": LEGACY, "dead": []}] if self._has_legacy() else []
+            return {"version": 0, "segments": segments}
+
+    def new_segment(self) -> tuple[str, str]:
+        name = f"{_PREFIX}{uuid.uuid4().hex}"
+        path = self._file(name)
+        os.makedirs(path)
+        return name, path
+
+    @contextmanager
+    def write_lock(self):
+        with self._thread_lock, open(self._file(_LOCK), "a+b") as f:
+            _lock_file(f)
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+
+    def publish(self, segments: list[dict]) -> None:
+        # Call with write_lock held, once the new segments are on disk.
+        previous = self.manifest()
+        manifest = {"version": int(previous.get("version", 0)) + 1, "segments": segments}
+        tmp = self._file(f"{_CURRENT}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file(_CURRENT))
+        self._collect(manifest, previous)
+
+    def _collect(self, manifest: dict, previous: dict) -> None:
+        # Segments of the previous manifest stay for readers that have just
+        # read it; older ones, and leftovers of failed writes, are removed.
+        keep = {s["name"] for s in manifest["segments"] + previous["segments"]}
+        for name in os.listdir(self.path):
+            if name.startswith(_PREFIX) and name not in keep:
+                shutil.rmtree(self._file(name), ignore_errors=True)
+            elif name.startswith(_CURRENT + ".") and name.endswith(".tmp"):
+                try:
+                    os.remove(self._file(name))
+                except OSError:
+                    pass
+        if LEGACY not in keep:
+            for name in self.legacy_files:
+                try:
+                    os.remove(self._file(name))
+                except FileNotFoundError:
+                    pass
+
+
+def tail_to_merge(live_rows: list[int]) -> int:
+    # How many trailing segments to merge into one so that segment sizes
+    # stay geometric, like a binary counter: every row is rewritten
+    # O(log n) times over the life of the store. 0 means none.
+    n, rows = 1, live_rows[-1] if live_rows else 0
+    while n < len(live_rows) and rows >= live_rows[-n - 1]:
+        rows += live_rows[-n - 1]
+        n += 1
+    return n if n > 1 else 0
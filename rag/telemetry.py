@@ -0,0 +1,466 @@
+from __future__ import annotations
+
+import atexit
+import bisect
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+logger = logging.getLogger(__name__)
+
+# Everything here is a no-op until telemetry is enabled, either with
+# RAG_TELEMETRY=1 or by calling configure(). Disabled spans cost one global
+# lookup and hand back a shared do-nothing object.
+_enabled: bool | None = None
+_log_spans = False
+_lock = threading.Lock()
+
+DURATION_BUCKETS_S = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+SIZE_BUCKETS = tuple(4 ** i for i in range(14))
+
+# Run names of the chain steps, see rag/rag_chain.py.
+CHAIN_STAGES = frozenset({
+    "route", "polish_check", "recap", "contextualize", "embed_question",
+    "answer_cache_lookup", "retrieve", "join_docs", "pack_context", "format_sources",
+    "overlap_check", "judge", "judge_llm", "answer", "render",
+})
+
+_SERVICE_START_NS = time.time_ns()
+_SPAN_BUFFER_MAX = 4096
+
+
+def _env_bool(name: str) -> bool:
+    return (os.environ.get(name) or "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Registry:
+    def __init__(self):
+        self.durations: dict[tuple[str, str], Histogram] = {}
+        self.sizes: dict[tuple[str, str], Histogram] = {}
+        self.spans: deque = deque(maxlen=_SPAN_BUFFER_MAX)
+        self.keep_spans = False
+        self.lock = threading.Lock()
+
+    def record(self, span: "Span", duration_s: float) -> None:
+        with self.lock:
+            key = (span.name, span.status)
+            h = self.durations.get(key)
+            if h is None:
+                h = self.durations[key] = Histogram(DURATION_BUCKETS_S)
+            h.observe(duration_s)
+            for attr, value in span.attrs.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                key = (span.name, attr)
+                h = self.sizes.get(key)
+                if h is None:
+                    h = self.sizes[key] = Histogram(SIZE_BUCKETS)
+                h.observe(float(value))
+            if self.keep_spans:
+                self.spans.append(span)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.durations.clear()
+            self.sizes.clear()
+            self.spans.clear()
+
+
+registry = _Registry()
+
+_current: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "rag_telemetry_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    __slots__ = ("name", "attrs", "trace_id", "span_id", "parent_id",
+                 "start_ns", "end_ns", "status", "_t0", "_token")
+
+    def __init__(self, name: str, attrs: dict, parent: "Span | None"):
+        self.name = name
+        self.attrs = attrs
+        self.trace_id = parent.trace_id if parent else _new_id(128)
+        self.span_id = _new_id(64)
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.status = "ok"
+        self._t0 = time.perf_counter()
+        self._token = None
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def end(self, error: BaseException | None = None) -> None:
+        if self.end_ns:
+            return
+        duration = time.perf_counter() - self._t0
+        self.end_ns = self.start_ns + int(duration * 1e9)
+        if error is not None:
+            self.status = "error"
+            self.attrs.setdefault("error", type(error).__name__)
+        registry.record(self, duration)
+        if _log_spans:
+            logger.info(json.dumps({
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "span": self.name,
+                "duration_ms": round(duration * 1e3, 3),
+                "status": self.status,
+                **{k: v for k, v in self.attrs.items() if isinstance(v, (str, int, float, bool))},
+            }, ensure_ascii=False))
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current.reset(self._token)
+        self.end(exc)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def end(self, error: BaseException | None = None) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def enabled() -> bool:
+    if _enabled is None:
+        configure()
+    return bool(_enabled)
+
+
+def span(name: str, **attrs: Any):
+    # `with span("download", blob=name) as sp: ...; sp.set(bytes=n)`.
+    # Numeric attributes end up in the size histograms.
+    if not _enabled:
+        if _enabled is not None or not enabled():
+            return _NOOP
+    return Span(name, attrs, _current.get())
+
+
+def configure(
+    *,
+    enabled: bool | None = None,
+    log_spans: bool | None = None,
+    otlp_endpoint: str | None = None,
+) -> None:
+    # Unset arguments come from RAG_TELEMETRY, RAG_TELEMETRY_LOG and
+    # RAG_OTLP_ENDPOINT.
+    global _enabled, _log_spans
+    with _lock:
+        _enabled = _env_bool("RAG_TELEMETRY") if enabled is None else enabled
+        _log_spans = _env_bool("RAG_TELEMETRY_LOG") if log_spans is None else log_spans
+        endpoint = os.environ.get("RAG_OTLP_ENDPOINT") if otlp_endpoint is None else otlp_endpoint
+        if _enabled and endpoint:
+            _start_otlp_exporter(endpoint.rstrip("/"))
+
+
+# ------------------------
+# LANGCHAIN
+# ------------------------
+
+def _size_attrs(outputs) -> dict:
+    if isinstance(outputs, str):
+        return {"chars": len(outputs)}
+    if isinstance(outputs, list):
+        return {"items": len(outputs)}
+    return {}
+
+
+class ChainTelemetry(BaseCallbackHandler):
+    # One span per chain invocation ("chain") with a child span per named
+    # stage. LangChain run ids provide the nesting, so spans stay correct
+    # across the threads and tasks the chain fans out to.
+    run_inline = True
+
+    def __init__(self):
+        self._spans: dict = {}
+        self._parents: dict = {}
+        self._lock = threading.Lock()
+
+    def _nearest_span(self, run_id):
+        while run_id is not None:
+            sp = self._spans.get(run_id)
+            if sp is not None:
+                return sp
+            run_id = self._parents.get(run_id)
+        return None
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name")
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            if parent_run_id is None:
+                self._spans[run_id] = Span("chain", {}, _current.get())
+            elif name in CHAIN_STAGES:
+                self._spans[run_id] = Span(name, {}, self._nearest_span(parent_run_id))
+
+    def _finish(self, run_id, outputs=None, error=None) -> None:
+        with self._lock:
+            self._parents.pop(run_id, None)
+            sp = self._spans.pop(run_id, None)
+        if sp is not None:
+            sp.attrs.update(_size_attrs(outputs))
+            sp.end(error)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id, outputs)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, error=error)
+
+
+def instrument_chain(chain):
+    if not enabled():
+        return chain
+    return chain.with_config(callbacks=[ChainTelemetry()])
+
+
+# ------------------------
+# EXPORT
+# ------------------------
+
+def _labels(**labels: str) -> str:
+    inner = ",".join(
+        f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for k, v in labels.items()
+    )
+    return "{" + inner + "}"
+
+
+def _prom_histogram(lines: list[str], name: str, h: Histogram, **labels: str) -> None:
+    cumulative = 0
+    for bound, count in zip(h.bounds, h.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=repr(float(bound)))} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {h.count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {h.sum!r}")
+    lines.append(f"{name}_count{_labels(**labels)} {h.count}")
+
+
+def prometheus_text() -> str:
+    with registry.lock:
+        durations = sorted(registry.durations.items())
+        sizes = sorted(registry.sizes.items())
+    lines = [
+        "# HELP rag_span_duration_seconds Duration of chain stages and ingestion steps.",
+        "# TYPE rag_span_duration_seconds histogram",
+    ]
+    for (name, status), h in durations:
+        _prom_histogram(lines, "rag_span_duration_seconds", h, span=name, status=status)
+    lines += [
+        "# HELP rag_span_size Sizes and counts recorded on spans (bytes, chunks, documents, ...).",
+        "# TYPE rag_span_size histogram",
+    ]
+    for (name, attr), h in sizes:
+        _prom_histogram(lines, "rag_span_size", h, span=name, attr=attr)
+    return "\n".join(lines) + "\n"
+
+
+def _otlp_attrs(attrs: dict) -> list[dict]:
+    out = []
+    for k, v in attrs.items():
+        if isinstance(v, bool):
+            value = {"boolValue": v}
+        elif isinstance(v, int):
+            value = {"intValue": str(v)}
+        elif isinstance(v, float):
+            value = {"doubleValue": v}
+        else:
+            value = {"stringValue": str(v)}
+        out.append({"key": k, "value": value})
+    return out
+
+
+def _otlp_resource() -> dict:
+    service = os.environ.get("RAG_SERVICE_NAME") or "ai-knowledge-agent"
+    return {"attributes": _otlp_attrs({"service.name": service})}
+
+
+def _otlp_histogram_points(items, bounds_attr: str, now_ns: int) -> list[dict]:
+    return [
+        {
+            "attributes": _otlp_attrs({"span": name, bounds_attr: extra}),
+            "startTimeUnixNano": str(_SERVICE_START_NS),
+            "timeUnixNano": str(now_ns),
+            "count": str(h.count),
+            "sum": h.sum,
+            "bucketCounts": [str(c) for c in h.counts],
+            "explicitBounds": [float(b) for b in h.bounds],
+        }
+        for (name, extra), h in items
+    ]
+
+
+def otlp_metrics_payload() -> dict:
+    now = time.time_ns()
+    with registry.lock:
+        durations = list(registry.durations.items())
+        sizes = list(registry.sizes.items())
+    # Cumulative temporality: every export carries totals since start.
+    return {"resourceMetrics": [{
+        "resource": _otlp_resource(),
+        "scopeMetrics": [{
+            "scope": {"name": __name__},
+            "metrics": [
+                {"name": "rag.span.duration", "unit": "s", "histogram": {
+                    "aggregationTemporality": 2,
+                    "dataPoints": _otlp_histogram_points(durations, "status", now)}},
+                {"name": "rag.span.size", "unit": "1", "histogram": {
+                    "aggregationTemporality": 2,
+                    "dataPoints": _otlp_histogram_points(sizes, "attr", now)}},
+            ],
+        }],
+    }]}
+
+
+def otlp_traces_payload(spans: list[Span]) -> dict:
+    return {"resourceSpans": [{
+        "resource": _otlp_resource(),
+        "scopeSpans": [{
+            "scope": {"name": __name__},
+            "spans": [
+                {
+                    "traceId": sp.trace_id,
+                    "spanId": sp.span_id,
+                    **({"parentSpanId": sp.parent_id} if sp.parent_id else {}),
+                    "name": sp.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(sp.start_ns),
+                    "endTimeUnixNano": str(sp.end_ns),
+                    "attributes": _otlp_attrs(sp.attrs),
+                    "status": {"code": 2 if sp.status == "error" else 1},
+                }
+                for sp in spans
+            ],
+        }],
+    }]}
+
+
+class _OtlpExporter:
+    # OTLP/HTTP with JSON bodies, e.g. to a collector on localhost:4318.
+    def __init__(self, endpoint: str, interval_s: float):
+        self.endpoint = endpoint
+        self.interval_s = interval_s
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="otlp-export", daemon=True)
+
+    def start(self) -> None:
+        registry.keep_spans = True
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self.flush()
+
+    def flush(self) -> None:
+        import httpx
+
+        with registry.lock:
+            spans = list(registry.spans)
+            registry.spans.clear()
+        try:
+            with httpx.Client(timeout=5.0) as client:
+                if spans:
+                    client.post(f"{self.endpoint}/v1/traces",
+                                json=otlp_traces_payload(spans)).raise_for_status()
+                client.post(f"{self.endpoint}/v1/metrics",
+                            json=otlp_metrics_payload()).raise_for_status()
+        except Exception as e:
+            logger.warning("OTLP export to %s failed: %s", self.endpoint, e)
+
+
+_exporter: _OtlpExporter | None = None
+
+
+def _start_otlp_exporter(endpoint: str) -> None:
+    global _exporter
+    if _exporter is not None:
+        return
+    try:
+        interval_s = float(os.environ.get("RAG_OTLP_INTERVAL_S", "15"))
+    except ValueError:
+        interval_s = 15.0
+    _exporter = _OtlpExporter(endpoint, interval_s)
+    _exporter.start()
+
+
+def flush() -> None:
+    if _exporter is not None:
+        _exporter.flush()
+
+
+# ------------------------
+# LOGGING
+# ------------------------
+
+_STANDARD_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime",
+}
+
+
+class ExtrasFormatter(logging.Formatter):
+    # Appends the `extra={...}` fields of a record as key=value pairs; the
+    # stock formatter silently drops them.
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        extras = {
+            k: v for k, v in vars(record).items()
+            if k not in _STANDARD_RECORD_ATTRS and not k.startswith("_")
+        }
+        if not extras:
+            return text
+        return text + " " + " ".join(
+            f"{k}={json.dumps(v, ensure_ascii=False, default=str)}" for k, v in extras.items())
+
+
+def install_log_formatter(fmt: str = logging.BASIC_FORMAT) -> None:
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(ExtrasFormatter(fmt))
@@ -0,0 +1,134 @@
+import binascii
+import re
+import zlib
+
+import numpy as np
+
+
+STOPWORDS_PL = {
+    "a",
+    "aby",
+    "albo",
+    "ale",
+    "bo",
+    "co",
+    "czy",
+    "dla",
+    "do",
+    "gdzie",
+    "i",
+    "jak",
+    "jaka",
+    "jakie",
+    "jaki",
+    "jest",
+    "kiedy",
+    "która",
+    "które",
+    "który",
+    "ma",
+    "mam",
+    "mi",
+    "mnie",
+    "na",
+    "nad",
+    "nie",
+    "o",
+    "od",
+    "oraz",
+    "po",
+    "pod",
+    "się",
+    "są",
+    "ta",
+    "ten",
+    "to",
+    "tu",
+    "w",
+    "we",
+    "z",
+    "za",
+    "ze",
+}
+
+
+_TOKEN = re.compile(r"[\wąćęłńóśźż]+")
+
+
+def token_list_pl(text: str) -> list[str]:
+    t = (text or "").casefold()
+    return [
+        tok for tok in _TOKEN.findall(t)
+        if len(tok) >= 3 and tok not in STOPWORDS_PL
+    ]
+
+
+def tokens_pl(text: str) -> set[str]:
+    return set(token_list_pl(text))
+
+
+STEM_CHARS = 5
+
+
+def stems_pl(text: str) -> set[str]:
+    # Crude stemming by prefix, so inflected Polish forms still match.
+    return {t[:STEM_CHARS] for t in token_list_pl(text)}
+
+
+# Chunks carry their token set as a sorted array of 32-bit token hashes,
+# base64-encoded under this metadata key, computed once at ingest. A hash
+# collision can only make two token sets look like they overlap.
+SIGNATURE_KEY = "lexical_sig"
+# The same for the token stems.
+STEM_SIGNATURE_KEY = "stem_sig"
+
+
+def token_hashes(tokens) -> np.ndarray:
+    return np.unique(np.fromiter(
+        (zlib.crc32(t.encode("utf-8")) for t in tokens), dtype=np.uint32))
+
+
+def _encode(hashes: np.ndarray) -> str:
+    return binascii.b2a_base64(hashes.astype("<u4").tobytes(), newline=False).decode("ascii")
+
+
+def lexical_signature(text: str) -> str:
+    return _encode(token_hashes(tokens_pl(text)))
+
+
+def stem_signature(text: str) -> str:
+    return _encode(token_hashes(stems_pl(text)))
+
+
+def signature_of(doc) -> np.ndarray:
+    sig = (doc.metadata or {}).get(SIGNATURE_KEY)
+    if isinstance(sig, str):
+        return np.frombuffer(binascii.a2b_base64(sig), dtype="<u4")
+    # Chunks indexed before signatures existed.
+    return token_hashes(tokens_pl(doc.page_content))
+
+
+def stem_signature_of(doc) -> np.ndarray:
+    sig = (doc.metadata or {}).get(STEM_SIGNATURE_KEY)
+    if isinstance(sig, str):
+        return np.frombuffer(binascii.a2b_base64(sig), dtype="<u4")
+    return token_hashes(stems_pl(doc.page_content))
+
+
+def signature_hits(sig: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    # Which of the sorted token `hashes` are in the signature.
+    if not sig.size:
+        return np.zeros(hashes.size, dtype=bool)
+    return sig.take(sig.searchsorted(hashes), mode="clip") == hashes
+
+
+def overlap_hits(tokens: set[str], docs) -> int:
+    # How many of `tokens` occur in any of the docs; the same count as
+    # intersecting them with the tokens of the joined docs.
+    q = token_hashes(tokens)
+    found = np.zeros(q.size, dtype=bool)
+    for d in docs:
+        found |= signature_hits(signature_of(d), q)
+        if found.all():
+            break
+    return int(found.sum())
@@ -1,15 +1,27 @@
 from functools import lru_cache
 
-from langchain_community.vectorstores.azuresearch import AzureSearch
+from langchain_core.vectorstores import VectorStore
 
 from config.embeddings import get_embeddings
 from config.settings import get_settings
-from azure.search.documents.indexes.models import SearchField
 
 
 @lru_cache(maxsize=1)
-def get_vector_store() -> AzureSearch:
+def get_vector_store() -> VectorStore:
     s = get_settings()
+    if s.vector_backend == "local":
+        from rag.local_vector_store import LocalVectorStore
+
+        return LocalVectorStore(
+            s.local_index_path,
+            get_embeddings(),
+            ann_min_rows=s.local_ann_min_rows,
+            ann_nprobe=s.local_ann_nprobe,
+        )
+
+    from langchain_community.vectorstores.azuresearch import AzureSearch
+    from azure.search.documents.indexes.models import SearchField
+
     return AzureSearch(
         azure_search_endpoint=s.azure_search_endpoint,
         azure_search_key=s.azure_search_key,
@@ -21,3 +33,53 @@ def get_vector_store() -> AzureSearch:
             SearchField(name="doc_id", type="Edm.String"),
         ]
     )
+
+
+# Azure Search returns at most 1000 results per request.
+_SEARCH_PAGE = 1000
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def find_ids_by_doc_id(doc_id: str) -> list[str]:
+    store = get_vector_store()
+    if hasattr(store, "ids_for_doc_id"):
+        return store.ids_for_doc_id(doc_id)
+
+    from azure.core.exceptions import HttpResponseError
+
+    # Keyset paging in id order; skip-based pages have no stable order and
+    # can overlap or miss rows.
+    doc_filter = f"doc_id eq {_quote(doc_id)}"
+    ids: list[str] = []
+    try:
+        while True:
+            after = f" and id gt {_quote(ids[-1])}" if ids else ""
+            page = [r["id"] for r in store.client.search(
+                search_text="*",
+                filter=doc_filter + after,
+                select=["id"],
+                order_by=["id asc"],
+                top=_SEARCH_PAGE,
+            )]
+            ids.extend(page)
+            if len(page) < _SEARCH_PAGE:
+                return ids
+    except HttpResponseError as e:
+        if ids or "sort" not in str(e).lower():
+            raise
+    # Indexes created by langchain's AzureSearch don't mark id as sortable:
+    # page by excluding the ids already seen instead.
+    while True:
+        seen = f" and not search.in(id, {_quote(','.join(ids))}, ',')" if ids else ""
+        page = [r["id"] for r in store.client.search(
+            search_text="*",
+            filter=doc_filter + seen,
+            select=["id"],
+            top=_SEARCH_PAGE,
+        )]
+        ids.extend(page)
+        if len(page) < _SEARCH_PAGE:
+            return ids
@@ -159,16 +159,19 @@ if st.session_state.pending_prompt:
             st.session_state.chain = _build_chain(v)
             st.session_state.chain_version = v
 
-        raw = st.session_state.chain.invoke(
-            {"input": pending, "chat_history": history}
-        )
+        from rag.rag_chain import AnswerReplace
 
-        if isinstance(raw, dict):
-            response = raw.get("answer") or raw.get("output") or str(raw)
-        elif hasattr(raw, "content"):
-            response = raw.content
-        else:
-            response = str(raw)
+        response = ""
+        for chunk in st.session_state.chain.stream(
+            {"input": pending, "chat_history": history}
+        ):
+            if hasattr(chunk, "content"):
+                chunk = chunk.content
+            if isinstance(chunk, AnswerReplace):
+                response = str(chunk)
+            else:
+                response += str(chunk or "")
+            placeholder.markdown(response + "▌")
 
         placeholder.markdown(response)
 